@@ -0,0 +1,40 @@
+import os, time
+from events import addBlockingHandler, addNonBlockingHandler
+from common import newCommitLogger, newLoggingShell, setCommitStatus, BuildStatus
+from charts import DeployableDiff
+
+# the handlers bench/run.py dispatches to, every run appends a line to CD_BENCH_RESULTS:
+# <head> <when the event was created> <when the handler started> <when it finished>
+
+
+def record(e, start):
+    with open(os.environ['CD_BENCH_RESULTS'], 'a') as f:
+        f.write(f"{e['head']} {e['bench_created']} {start} {time.time()}\n")
+
+
+# what a typical nonblocking handler does: log to the commit and run a few commands, one per line of CD_BENCH_COMMANDS
+def runCommands(e):
+    start = time.time()
+    log = newCommitLogger(e['head'])
+    sh = newLoggingShell(log)
+    for cmd in os.environ.get('CD_BENCH_COMMANDS', 'true').split('\n'):
+        if cmd.strip():
+            sh(cmd)
+    record(e, start)
+
+
+# the chart pipeline of examples/iks, minus the rollback and notifications when something fails
+def deployCharts(e):
+    start = time.time()
+    diff = DeployableDiff.createFromMerge(e)
+    setCommitStatus(diff.head, BuildStatus.pending, 'Starting deployment..', diff.outputURL)
+    diff.initializeCharts()
+    if not diff.deploy() or not diff.runTests():
+        setCommitStatus(diff.head, BuildStatus.failure, 'Deployment or tests failed.', diff.outputURL)
+        raise Exception('Deployment or tests failed.')
+    setCommitStatus(diff.head, BuildStatus.success, 'Deployment and tests successful!', diff.outputURL)
+    record(e, start)
+
+
+addNonBlockingHandler('PushEvent', runCommands, filterFn="ref == 'refs/heads/master'")
+addBlockingHandler('PushEvent', deployCharts, filterFn="ref == 'refs/heads/charts'")
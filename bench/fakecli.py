@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+"""
+Stands in for kubectl, helm, kdep and kdep-merge-inherited-values, bench/run.py links it into a directory on PATH
+under each of those names and it acts according to the name it was called by.
+Every call sleeps CD_BENCH_CLI_LATENCY seconds first, to model the start up time of the real tools.
+
+Releases are kept the way Tiller keeps them, as ConfigMaps in kube-system of the fake api server at CD_KUBE_API_URL,
+so charts.ReleaseSnapshot reads them like it would in a cluster. Test Jobs are created already complete.
+Values files are expected to be JSON, which is YAML as well, and are taken to be fully merged already.
+"""
+import json, os, sys, time, hashlib
+from urllib.request import Request, urlopen
+from urllib.error import HTTPError
+
+TILLER_NAMESPACE = os.environ.get('TILLER_NAMESPACE', 'kube-system')
+
+
+def api(method, path, body=None, **query):
+    url = os.environ['CD_KUBE_API_URL'] + path
+    if query:
+        url += '?' + '&'.join(f'{key}={value}' for key, value in query.items())
+    data = json.dumps(body).encode('utf-8') if body is not None else None
+    contentType = 'application/merge-patch+json' if method == 'PATCH' else 'application/json'
+    with urlopen(Request(url, data, {'Content-Type': contentType}, method=method)) as resp:
+        return json.loads(resp.read().decode('utf-8'))
+
+
+def now():
+    return time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())
+
+
+# kdep -i [-d] [-t RELEASE] VALUES_FILE
+def kdep(args):
+    flags = dict(zip(args, args[1:]))
+    chart = args[-1].lstrip('./').split('/')[0]
+    if '-d' in args:
+        print(f'dry run of {chart}')
+    elif '-t' in args:
+        release = flags['-t']
+        api(
+            'POST', f'/apis/batch/v1/namespaces/{chart.split("-")[0]}/jobs', {
+                'apiVersion': 'batch/v1',
+                'kind': 'Job',
+                'metadata': {
+                    'name': release,
+                    'labels': {
+                        'job-name': release
+                    }
+                },
+                'status': {
+                    'succeeded': 1,
+                    'completionTime': now(),
+                    'conditions': [{
+                        'type': 'Complete',
+                        'status': 'True'
+                    }]
+                }
+            })
+        print(f'job {release} created')
+    else:
+        path = f'/api/v1/namespaces/{TILLER_NAMESPACE}/configmaps'
+        revisions = api('GET', path, labelSelector=f'OWNER=TILLER,NAME={chart}')['items']
+        for item in revisions:
+            if item['metadata']['labels']['STATUS'] == 'DEPLOYED':
+                api('PATCH', f'{path}/{item["metadata"]["name"]}', {'metadata': {'labels': {'STATUS': 'SUPERSEDED'}}})
+        version = max([int(item['metadata']['labels']['VERSION']) for item in revisions] + [0]) + 1
+        api(
+            'POST', path, {
+                'apiVersion': 'v1',
+                'kind': 'ConfigMap',
+                'metadata': {
+                    'name': f'{chart}.v{version}',
+                    'labels': {
+                        'OWNER': 'TILLER',
+                        'NAME': chart,
+                        'VERSION': str(version),
+                        'STATUS': 'DEPLOYED'
+                    }
+                },
+                'data': {
+                    'release': ''
+                }
+            })
+        print(f'release {chart} upgraded to revision {version}')
+
+
+# helm template ./CHART --name NAME --values FILE, anything else gets an empty answer
+def helm(args):
+    if args[:1] == ['template']:
+        with open(args[args.index('--values') + 1], 'rb') as f:
+            print(f'# {args[1]}\nkind: ConfigMap\nchecksum: {hashlib.sha1(f.read()).hexdigest()}')
+    elif args[:1] == ['ls']:
+        print('{}')
+
+
+def main():
+    time.sleep(float(os.environ.get('CD_BENCH_CLI_LATENCY', '0')))
+    name, args = os.path.basename(sys.argv[0]), sys.argv[1:]
+    try:
+        if name == 'kdep':
+            kdep(args)
+        elif name == 'kdep-merge-inherited-values':
+            with open(args[0]) as f:
+                print(f.read())
+        elif name == 'helm':
+            helm(args)
+        elif name == 'kubectl':
+            print(f'fake kubectl {" ".join(args)}')
+    except HTTPError as e:
+        print(f'{name}: {e.code} {e.read().decode("utf-8")}', file=sys.stderr)
+        exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,161 @@
+"""
+A stand-in for the parts of the GitHub api quickcd uses: the events feed with pagination and ETags, comments,
+statuses and the rate limit headers. Events are added through /_bench/events, /_bench/stats counts requests.
+
+python bench/fakegithub.py [--latency SECONDS] [--per-page N] [--poll-interval SECONDS] [--rate-limit N]
+prints the port it listens on, then serves until killed
+"""
+import argparse, json, re, threading, time
+from collections import Counter
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+from urllib.parse import urlparse, parse_qs
+
+MAX_EVENTS = 300  # like GitHub, older events drop off the feed
+lock = threading.Lock()
+events = []  # newest first
+nextID = [1000000]
+comments = {}  # id -> body
+requests = Counter()  # 'METHOD endpoint' -> count
+settings = None
+
+
+def addEvents(spec):
+    created = []
+    with lock:
+        for i in range(spec.get('count', 1)):
+            nextID[0] += 1
+            payload = dict(spec.get('payload') or {}, bench_created=time.time())
+            if spec.get('type', 'PushEvent') == 'PushEvent':
+                payload.setdefault('head', '%040x' % nextID[0])
+                payload.setdefault('before', '%040x' % (nextID[0] - 1))
+                payload.setdefault('ref', 'refs/heads/master')
+            event = {
+                'id': str(nextID[0]),
+                'type': spec.get('type', 'PushEvent'),
+                'actor': {
+                    'login': 'bench'
+                },
+                'repo': {
+                    'name': 'bench/repo'
+                },
+                'payload': payload,
+                'created_at': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+            }
+            events.insert(0, event)
+            created.append(event['id'])
+        del events[MAX_EVENTS:]
+    return created
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def respond(self, status, body=None, headers={}):
+        data = json.dumps(body).encode('utf-8') if body is not None else b''
+        self.send_response(status)
+        for key, value in dict(self.rateLimitHeaders(), **headers).items():
+            self.send_header(key, value)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def rateLimitHeaders(self):
+        total = sum(requests.values())
+        return {
+            'X-RateLimit-Limit': str(settings.rate_limit),
+            'X-RateLimit-Remaining': str(max(0, settings.rate_limit - total)),
+            'X-RateLimit-Reset': str(int(time.time()) + 3600)
+        }
+
+    def readJSON(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return json.loads(self.rfile.read(length).decode('utf-8')) if length else None
+
+    def route(self, method):
+        url = urlparse(self.path)
+        query = dict((k, v[0]) for k, v in parse_qs(url.query).items())
+        endpoint = re.sub(r'/(\d+|[0-9a-f]{40})(?=/|$)', '/*', url.path)
+        if not url.path.startswith('/_bench/'):
+            with lock:
+                requests[f'{method} {endpoint}'] += 1
+            if settings.latency:
+                time.sleep(settings.latency)
+        return url.path, query
+
+    def do_GET(self):
+        path, query = self.route('GET')
+        if path == '/_bench/stats':
+            with lock:
+                return self.respond(200, {'requests': dict(requests), 'events': len(events)})
+        if path.endswith('/events'):
+            return self.eventsPage(path, query)
+        if re.search(r'/commits/[^/]+/status$', path):
+            return self.respond(200, {'state': 'pending', 'statuses': []})
+        return self.respond(404, {'message': 'Not Found'})
+
+    def eventsPage(self, path, query):
+        perPage = min(100, int(query.get('per_page', settings.per_page)))
+        page = int(query.get('page', '1'))
+        with lock:
+            etag = '"%s"' % (events[0]['id'] if events else 'empty')
+            if page == 1 and self.headers.get('If-None-Match') == etag:
+                return self.respond(304, headers={'ETag': etag, 'X-Poll-Interval': str(settings.poll_interval)})
+            last = max(1, (len(events) + perPage - 1) // perPage)
+            pageEvents = events[(page - 1) * perPage:page * perPage]
+        base = f'http://{self.headers["Host"]}{path}?per_page={perPage}&page='
+        links = []
+        if page < last:
+            links += [f'<{base}{page + 1}>; rel="next"', f'<{base}{last}>; rel="last"']
+        if page > 1:
+            links += [f'<{base}1>; rel="first"', f'<{base}{page - 1}>; rel="prev"']
+        headers = {'ETag': etag, 'X-Poll-Interval': str(settings.poll_interval)}
+        if links:
+            headers['Link'] = ', '.join(links)
+        self.respond(200, pageEvents, headers)
+
+    def do_POST(self):
+        path, query = self.route('POST')
+        body = self.readJSON()
+        if path == '/_bench/events':
+            return self.respond(200, {'ids': addEvents(body or {})})
+        if path.endswith('/comments'):
+            with lock:
+                id = len(comments) + 1
+                comments[id] = body.get('body', '')
+            base = f'http://{self.headers["Host"]}'
+            return self.respond(201, {'id': id, 'url': f'{base}/comments/{id}', 'html_url': f'{base}/comments/{id}'})
+        if re.search(r'/statuses/[^/]+$', path):
+            return self.respond(201, dict(body, id=1))
+        return self.respond(404, {'message': 'Not Found'})
+
+    def do_PATCH(self):
+        path, query = self.route('PATCH')
+        body = self.readJSON()
+        match = re.search(r'/comments/(\d+)$', path)
+        if match:
+            with lock:
+                comments[int(match.group(1))] = body.get('body', '')
+            return self.respond(200, {'id': int(match.group(1))})
+        return self.respond(404, {'message': 'Not Found'})
+
+
+class ThreadingServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--port', type=int, default=0)
+    parser.add_argument('--latency', type=float, default=0, help='seconds added to every api call')
+    parser.add_argument('--per-page', type=int, default=30)
+    parser.add_argument('--poll-interval', type=int, default=1, help='sent as X-Poll-Interval')
+    parser.add_argument('--rate-limit', type=int, default=1000000, help='requests allowed before the limit is hit')
+    settings = parser.parse_args()
+    server = ThreadingServer(('127.0.0.1', settings.port), RequestHandler)
+    print(server.server_address[1], flush=True)
+    server.serve_forever()
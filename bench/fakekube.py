@@ -0,0 +1,209 @@
+"""
+An in-memory stand-in for the parts of the Kubernetes api quickcd uses: ConfigMaps and Jobs, with label and field
+selectors, merge patches, resourceVersion checks on replace and watches. /_bench/stats counts requests.
+Jobs are created by bench/fakecli.py, already finished, see kdep -t there.
+
+python bench/fakekube.py [--latency SECONDS]
+prints the port it listens on, then serves until killed
+"""
+import argparse, json, re, threading, time
+from collections import Counter
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+from urllib.parse import urlparse, parse_qs
+
+changed = threading.Condition()
+objects = {}  # (kind, namespace, name) -> object
+history = []  # (resourceVersion, type, kind, object), for watches
+resourceVersion = [0]
+requests = Counter()  # 'METHOD kind' -> count
+settings = None
+paths = {
+    'configmaps': re.compile(r'^/api/v1/namespaces/([^/]+)/configmaps(?:/([^/]+))?$'),
+    'jobs': re.compile(r'^/apis/batch/v1/namespaces/([^/]+)/jobs(?:/([^/]+))?$'),
+}
+
+
+def selected(obj, labelSelector=None, fieldSelector=None):
+    labels = obj['metadata'].get('labels') or {}
+    for part in (labelSelector or '').split(','):
+        if part and labels.get(part.split('=', 1)[0]) != part.split('=', 1)[1]:
+            return False
+    return not fieldSelector or obj['metadata']['name'] == fieldSelector.split('=', 1)[1]
+
+
+# call with changed held
+def record(type, kind, obj):
+    resourceVersion[0] += 1
+    obj['metadata']['resourceVersion'] = str(resourceVersion[0])
+    history.append((resourceVersion[0], type, kind, json.loads(json.dumps(obj))))
+    changed.notify_all()
+
+
+def mergePatch(target, patch):
+    for key, value in patch.items():
+        if value is None:
+            target.pop(key, None)
+        elif isinstance(value, dict) and isinstance(target.get(key), dict):
+            mergePatch(target[key], value)
+        else:
+            target[key] = value
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def respond(self, status, body):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def status(self, code, reason):
+        self.respond(code, {'kind': 'Status', 'code': code, 'reason': reason})
+
+    def readJSON(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return json.loads(self.rfile.read(length).decode('utf-8')) if length else None
+
+    # (kind, namespace, name, query), or None after responding with a 404
+    def route(self, method):
+        url = urlparse(self.path)
+        query = dict((k, v[0]) for k, v in parse_qs(url.query).items())
+        if url.path == '/_bench/stats':
+            with changed:
+                self.respond(200, {'requests': dict(requests), 'objects': len(objects)})
+            return None
+        for kind, pattern in paths.items():
+            match = pattern.match(url.path)
+            if match:
+                with changed:
+                    requests[f'{method} {kind}'] += 1
+                if settings.latency:
+                    time.sleep(settings.latency)
+                return kind, match.group(1), match.group(2), query
+        self.status(404, 'NotFound')
+        return None
+
+    def do_GET(self):
+        route = self.route('GET')
+        if not route:
+            return
+        kind, namespace, name, query = route
+        if query.get('watch') in ('1', 'true'):
+            return self.watch(kind, namespace, query)
+        with changed:
+            if name:
+                obj = objects.get((kind, namespace, name))
+                return self.respond(200, obj) if obj else self.status(404, 'NotFound')
+            items = [
+                obj for (k, ns, n), obj in sorted(objects.items()) if k == kind and ns == namespace and
+                selected(obj, query.get('labelSelector'), query.get('fieldSelector'))
+            ]
+            self.respond(200, {
+                'kind': 'List',
+                'items': items,
+                'metadata': {
+                    'resourceVersion': str(resourceVersion[0])
+                }
+            })
+
+    def watch(self, kind, namespace, query):
+        since = int(query.get('resourceVersion') or resourceVersion[0])
+        deadline = time.time() + int(query.get('timeoutSeconds', 300))
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        while time.time() < deadline:
+            with changed:
+                pending = [entry for entry in history if entry[0] > since]
+                if not pending:
+                    changed.wait(min(1, max(0, deadline - time.time())))
+                    continue
+            for version, type, objKind, obj in pending:
+                since = version
+                if objKind == kind and obj['metadata']['namespace'] == namespace and selected(
+                        obj, query.get('labelSelector'), query.get('fieldSelector')):
+                    line = (json.dumps({'type': type, 'object': obj}) + '\n').encode('utf-8')
+                    self.wfile.write(b'%x\r\n%s\r\n' % (len(line), line))
+                    self.wfile.flush()
+        self.wfile.write(b'0\r\n\r\n')
+
+    def do_POST(self):
+        route = self.route('POST')
+        if not route:
+            return
+        kind, namespace, name, query = route
+        obj = self.readJSON()
+        with changed:
+            key = (kind, namespace, obj['metadata']['name'])
+            if key in objects:
+                return self.status(409, 'AlreadyExists')
+            obj['metadata'].update(namespace=namespace,
+                                   creationTimestamp=time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()))
+            objects[key] = obj
+            record('ADDED', kind, obj)
+            self.respond(201, obj)
+
+    def do_PATCH(self):
+        route = self.route('PATCH')
+        if not route:
+            return
+        kind, namespace, name, query = route
+        patch = self.readJSON()
+        with changed:
+            obj = objects.get((kind, namespace, name))
+            if not obj:
+                return self.status(404, 'NotFound')
+            mergePatch(obj, patch)
+            record('MODIFIED', kind, obj)
+            self.respond(200, obj)
+
+    def do_PUT(self):
+        route = self.route('PUT')
+        if not route:
+            return
+        kind, namespace, name, query = route
+        obj = self.readJSON()
+        with changed:
+            current = objects.get((kind, namespace, name))
+            if not current:
+                return self.status(404, 'NotFound')
+            if obj['metadata'].get('resourceVersion') not in (None, current['metadata']['resourceVersion']):
+                return self.status(409, 'Conflict')
+            obj['metadata'].update(namespace=namespace, creationTimestamp=current['metadata']['creationTimestamp'])
+            objects[(kind, namespace, name)] = obj
+            record('MODIFIED', kind, obj)
+            self.respond(200, obj)
+
+    def do_DELETE(self):
+        route = self.route('DELETE')
+        if not route:
+            return
+        kind, namespace, name, query = route
+        with changed:
+            obj = objects.pop((kind, namespace, name), None)
+            if not obj:
+                return self.status(404, 'NotFound')
+            record('DELETED', kind, obj)
+            self.respond(200, {'kind': 'Status', 'status': 'Success'})
+
+
+class ThreadingServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--port', type=int, default=0)
+    parser.add_argument('--latency', type=float, default=0, help='seconds added to every api call')
+    settings = parser.parse_args()
+    server = ThreadingServer(('127.0.0.1', settings.port), RequestHandler)
+    print(server.server_address[1], flush=True)
+    server.serve_forever()
@@ -0,0 +1,365 @@
+"""
+End to end benchmark of quickcd's main loop: polling, saving, dispatching and running handlers against a fake GitHub
+(bench/fakegithub.py), a fake Kubernetes api server (bench/fakekube.py) and fake kubectl, helm and kdep
+(bench/fakecli.py). Handlers are the ones in bench/eventHandlers.py, quickcd's own main() does the rest.
+
+Scenarios:
+  pending  --events N (default 1000) events are already saved and waiting when quickcd starts,
+           latency is counted from when they were saved, so it includes start up
+  poll     --events N (default 250) events show up on GitHub once quickcd is up, all at once or --rate per second,
+           GitHub only keeps the latest 300 events so more than that at once can't all be picked up
+  charts   --events N (default 1) pushes that each change all of --charts N (default 50) charts, which are deployed
+           and tested by a blocking handler, every fifth chart depends on the one before it
+
+Reports events per second, dispatch latency percentiles (from the event being created to its handler starting),
+and subprocesses, GitHub requests and Kubernetes api requests per event.
+
+python bench/run.py pending --workers 8 --cli-latency 0.05
+python bench/run.py charts --charts 100 --kube-latency 0.01 --json
+"""
+import argparse, json, os, shutil, subprocess, sys, tempfile, threading, time
+from collections import Counter
+from urllib.request import Request, urlopen
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(BENCH_DIR)
+sys.path[1:1] = [ROOT, os.path.join(ROOT, 'bundles', 'kdep')]  # bench comes first, for its eventHandlers
+FIRST_EVENT_ID = 1000001  # fakegithub.py's first id
+ORG, REPO, DOMAIN = 'bench', 'repo', 'github.bench'
+
+
+def parseArgs():
+    parser = argparse.ArgumentParser(description='End to end benchmark of quickcd.')
+    parser.add_argument('scenario', choices=['pending', 'poll', 'charts'])
+    parser.add_argument('--events', type=int, help='number of events, the default depends on the scenario')
+    parser.add_argument('--charts', type=int, default=50, help='charts changed per push in the charts scenario')
+    parser.add_argument('--rate', type=float, default=0, help='events per second for poll, 0 is all at once')
+    parser.add_argument('--workers', type=int, default=4, help='CD_WORKERS')
+    parser.add_argument('--commands', default='true\ngit --version', help='what the nonblocking handler runs')
+    parser.add_argument('--github-latency', type=float, default=0, help='seconds added to every GitHub api call')
+    parser.add_argument('--kube-latency', type=float, default=0, help='seconds added to every Kubernetes api call')
+    parser.add_argument('--cli-latency', type=float, default=0, help='seconds every kubectl, helm and kdep call takes')
+    parser.add_argument('--per-page', type=int, default=30, help='events per page of the GitHub events api')
+    parser.add_argument('--timeout', type=float, default=600)
+    parser.add_argument('--json', action='store_true', help='print the report as JSON')
+    parser.add_argument('--verbose', action='store_true', help="show quickcd's output instead of keeping it in a file")
+    parser.add_argument('--keep', action='store_true', help="keep the temporary directory with quickcd's output")
+    args = parser.parse_args()
+    if args.events is None:
+        args.events = {'pending': 1000, 'poll': 250, 'charts': 1}[args.scenario]
+    return args
+
+
+def startFake(script, *args):
+    process = subprocess.Popen([sys.executable, os.path.join(BENCH_DIR, script)] + [str(arg) for arg in args],
+                               stdout=subprocess.PIPE)
+    return process, f'http://127.0.0.1:{int(process.stdout.readline())}'
+
+
+def call(method, url, body=None):
+    data = json.dumps(body).encode('utf-8') if body is not None else None
+    with urlopen(Request(url, data, {'Content-Type': 'application/json'}, method=method)) as resp:
+        return json.loads(resp.read().decode('utf-8'))
+
+
+def git(repo, *args):
+    return subprocess.check_output(['git', '-C', repo] + list(args), stderr=subprocess.DEVNULL).decode('utf-8').strip()
+
+
+class Bench:
+
+    def __init__(self, args):
+        self.args = args
+        self.tmp = tempfile.mkdtemp(prefix='quickcd-bench-')
+        self.fakes = []
+        self.start = None
+        self.finished = None
+        self.error = None
+        self.startCounts = None
+
+    def setUp(self):
+        args = self.args
+        github, self.githubURL = startFake('fakegithub.py', '--latency', args.github_latency, '--per-page',
+                                           args.per_page)
+        kube, self.kubeURL = startFake('fakekube.py', '--latency', args.kube_latency)
+        self.fakes = [github, kube]
+
+        # kubectl, helm etc. are all fakecli.py, run by the same python as we are
+        bin = os.path.join(self.tmp, 'bin')
+        os.makedirs(bin)
+        for name in ('kubectl', 'helm', 'kdep', 'kdep-merge-inherited-values'):
+            os.symlink(os.path.join(BENCH_DIR, 'fakecli.py'), os.path.join(bin, name))
+        os.symlink(sys.executable, os.path.join(bin, 'python3'))
+
+        # clones of https://github.bench/bench/repo come from a local repository
+        home = os.path.join(self.tmp, 'home')
+        self.origin = os.path.join(self.tmp, 'origin')
+        os.makedirs(home)
+        with open(os.path.join(home, '.gitconfig'), 'w') as f:
+            f.write(f'[user]\n\tname = bench\n\temail = bench@{DOMAIN}\n'
+                    f'[url "{self.origin}"]\n\tinsteadOf = https://{DOMAIN}/{ORG}/{REPO}\n')
+
+        self.results = os.path.join(self.tmp, 'results')
+        os.environ.update(HOME=home,
+                          PATH=bin + os.pathsep + os.environ['PATH'],
+                          CD_ENVIRONMENT='bench',
+                          CD_REGION_DASHED='local-1',
+                          CD_CLUSTER_NAME='bench',
+                          CD_EMAIL_ADDRESS=f'bench@{DOMAIN}',
+                          CD_GITHUB_TOKEN='bench',
+                          CD_GITHUB_DOMAIN=DOMAIN,
+                          CD_GITHUB_ORG_NAME=ORG,
+                          CD_GITHUB_REPO_NAME=REPO,
+                          CD_GITHUB_API_URL=self.githubURL,
+                          CD_KUBE_API_URL=self.kubeURL,
+                          CD_LOCAL_MODE='false',
+                          CD_WORKERS=str(args.workers),
+                          CD_POLL_MIN_INTERVAL='1',
+                          CD_EVENT_RETENTION_DAYS='0',
+                          CD_WORKSPACE_ROOT=os.path.join(self.tmp, 'workspaces'),
+                          CD_ARTIFACT_DIR=os.path.join(self.tmp, 'artifacts'),
+                          CD_GIT_CACHE_DIR=os.path.join(self.tmp, 'git-cache'),
+                          CD_VALUES_CACHE_DIR=os.path.join(self.tmp, 'values-cache'),
+                          CD_CHARTS_DEBUG='false',
+                          CD_BENCH_RESULTS=self.results,
+                          CD_BENCH_COMMANDS=args.commands,
+                          CD_BENCH_CLI_LATENCY=str(args.cli_latency))
+        for key in ('CD_GITHUB_REPOS', 'CD_WEBHOOK_SECRET', 'CD_METRICS', 'CD_TRACE_SAMPLE_RATE'):
+            os.environ.pop(key, None)
+
+        self.initRepository()
+        if args.scenario == 'pending':
+            self.seedPendingEvents()
+        else:
+            self.saveCursor(FIRST_EVENT_ID - 1, '"none"')
+
+    def initRepository(self):
+        git(self.tmp, 'init', '-q', '--bare', self.origin)
+        work = os.path.join(self.tmp, 'work')
+        git(self.tmp, 'clone', '-q', self.origin, work)
+        with open(os.path.join(work, 'README'), 'w') as f:
+            f.write('quickcd benchmark\n')
+        for i in range(self.args.charts if self.args.scenario == 'charts' else 0):
+            self.writeChart(work, i, 0)
+        git(work, 'add', '-A')
+        git(work, 'commit', '-q', '-m', 'initial')
+        git(work, 'push', '-q', 'origin', 'HEAD:refs/heads/charts', 'HEAD:refs/heads/master')
+        self.work = work
+
+    def writeChart(self, work, i, revision):
+        name = f'chart{i:03}-app'
+        os.makedirs(os.path.join(work, name), exist_ok=True)
+        with open(os.path.join(work, name, 'Chart.yaml'), 'w') as f:
+            f.write(f'name: {name}\nversion: 0.1.0\n')
+        values = {
+            'revision': revision,
+            'continuousDeployment': {
+                'enabled': True,
+                'integrationTests': {
+                    f'chart{i:03}-test': {}
+                },
+                'dependsOn': [f'chart{i - 1:03}-app'] if i % 5 else []
+            }
+        }
+        with open(os.path.join(work, name, 'local1-bench-values.yaml'), 'w') as f:
+            json.dump(values, f, indent=2)
+
+    # one commit per push, each changes every chart
+    def pushCharts(self):
+        pushes = []
+        for revision in range(1, self.args.events + 1):
+            before = git(self.work, 'rev-parse', 'HEAD')
+            for i in range(self.args.charts):
+                self.writeChart(self.work, i, revision)
+            git(self.work, 'commit', '-q', '-a', '-m', f'revision {revision}')
+            pushes.append({'ref': 'refs/heads/charts', 'before': before, 'head': git(self.work, 'rev-parse', 'HEAD')})
+        git(self.work, 'push', '-q', 'origin', 'HEAD:refs/heads/charts')
+        return pushes
+
+    def saveCursor(self, eventID, etag):
+        self.createConfigMap(f'quickcd-{ORG}-{REPO}-event-cursor', {'owner': 'quickcd'}, {
+            'eventID': str(eventID),
+            'ETag': etag
+        })
+
+    def createConfigMap(self, name, labels, data):
+        call('POST', f'{self.kubeURL}/api/v1/namespaces/default/configmaps', {
+            'apiVersion': 'v1',
+            'kind': 'ConfigMap',
+            'metadata': {
+                'name': name,
+                'labels': labels
+            },
+            'data': data
+        })
+
+    # saved the way events.saveEvents saves them
+    def seedPendingEvents(self):
+        created = time.time()
+        for id in range(FIRST_EVENT_ID, FIRST_EVENT_ID + self.args.events):
+            event = {
+                'id': str(id),
+                'type': 'PushEvent',
+                'actor': {
+                    'login': 'bench'
+                },
+                'repo': {
+                    'name': f'{ORG}/{REPO}'
+                },
+                'payload': {
+                    'ref': 'refs/heads/master',
+                    'head': '%040x' % id,
+                    'before': '%040x' % (id - 1),
+                    'bench_created': created
+                },
+                'created_at': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(created))
+            }
+            labels = {'owner': 'quickcd', 'kind': 'GitHubEvent', 'org': ORG, 'repo': REPO, 'status': 'pending'}
+            self.createConfigMap(f'quickcd-{ORG}-{REPO}-{id}', labels, {'event': json.dumps(event)})
+        self.saveCursor(FIRST_EVENT_ID + self.args.events - 1, '"empty"')
+
+    # runs in a thread while quickcd's main loop has the main thread
+    def drive(self):
+        import common, kube
+        try:
+            kube.state.waitSynced(self.args.timeout)
+            self.startCounts = self.counts()
+            self.start = time.time()
+            if self.args.scenario == 'poll':
+                self.publish([{'ref': 'refs/heads/master'}] * self.args.events)
+            elif self.args.scenario == 'charts':
+                self.publish(self.pushCharts())
+            selector = f'kind=GitHubEvent,status=handled,org={ORG},repo={REPO}'
+            while time.time() - self.start < self.args.timeout:
+                if len(kube.state.list(selector)) >= self.args.events:
+                    self.finished = time.time()
+                    break
+                time.sleep(0.05)
+            else:
+                self.error = f'Timed out after {self.args.timeout}s.'
+        except Exception as e:
+            self.error = repr(e)
+        finally:
+            common.interruptEvent.set()
+            common.wake()
+
+    def publish(self, payloads):
+        interval = 1 / self.args.rate if self.args.rate else 0
+        if not interval:
+            return [call('POST', f'{self.githubURL}/_bench/events', {'count': 1, 'payload': p}) for p in payloads]
+        for payload in payloads:
+            call('POST', f'{self.githubURL}/_bench/events', {'count': 1, 'payload': payload})
+            time.sleep(interval)
+
+    def run(self):
+        import main
+        driver = threading.Thread(target=self.drive, name='bench', daemon=True)
+        driver.start()
+        try:
+            main.main()
+        except SystemExit:
+            pass
+        driver.join()
+
+    # calls made so far by kind, setting up doesn't count so these are taken again once quickcd is up
+    def counts(self):
+        import metrics
+        subprocesses, githubRequests = Counter(), Counter()
+        for (command, outcome), counts in list(metrics.shDuration.values.items()):
+            subprocesses[command] += sum(counts[:-1])
+        for (method, status), count in list(metrics.githubRequests.values.items()):
+            githubRequests[method] += count
+        return {
+            'subprocesses': subprocesses,
+            'githubRequests': githubRequests,
+            'fakeGithubRequests': Counter(call('GET', f'{self.githubURL}/_bench/stats')['requests']),
+            'kubeRequests': Counter(call('GET', f'{self.kubeURL}/_bench/stats')['requests']),
+        }
+
+    def report(self):
+        events = self.args.events
+        elapsed = (self.finished or time.time()) - self.start if self.start else 0
+        latencies, durations = [], []
+        if os.path.exists(self.results):
+            with open(self.results) as f:
+                for line in f:
+                    head, created, start, end = line.split()
+                    latencies.append(float(start) - float(created))
+                    durations.append(float(end) - float(start))
+
+        startCounts = self.startCounts or dict((name, Counter()) for name in self.counts())
+        perEvent = lambda counts: dict((key, round(value / events, 3)) for key, value in sorted(counts.items()))
+        return {
+            'scenario': self.args.scenario,
+            'events': events,
+            'handled': len(latencies),
+            'workers': self.args.workers,
+            'error': self.error,
+            'elapsedSeconds': round(elapsed, 3),
+            'eventsPerSecond': round(len(latencies) / elapsed, 3) if elapsed else 0,
+            'dispatchLatencySeconds': percentiles(latencies),
+            'handlerSeconds': percentiles(durations),
+            'perEvent': dict((name, perEvent(counts - startCounts[name])) for name, counts in self.counts().items())
+        }
+
+    def tearDown(self):
+        for process in self.fakes:
+            process.kill()
+            process.wait()
+        if not self.args.keep:
+            shutil.rmtree(self.tmp, ignore_errors=True)
+
+
+def percentiles(values):
+    values = sorted(values)
+    if not values:
+        return {}
+    at = lambda p: round(values[min(len(values) - 1, int(p * len(values)))], 4)
+    return {'p50': at(0.5), 'p90': at(0.9), 'p99': at(0.99), 'max': round(values[-1], 4)}
+
+
+def printReport(report, file):
+    print(
+        f"{report['scenario']}: {report['handled']}/{report['events']} events handled "
+        f"in {report['elapsedSeconds']}s with {report['workers']} workers",
+        file=file)
+    if report['error']:
+        print(f"error: {report['error']}", file=file)
+    print(f"events/s: {report['eventsPerSecond']}", file=file)
+    for name in ('dispatchLatencySeconds', 'handlerSeconds'):
+        print(f'{name}: ' + ' '.join(f'{p} {value}' for p, value in report[name].items()), file=file)
+    print('per event:', file=file)
+    for name, counts in report['perEvent'].items():
+        total = round(sum(counts.values()), 3)
+        print(f'  {name}: {total} (' + ', '.join(f'{key} {value}' for key, value in counts.items()) + ')', file=file)
+
+
+def main():
+    args = parseArgs()
+    out = sys.stdout
+    bench = Bench(args)
+    try:
+        bench.setUp()
+        if not args.verbose:
+            # quickcd, its worker processes and whatever they run print to the log instead
+            out = os.fdopen(os.dup(1), 'w')
+            log = os.open(os.path.join(bench.tmp, 'quickcd.log'), os.O_WRONLY | os.O_CREAT | os.O_APPEND)
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os.dup2(log, 1)
+            os.dup2(log, 2)
+        bench.run()
+        report = bench.report()
+        if args.json:
+            print(json.dumps(report, indent=2), file=out)
+        else:
+            printReport(report, out)
+        if args.keep:
+            print(f'output kept in {bench.tmp}', file=out)
+    finally:
+        bench.tearDown()
+    exit(1 if report['error'] else 0)
+
+
+if __name__ == '__main__':
+    main()
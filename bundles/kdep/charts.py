@@ -1,6 +1,7 @@
-import os, time, traceback, json
+import os, time, traceback, json, threading, hashlib, tempfile, gitcache, kube, db, tracing
 from enum import Enum, auto
-from common import newCommitLogger, env, newLoggingShell, GET
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from common import newCommitLogger, env, newLoggingShell, GET, inCurrentContext, M
 
 DEBUG = env.CD_CHARTS_DEBUG != 'false'
 
@@ -10,6 +11,16 @@ if DEBUG:
     KDEP_FLAGS = '-d'
     HELM_FLAGS = '--debug --dry-run'
 
+# how many charts may be upgraded or rolled back at the same time
+PARALLELISM = int(os.environ.get('CD_CHART_PARALLELISM', '4'))
+# how many integration tests may run at the same time
+TEST_PARALLELISM = int(os.environ.get('CD_TEST_PARALLELISM', '4'))
+# merged values are cached here, best on a persistent volume, an empty string turns the cache off
+VALUES_CACHE_DIR = os.environ.get('CD_VALUES_CACHE_DIR', '/var/cache/quickcd-values')
+VALUES_CACHE_MAX_MB = float(os.environ.get('CD_VALUES_CACHE_MAX_MB', '64'))
+# skip upgrading and testing charts whose rendered manifests are the same as when they were last deployed
+SKIP_UNCHANGED = os.environ.get('CD_SKIP_UNCHANGED_CHARTS', 'true') == 'true'
+
 
 class ChartStatus(Enum):
     READY = auto()
@@ -36,38 +47,53 @@ class DeployableDiff:
         self.log = log
         self.outputURL = self.log.commentHTMLURL
 
+    @tracing.traced('charts.initializeCharts')
     def initializeCharts(self):
-        allReleases = set(self.sh('helm ls --short --all').split('\n'))
+        releases = ReleaseSnapshot(self.sh)
         changedFiles = self.sh(f'git diff --name-only {self.base}..{self.merge}')
         changedDirs = set(file.split('/')[0] for file in changedFiles.split('\n') if '/' in file)
+        # path -> blob hash of every file in the checkout, from '<mode> <hash> <stage>\t<path>' lines
+        blobs = dict((line.split('\t', 1)[1], line.split()[1])
+                     for line in self.sh('git ls-files -s', skipLog=True).split('\n') if '\t' in line)
+        hits, misses = valuesCache.hits, valuesCache.misses
         self.charts = [
-            Chart(dir, allReleases, self.sh, self.log) for dir in changedDirs if os.path.isfile(dir + '/Chart.yaml')
+            Chart(dir, releases, self.sh, self.log, blobs) for dir in changedDirs
+            if os.path.isfile(dir + '/Chart.yaml')
         ]
+        self.log(f'Values cache: {valuesCache.hits - hits} hits, {valuesCache.misses - misses} misses.')
+        checkDependencies(self.charts)  # a cycle would deadlock deploy, better to find out before touching the cluster
 
     @classmethod
+    @tracing.traced('charts.createFromMerge')
     def createFromMerge(cls, e):
         log = newCommitLogger(e['head'])
         sh = newLoggingShell(log)
         log('Event', json.dumps(e, ensure_ascii=False, allow_nan=False, indent=2, sort_keys=True))
 
-        sh(f'git clone {env.CD_REPO_URL} .')
+        gitcache.clone(sh, commits=[e['head']])
         sh(f'git checkout {e["head"]}')
 
         return cls(e['before'], e['head'], e['head'], sh, log)
 
     @classmethod
+    @tracing.traced('charts.createFromPR')
     def createFromPR(cls, e):
         log = newCommitLogger(e['head']['sha'])
         sh = newLoggingShell(log)
         log('Event', json.dumps(e, ensure_ascii=False, allow_nan=False, indent=2, sort_keys=True))
         commits = [c['commit'] for c in GET(e['commits_url'])]
 
-        sh(f'git clone -b {e["base"]["ref"]} {env.CD_REPO_URL} .')
+        gitcache.clone(sh, branch=e['base']['ref'], commits=[e['base']['sha'], e['head']['sha']])
 
         if e["head"]["sha"] == sh(f'git merge-base HEAD {e["head"]["sha"]}'):
             log("Looks like this commit has already been merged.")
             return False
 
+        # GitHub has usually made the merge for us already, this also covers PRs from forks
+        mergeHash = gitcache.checkoutPullMerge(sh, e['number'], e['head']['sha'])
+        if mergeHash:
+            return cls(e['base']['sha'], e['head']['sha'], mergeHash, sh, log)
+
         try:
             if e['head']['repo']['fork']:
                 sh(f'git pull --no-edit --no-ff {e["head"]["repo"]["ssh_url"]} {e["head"]["ref"]}')
@@ -79,63 +105,127 @@ class DeployableDiff:
             mergeHash = sh('git rev-parse HEAD')
             return cls(e['base']['sha'], e['head']['sha'], mergeHash, sh, log)
 
+    @tracing.traced('charts.deploy')
     def deploy(self):
         self.log(f'Chart deployment commencing.')
         for chart in self.charts:
-            if chart.enabled:
-                if not chart.upgrade():
-                    return False
-            else:
+            if not chart.enabled:
                 self.log(f'Continuous deployment for chart {chart.name} not enabled, skipping.')
+            elif chart.unchanged:
+                self.log(f'Rendered manifests of chart {chart.name} are unchanged since revision ' +
+                         f'{chart.lastRevision} was deployed, skipping it and its tests.')
+        # independent charts are upgraded side by side, after the first failure nothing new is started
+        if not runInDependencyOrder(self.chartsToDeploy(), Chart.upgrade, failFast=True):
+            return False
         self.log(f'Chart deployment complete.')
         return True
 
+    def chartsToDeploy(self):
+        return [chart for chart in self.charts if chart.enabled and not chart.unchanged]
+
+    @tracing.traced('charts.runTests')
     def runTests(self):
         self.log(f'Tests commencing.')
-        for chartName in set(sum((chart.tests for chart in self.charts if chart.enabled), [])):
-            squad = chartName.split('-')[0]
-            self.log(f'Launching integration test: {chartName}')
-            releaseName = chartName + time.strftime('-%m-%d-%y--%H-%M-%S')
-            self.sh(
-                f'kdep -i {KDEP_FLAGS} -t {releaseName} ./{chartName}/{env.CD_REGION_UNDASHED}-{env.CD_ENVIRONMENT}-values.yaml'
-            )
-
-            if not DEBUG:
-                self.log('Job running... 0m')
-                for i in range(60 * 60):
-                    if i % 10:
-                        time.sleep(1)
-                    else:
-                        self.log(f'Job running... {i//60}m', replaceLast=True)
-                        job = json.loads(self.sh(f'kubectl get job -n {squad} {releaseName} -ojson', skipLog=True))
-                        if 'active' not in job['status']:
-                            ok = 'succeeded' in job['status']
-                            self.log(f"{releaseName} {'succeeded' if ok else 'failed'}!")
-                            self.sh(f'kubectl logs -ljob-name={releaseName} -n {squad}')
-                            if ok:
-                                break
-                            else:
-                                return False
-                else:
-                    self.log(f'Test {chartName} timed out...')
-                    return False
+        tests = sorted(set(sum((chart.tests for chart in self.chartsToDeploy()), [])))
+        self.testsCancelled = threading.Event()
+        self.testJobs = {}  # release name -> namespace, for the tests currently running
+        with ThreadPoolExecutor(TEST_PARALLELISM) as pool:
+            results = [pool.submit(inCurrentContext(self.runTest), chartName) for chartName in tests]
+            if not all([result.result() for result in results]):
+                return False
         self.log(f'Tests complete.')
+        self.recordDeployed()
         return True
 
+    # once the upgrades have passed their tests, future commits that render the same manifests can skip them
+    def recordDeployed(self):
+        if DEBUG:
+            return
+        with db.batch():
+            for chart in self.chartsToDeploy():
+                release = chart.releases.get(chart.name)
+                upgraded = chart.status == ChartStatus.UPGRADED and release and release['status'] == 'DEPLOYED'
+                if chart.digest and upgraded:
+                    db.put(f'deployed-digest/{chart.name}', {
+                        'digest': chart.digest,
+                        'revision': str(release['revision'])
+                    })
+
+    # called on the first test failure, deleting the Jobs of running tests stops them and wakes up their watches
+    def cancelTests(self):
+        self.testsCancelled.set()
+        for releaseName, squad in list(self.testJobs.items()):
+            try:
+                deleteJob(releaseName, squad)
+            except kube.KubeError:
+                print(traceback.format_exc())  # its watch still sees the tests are cancelled, just not as soon
+
+    # runs a single integration test, returns True if it passed
+    # any failure, including one to launch or watch the test, cancels the rest
+    @tracing.traced('charts.runTest')
+    def runTest(self, chartName):
+        tracing.annotate(chart=chartName)
+        try:
+            if self.launchTest(chartName):
+                return True
+        except Exception:
+            self.log(f'Error running test {chartName}', traceback.format_exc())
+        self.cancelTests()
+        return False
+
+    # launches the test and waits for its Job, returns True if it passed
+    def launchTest(self, chartName):
+        if self.testsCancelled.is_set():
+            return False
+        squad = chartName.split('-')[0]
+        self.log(f'Launching integration test: {chartName}')
+        releaseName = chartName + time.strftime('-%m-%d-%y--%H-%M-%S')
+        self.sh(
+            f'kdep -i {KDEP_FLAGS} -t {releaseName} ./{chartName}/{env.CD_REGION_UNDASHED}-{env.CD_ENVIRONMENT}-values.yaml'
+        )
+        if DEBUG:
+            return True
+
+        self.testJobs[releaseName] = squad
+        try:
+            result = kube.waitForJob(releaseName, squad, 60 * M, self.testsCancelled)
+        finally:
+            self.testJobs.pop(releaseName, None)
+
+        if result != 'succeeded' and self.testsCancelled.is_set():
+            self.log(f'Test {chartName} cancelled since another test failed.')
+            deleteJob(releaseName, squad)  # in case it was launched just as the tests were cancelled
+            return False
+        if result is None:
+            self.log(f'Test {chartName} timed out...')
+        else:
+            self.log(f'{releaseName} {result}!')
+            if result != 'deleted':
+                self.sh(f'kubectl logs -ljob-name={releaseName} -n {squad}', stream=True, spill=True, attempts=3)
+        return result == 'succeeded'
+
+    @tracing.traced('charts.rollback')
     def rollback(self):
         self.log('Starting rollbacks ...')
 
-        lastException = None
-        for chart in self.charts:
-            if chart.enabled and chart.status in (ChartStatus.UPGRADED, ChartStatus.UPGRADEFAILED):
-                try:
-                    chart.rollback()
-                except Exception as e:
-                    lastException = e
+        exceptions = []
+
+        # every chart is rolled back even if some fail, dependents go before the charts they depend on
+        def rollback(chart):
+            try:
+                chart.rollback()
+            except Exception as e:
+                exceptions.append(e)
+            return True
 
-        if lastException:
+        runInDependencyOrder([
+            chart for chart in self.charts
+            if chart.enabled and chart.status in (ChartStatus.UPGRADED, ChartStatus.UPGRADEFAILED)
+        ], rollback, reverse=True)
+
+        if exceptions:
             self.log('Rollback failed, chart summary:', self.chartStatusSummary())
-            raise lastException
+            raise exceptions[-1]
         else:
             self.log('Rollback complete, chart summary:', self.chartStatusSummary())
 
@@ -148,30 +238,267 @@ class DeployableDiff:
         ])
 
 
+class ReleaseSnapshot:
+    '''
+    Status and revisions of every helm release, loaded with a single list of the ConfigMaps Tiller keeps them in.
+    One snapshot is shared by all the charts of a DeployableDiff and is reloaded only after one of them
+    is upgraded or rolled back. If Tiller's ConfigMaps can't be read, helm is asked instead.
+    Listing them needs `list` on ConfigMaps in TILLER_NAMESPACE, see the README.
+    '''
+    tillerReadable = True  # False once the api refused us, from then on helm is asked straight away
+
+    def __init__(self, sh):
+        self.sh = sh
+        self.lock = threading.Lock()
+        self.releases = None  # name -> {'status', 'revision', 'lastDeployed'}
+
+    def get(self, name):
+        with self.lock:
+            if self.releases is None:
+                self.releases = self.load()
+            return self.releases.get(name)
+
+    def invalidate(self):
+        with self.lock:
+            self.releases = None
+
+    @tracing.traced('charts.ReleaseSnapshot.load')
+    def load(self):
+        if not ReleaseSnapshot.tillerReadable:
+            return self.loadFromHelm()
+        try:
+            items = kube.listConfigMapsMetadata('OWNER=TILLER', os.environ.get('TILLER_NAMESPACE', 'kube-system'))
+        except kube.KubeError as e:
+            if e.status in (403, 404):
+                print(f"Can't list Tiller's ConfigMaps ({e.status}), asking helm for the releases from now on.")
+                ReleaseSnapshot.tillerReadable = False
+            else:
+                print(traceback.format_exc())
+            return self.loadFromHelm()
+        if not items['items']:
+            return self.loadFromHelm()  # Tiller may be keeping releases in Secrets instead
+
+        releases = {}
+        for item in items['items']:
+            labels = item['metadata'].get('labels') or {}
+            release = releases.setdefault(labels['NAME'], {'status': None, 'revision': 0, 'lastDeployed': None})
+            revision = int(labels['VERSION'])
+            if revision > release['revision']:
+                release.update(status=labels['STATUS'], revision=revision)
+            if labels['STATUS'] == 'DEPLOYED':
+                release['lastDeployed'] = max(revision, release['lastDeployed'] or 0)
+        return releases
+
+    # helm ls only has the latest revision, so releases whose latest revision isn't deployed need their history
+    def loadFromHelm(self):
+        releases = {}
+        for release in (json.loads(self.sh('helm ls --all --output json') or '{}').get('Releases') or []):
+            deployed = release['Status'] == 'DEPLOYED'
+            releases[release['Name']] = {
+                'status': release['Status'],
+                'revision': release['Revision'],
+                'lastDeployed': release['Revision'] if deployed else self.lastDeployedFromHistory(release['Name'])
+            }
+        return releases
+
+    def lastDeployedFromHistory(self, name):
+        chartsByCols = [chart.split('\t') for chart in self.sh(f'helm history {name}').split('\n')]
+        deployedCharts = [chart for chart in chartsByCols if len(chart) == 5 and 'DEPLOYED' in chart[2]]
+        return max(int(chart[0]) for chart in deployedCharts) if deployedCharts else None
+
+
+class ValuesCache:
+    '''
+    Merged chart values on local disk, keyed on the git blob hashes of all the values files in the chart,
+    so that kdep-merge-inherited-values only has to run again when one of them changed.
+    The least recently used entries are evicted once the cache is bigger than maxBytes.
+    '''
+
+    def __init__(self, directory, maxBytes):
+        self.directory = directory
+        self.maxBytes = maxBytes
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    # values files can inherit from ones in the same or a parent directory, so all of those are part of the key
+    # None if the values file isn't in git, then there's nothing reliable to key on
+    def key(self, valuesFile, blobs):
+        valuesFile = os.path.normpath(valuesFile)
+        if valuesFile not in blobs:
+            return None
+        dirs = set([''])
+        dir = os.path.dirname(valuesFile)
+        while dir:
+            dirs.add(dir)
+            dir = os.path.dirname(dir)
+        inputs = sorted((path, blob) for path, blob in blobs.items()
+                        if os.path.dirname(path) in dirs and path.endswith(('values.yaml', 'values.yml')))
+        return hashlib.sha1(json.dumps([valuesFile, inputs]).encode()).hexdigest()
+
+    # returns merge(valuesFile), from the cache if possible
+    def get(self, valuesFile, blobs, merge):
+        key = self.key(valuesFile, blobs) if self.directory else None
+        if key is None:
+            return merge(valuesFile)
+
+        path = os.path.join(self.directory, key + '.json')
+        try:
+            with open(path) as f:
+                values = json.load(f)
+            os.utime(path)  # mtime is the last use, for eviction
+            with self.lock:
+                self.hits += 1
+            return values
+        except (OSError, ValueError):
+            pass
+
+        values = merge(valuesFile)
+        with self.lock:
+            self.misses += 1
+        os.makedirs(self.directory, exist_ok=True)
+        tmpPath = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'  # other processes may be writing it as well
+        with open(tmpPath, 'w') as f:
+            json.dump(values, f)
+        os.replace(tmpPath, path)
+        self.evict()
+        return values
+
+    def evict(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            try:
+                stat = os.stat(os.path.join(self.directory, name))
+                entries.append((stat.st_mtime, stat.st_size, name))
+            except OSError:
+                pass  # evicted by someone else in the meantime
+        size = sum(entry[1] for entry in entries)
+        for mtime, entrySize, name in sorted(entries):
+            if size <= self.maxBytes:
+                break
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                pass
+            size -= entrySize
+
+
+valuesCache = ValuesCache(VALUES_CACHE_DIR, VALUES_CACHE_MAX_MB * 1024 * 1024)
+
+
+def deleteJob(name, namespace):
+    try:
+        kube.deleteJob(name, namespace)
+    except kube.KubeError as e:
+        if not kube.isNotFound(e):
+            raise
+
+
+# charts in the given list that each chart has to wait for, dependencies on charts not in the list are already deployed
+def dependencyGraph(charts, reverse=False):
+    names = set(chart.name for chart in charts)
+    graph = dict((chart.name, set(chart.dependsOn) & names) for chart in charts)
+    if reverse:
+        graph = dict((name, set(other for other, deps in graph.items() if name in deps)) for name in graph)
+    return graph
+
+
+def checkDependencies(charts):
+    graph = dependencyGraph([chart for chart in charts if chart.enabled])
+    done = set()
+    while len(done) < len(graph):
+        ready = [name for name, deps in graph.items() if name not in done and deps <= done]
+        if not ready:
+            raise Exception('Charts have circular dependencies: ' + ', '.join(sorted(set(graph) - done)))
+        done.update(ready)
+
+
+# calls fn(chart) for each chart, at most PARALLELISM at a time and each only once all it depends on are done
+# with reverse a chart waits for the charts that depend on it instead, returns False if fn returned False for any
+def runInDependencyOrder(charts, fn, failFast=False, reverse=False):
+    graph = dependencyGraph(charts, reverse)
+    fn = inCurrentContext(fn)
+    started = set()
+    done = set()
+    running = {}  # future -> chart
+    ok = True
+    with ThreadPoolExecutor(PARALLELISM) as pool:
+        while True:
+            for chart in charts:
+                ready = chart.name not in started and graph[chart.name] <= done
+                if ready and len(running) < PARALLELISM and (ok or not failFast):
+                    started.add(chart.name)
+                    running[pool.submit(fn, chart)] = chart
+            if not running:
+                break
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                done.add(running.pop(future).name)
+                ok = future.result() and ok
+    return ok
+
+
 class Chart:
-    def __init__(self, name, allReleases, sh, log):
+    def __init__(self, name, releases, sh, log, blobs={}):
         self.name = name
+        self.releases = releases
         self.sh = sh
         self.log = log
         self.lastRevision = None
         self.enabled = False
         self.tests = []
+        self.dependsOn = []  # names of charts that have to be upgraded before this one
+        self.digest = None
+        self.unchanged = False  # renders the same as what's deployed, so there's nothing to upgrade
+        self.statusLock = threading.Lock()
         self.status = ChartStatus.READY
 
         self.log(f'Examining changed chart: {self.name}')
-        values = json.loads(
-            self.sh(f'kdep-merge-inherited-values ./{name}/{env.CD_REGION_UNDASHED}-{env.CD_ENVIRONMENT}-values.yaml'))
+        values = valuesCache.get(f'./{name}/{env.CD_REGION_UNDASHED}-{env.CD_ENVIRONMENT}-values.yaml', blobs,
+                                 lambda valuesFile: json.loads(self.sh(f'kdep-merge-inherited-values {valuesFile}')))
         if 'continuousDeployment' in values:
             self.enabled = values['continuousDeployment'].get('enabled') or False  # may be set to null in yaml
             self.tests = list((values['continuousDeployment'].get('integrationTests') or {}).keys())
-
-        if self.name in allReleases:
-            chartsByCols = [chart.split('\t') for chart in self.sh(f'helm history {self.name}').split('\n')]
-            deployedCharts = [chart for chart in chartsByCols if len(chart) == 5 and 'DEPLOYED' in chart[2]]
-            if deployedCharts:
-                self.lastRevision = max(int(chart[0]) for chart in deployedCharts)
-
+            self.dependsOn = list(values['continuousDeployment'].get('dependsOn') or [])
+
+        release = releases.get(self.name)
+        if release:
+            self.lastRevision = release['lastDeployed']
+
+        if self.enabled and SKIP_UNCHANGED:
+            self.digest = self.renderDigest(values)
+            deployed = db.get(f'deployed-digest/{self.name}')
+            # the revision check catches anything done to the release since, like a rollback or a manual upgrade
+            self.unchanged = bool(self.digest and deployed and release and release['status'] == 'DEPLOYED'
+                                  and deployed == {'digest': self.digest, 'revision': str(release['revision'])})
+
+    # digest of the merged values and everything the chart renders to with them, None if it can't be rendered
+    def renderDigest(self, values):
+        with tempfile.NamedTemporaryFile('w', suffix='.json') as valuesFile:
+            json.dump(values, valuesFile)
+            valuesFile.flush()
+            try:
+                rendered = self.sh(f'helm template ./{self.name} --name {self.name} --values {valuesFile.name}',
+                                   skipLog=True)
+            except Exception:
+                self.log(f"Couldn't render {self.name}, it will be upgraded regardless.", traceback.format_exc())
+                return None
+        return hashlib.sha256(json.dumps([values, rendered], sort_keys=True).encode()).hexdigest()
+
+    # upgrades and rollbacks of different charts run in different threads
+    @property
+    def status(self):
+        with self.statusLock:
+            return self._status
+
+    @status.setter
+    def status(self, status):
+        with self.statusLock:
+            self._status = status
+
+    @tracing.traced('charts.Chart.upgrade')
     def upgrade(self):
+        tracing.annotate(chart=self.name)
         if not self.enabled:
             raise Exception(f"Tried to ugrade {self.name} which is not enabled for auto deployment.")
 
@@ -179,7 +506,13 @@ class Chart:
 
         try:
             self.status = ChartStatus.UPGRADING
-            self.sh(f"kdep -i {KDEP_FLAGS} ./{self.name}/{env.CD_REGION_UNDASHED}-{env.CD_ENVIRONMENT}-values.yaml")
+            try:
+                self.sh(
+                    f"kdep -i {KDEP_FLAGS} ./{self.name}/{env.CD_REGION_UNDASHED}-{env.CD_ENVIRONMENT}-values.yaml",
+                    stream=True,
+                    spill=True)
+            finally:
+                self.releases.invalidate()
         except:
             self.status = ChartStatus.UPGRADEFAILED
             self.log(f'Error deploying chart {self.name}', traceback.format_exc())
@@ -187,7 +520,9 @@ class Chart:
             self.status = ChartStatus.UPGRADED
         return self.status == ChartStatus.UPGRADED
 
+    @tracing.traced('charts.Chart.rollback')
     def rollback(self):
+        tracing.annotate(chart=self.name)
         if self.status not in (ChartStatus.UPGRADED, ChartStatus.UPGRADEFAILED):
             raise Exception(f"Tried to roll back {self.name} which had status {self.status.name}.")
 
@@ -195,7 +530,10 @@ class Chart:
 
         if self.lastRevision is not None:
             self.status = ChartStatus.ROLLINGBACK
-            self.sh(f'helm rollback {HELM_FLAGS} --force {self.name} {self.lastRevision}')
+            try:
+                self.sh(f'helm rollback {HELM_FLAGS} --force {self.name} {self.lastRevision}', stream=True)
+            finally:
+                self.releases.invalidate()
             self.status = ChartStatus.ROLLEDBACK
         else:
             self.status = ChartStatus.CANTROLLBACK
@@ -1,22 +1,65 @@
-import subprocess, os, signal, urllib3, certifi, json, re, traceback, threading, time
+import subprocess, os, signal, urllib3, certifi, json, re, traceback, threading, time, tempfile, shutil, atexit, hashlib
+import uuid, asyncio, sys, multiprocessing
+from contextlib import contextmanager
+from ratelimit import rateBudget
+import metrics, tracing
+from retries import RetryException, CircuitBreaker, retryWithBackoff
+
+
+# env vars that depend on which repository we're working on
+def repoVars(org, repo):
+    # GitHub Enterprise's api is under /api/v3, set CD_GITHUB_API_URL for anything else, e.g. https://api.github.com
+    apiURL = os.environ.get('CD_GITHUB_API_URL') or 'https://%s/api/v3' % os.environ['CD_GITHUB_DOMAIN']
+    return {
+        'CD_GITHUB_ORG_NAME': org,
+        'CD_GITHUB_REPO_NAME': repo,
+        'CD_REPO_API_URL': '%s/repos/%s/%s' % (apiURL, org, repo),
+        'CD_REPO_URL': 'https://%s/%s/%s' % (os.environ['CD_GITHUB_DOMAIN'], org, repo),
+    }
+
+
+# per thread overrides of env, used to work on one of several repositories
+repoOverrides = threading.local()
 
 
 class Env:
     def __init__(self):
         # computed env vars
         self.CD_CLUSTER_ID = f"{os.environ['CD_ENVIRONMENT']}/{os.environ['CD_REGION_DASHED']}/{os.environ['CD_CLUSTER_NAME']}"
-        self.CD_REPO_API_URL = 'https://%s/api/v3/repos/%s/%s' % (
-            os.environ['CD_GITHUB_DOMAIN'], os.environ['CD_GITHUB_ORG_NAME'], os.environ['CD_GITHUB_REPO_NAME'])
-        self.CD_REPO_URL = 'https://%s/%s/%s' % (os.environ['CD_GITHUB_DOMAIN'], os.environ['CD_GITHUB_ORG_NAME'],
-                                                 os.environ['CD_GITHUB_REPO_NAME'])
+        # when watching several repositories (CD_GITHUB_REPOS) these are set per repo instead
+        if 'CD_GITHUB_ORG_NAME' in os.environ and 'CD_GITHUB_REPO_NAME' in os.environ:
+            for key, value in repoVars(os.environ['CD_GITHUB_ORG_NAME'], os.environ['CD_GITHUB_REPO_NAME']).items():
+                setattr(self, key, value)
         self.CD_DEBUG = os.environ.get('CD_DEBUG', 'false')
         self.CD_LOCAL_MODE = os.environ.get('CD_LOCAL_MODE', 'false')
         self.CD_NAMESPACE = os.environ.get('CD_NAMESPACE') or 'default'
+        self.CD_WORKERS = os.environ.get('CD_WORKERS', '4')  # processes for nonblocking handlers, 0 runs them inline
+        self.CD_DRAIN_TIMEOUT = os.environ.get('CD_DRAIN_TIMEOUT', '600')  # max seconds a shutdown waits for workers
+        self.CD_WORKSPACE_ROOT = os.environ.get('CD_WORKSPACE_ROOT', '/tmp/quickcd')
+        self.CD_LOG_FLUSH_INTERVAL = os.environ.get('CD_LOG_FLUSH_INTERVAL', '3')  # min seconds between comment PATCHes
+        self.CD_LOG_SEGMENT_SIZE = os.environ.get('CD_LOG_SEGMENT_SIZE', '60000')  # GitHub's limit is 65536 chars
+        self.CD_LOG_MAX_OUTPUT = os.environ.get('CD_LOG_MAX_OUTPUT', '10000')  # longer output goes to an artifact
+        self.CD_STREAM_BUFFER_SIZE = os.environ.get('CD_STREAM_BUFFER_SIZE', '1048576')  # bytes kept per stream
+        self.CD_ARTIFACT_DIR = os.environ.get('CD_ARTIFACT_DIR', '/var/tmp/quickcd-artifacts')
+        self.CD_ARTIFACT_URL = os.environ.get('CD_ARTIFACT_URL', '')  # where CD_ARTIFACT_DIR is served, if anywhere
+        self.CD_ARTIFACT_RETENTION_DAYS = os.environ.get('CD_ARTIFACT_RETENTION_DAYS', '7')
+        self.CD_HTTP_PORT = os.environ.get('CD_HTTP_PORT', '8080')  # for the webhook and metrics endpoints, if enabled
+        self.CD_METRICS = os.environ.get('CD_METRICS', 'false')  # true serves /metrics on CD_HTTP_PORT
+        self.CD_TRACE_SAMPLE_RATE = os.environ.get('CD_TRACE_SAMPLE_RATE', '0')  # fraction of handler runs traced
+        self.CD_EVENT_PAGE_PARALLELISM = os.environ.get('CD_EVENT_PAGE_PARALLELISM', '4')  # events pages at once
+        self.CD_EVENT_RETENTION_DAYS = os.environ.get('CD_EVENT_RETENTION_DAYS', '7')  # 0 keeps handled events
+        self.CD_EVENT_ARCHIVE = os.environ.get('CD_EVENT_ARCHIVE', 'full')  # or audit, to keep only handler runs
+        self.CD_COMPACT_RATE = os.environ.get('CD_COMPACT_RATE', '2')  # api calls per second while archiving
+        self.CD_COMPACT_INTERVAL = os.environ.get('CD_COMPACT_INTERVAL', '3600')
+        self.CD_GIT_CACHE_DIR = os.environ.get('CD_GIT_CACHE_DIR', '/var/cache/quickcd-git')  # '' disables the mirror
         if 'CD_REGION_DASHED' in os.environ:
             self.CD_REGION_UNDASHED = os.environ['CD_REGION_DASHED'].replace('-', '')
 
     # this method only called in absense of instance attribute
     def __getattr__(self, attr):
+        overrides = getattr(repoOverrides, 'vars', None)
+        if overrides and attr in overrides:
+            return overrides[attr]
         try:
             return os.environ[attr]
         except:
@@ -31,9 +74,47 @@ class Env:
 
 env = Env()
 
-# default retries are set to 3 times but only for connection errors, maybe we should add things like 500?
-http = urllib3.PoolManager(
+
+# the repositories to watch, as (org, repo) tuples
+# CD_GITHUB_REPOS is a comma separated list of org/repo, otherwise it's the one repo in CD_GITHUB_ORG_NAME/REPO_NAME
+def getRepos():
+    if 'CD_GITHUB_REPOS' in os.environ:
+        return [tuple(repo.strip().split('/')) for repo in os.environ['CD_GITHUB_REPOS'].split(',') if repo.strip()]
+    return [(os.environ['CD_GITHUB_ORG_NAME'], os.environ['CD_GITHUB_REPO_NAME'])]
+
+
+# within this block env (and everything built on it) refers to the given repository, for the current thread only
+@contextmanager
+def repoContext(repo):
+    previous = getattr(repoOverrides, 'vars', None)
+    repoOverrides.vars = repoVars(*repo)
+    try:
+        yield
+    finally:
+        repoOverrides.vars = previous
+
+
+def currentRepo():
+    return (env.CD_GITHUB_ORG_NAME, env.CD_GITHUB_REPO_NAME)
+
+# keeps the shared rate limit budget up to date from every response we get from GitHub
+class GitHubPoolManager(urllib3.PoolManager):
+    def urlopen(self, method, *args, **kwargs):
+        try:
+            resp = super().urlopen(method, *args, **kwargs)
+        except Exception:
+            metrics.githubRequests.inc(method=method, status='error')
+            raise
+        metrics.githubRequests.inc(method=method, status=resp.status)
+        rateBudget.record(resp.headers)
+        return resp
+
+
+# default retries are set to 3 times but only for connection errors, request below retries errors from GitHub
+# connections kept per host, enough for fetching events pages in parallel
+http = GitHubPoolManager(
     timeout=10,
+    maxsize=int(env.CD_EVENT_PAGE_PARALLELISM),
     cert_reqs='CERT_REQUIRED',
     ca_certs=certifi.where(),
     headers={'Authorization': f'token {env.CD_GITHUB_TOKEN}'})
@@ -58,10 +139,9 @@ class ExecutionError(Exception):
 
 
 # todo: add graceful shutdown via SIGTERM first
-# basic command execution function
+# basic command execution function, fine to call from several threads at once
 # input should ideally be bytes, and is converted to bytes if not already
 def exec(cmd, timeout, input=b''):
-    # not threadsafe, surround with lock if switch to multithread model
     p = subprocess.Popen(
         cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True, start_new_session=True)
 
@@ -78,15 +158,111 @@ def exec(cmd, timeout, input=b''):
     return p.returncode, out, err
 
 
+# keeps only the last size bytes written to it
+class RingBuffer:
+    def __init__(self, size):
+        self.size = size
+        self.data = bytearray()
+        self.dropped = 0
+        self.lock = threading.Lock()
+
+    def write(self, chunk):
+        with self.lock:
+            self.data += chunk
+            if len(self.data) > self.size:
+                self.dropped += len(self.data) - self.size
+                del self.data[:-self.size]
+
+    def getvalue(self):
+        with self.lock:
+            return (f'[... {self.dropped} bytes omitted ...]\n'.encode() if self.dropped else b'') + bytes(self.data)
+
+
+# like exec but output is read as it's produced and only the last bufferSize bytes of stdout and stderr are kept
+# every interval seconds while the command runs onOutput(out, err) is called with what's been kept so far,
+# by default as often as the log is sent to GitHub
+# the complete output, stdout and stderr interleaved, is also written to spillPath if given
+def execStreaming(cmd, timeout, input=b'', bufferSize=None, onOutput=None, interval=None, spillPath=None):
+    p = subprocess.Popen(
+        cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True, start_new_session=True)
+
+    input = input.encode() if input and not isinstance(input, bytes) else (input or b'')
+    bufferSize = bufferSize or int(env.CD_STREAM_BUFFER_SIZE)
+    interval = interval or float(env.CD_LOG_FLUSH_INTERVAL)
+    out, err = RingBuffer(bufferSize), RingBuffer(bufferSize)
+    spill = open(spillPath, 'wb') if spillPath else None
+    spillLock = threading.Lock()
+
+    def feed():
+        try:
+            p.stdin.write(input)
+            p.stdin.close()
+        except BrokenPipeError:
+            pass  # the command doesn't want it all, same as with communicate
+
+    def pump(pipe, buffer):
+        for chunk in iter(lambda: pipe.read1(64 * 1024), b''):
+            buffer.write(chunk)
+            if spill:
+                with spillLock:
+                    spill.write(chunk)
+
+    threads = [threading.Thread(target=feed, daemon=True)] + [
+        threading.Thread(target=pump, args=args, daemon=True) for args in ((p.stdout, out), (p.stderr, err))
+    ]
+    for thread in threads:
+        thread.start()
+
+    deadline = time.time() + timeout - 2
+    try:
+        while True:
+            try:
+                p.wait(timeout=max(0, min(interval, deadline - time.time())))
+                break
+            except subprocess.TimeoutExpired:
+                if time.time() < deadline:
+                    if onOutput:
+                        onOutput(out.getvalue().decode(errors='replace'), err.getvalue().decode(errors='replace'))
+                    continue
+                print(f"WARNING: Killing cmd: {cmd}")
+                os.killpg(os.getpgid(p.pid), signal.SIGKILL)
+                try:
+                    p.wait(timeout=2)
+                except subprocess.TimeoutExpired:
+                    return 255, "", "Very strange, failed to kill.."
+                break
+        for thread in threads:
+            thread.join(max(0, deadline - time.time()) + 2)  # whatever is left in the pipes
+    finally:
+        if spill:
+            with spillLock:
+                spill.close()
+    return p.returncode, out.getvalue(), err.getvalue()
+
+
 # a convenience wrapper on top of exec that returns string output and has a default timeout
-def sh(cmd, timeout=5 * M, input=b''):
+# with stream=True memory use is bounded and onOutput and spillPath can be used, see execStreaming
+# attempts > 1 retries a failing command with backoff, for flaky things like kubectl against a busy api server
+def sh(cmd, timeout=5 * M, input=b'', stream=False, onOutput=None, spillPath=None, attempts=1):
+    if attempts > 1:
+        return retryWithBackoff(attempts, exceptions=(ExecutionError, ))(sh)(cmd, timeout, input, stream, onOutput,
+                                                                            spillPath)
     if env.CD_DEBUG == 'true':
         print(cmd)
         if input:
             print(input)
-    ret, out, err = exec(cmd, timeout, input)
+    stream = stream or onOutput or spillPath
+    with metrics.shDuration.time(command=metrics.commandName(cmd), outcome='failure') as labels, tracing.span(
+            cmd[:200], 'sh'):
+        if stream:
+            ret, out, err = execStreaming(cmd, timeout, input, onOutput=onOutput, spillPath=spillPath)
+        else:
+            ret, out, err = exec(cmd, timeout, input)
+        tracing.annotate(returncode=ret)
+        if not ret:
+            labels['outcome'] = 'success'
     if not ret:
-        out = out.decode().strip()
+        out = out.decode(errors='replace' if stream else 'strict').strip()  # the ring buffer may cut a character
         if env.CD_DEBUG == 'true' and out:
             print(out)
         return out
@@ -103,39 +279,302 @@ def newPRLogger(prNumber):
     return newGithubLogger(f'{env.CD_REPO_API_URL}/issues/{prNumber}/comments')
 
 
+# the log is split over several comments when it gets too long for one, only the last one is updated
 def newGithubLogger(newCommentURL):
-    content = [f'## {env.CD_CLUSTER_ID}: {currentHandlerFnName}\n']
+    heading = f'## {env.CD_CLUSTER_ID}: {getCurrentHandlerFnName()}'
+    first = CommentSegment(newCommentURL, f'{heading}\n')
+    segments = [first]
     if env.CD_LOCAL_MODE == 'false':
-        comment = POST(newCommentURL, {'body': '\n'.join(content)})
-        commentAPIURL = comment['url']
-        commentHTMLURL = comment['html_url']
+        first.send()  # done right away so the comment url is available to link to
+        commentAPIURL = first.apiURL
+        commentHTMLURL = first.htmlURL
     else:
         commentAPIURL = "RunningInLocalMode"
         commentHTMLURL = "RunningInLocalMode"
 
+    lock = threading.Lock()  # handlers may log from several threads
+
     def log(title, body='', isCmd=False, replaceLast=False):
-        section = wrapCommentSection(title, body, isCmd=isCmd) if body or isCmd else f'{title}'
-        if replaceLast:
-            content[-1] = section
+        with tracing.span('log ' + title[:100], 'log'), lock:
+            logLocked(title, body, isCmd, replaceLast)
+
+    # output that's too long is cut down to its tail, the full version goes to an artifact unless footer links to it
+    def formatSection(title, body, isCmd, footer=''):
+        if len(body) > int(env.CD_LOG_MAX_OUTPUT):
+            if not footer:
+                link = saveArtifact(body)
+                footer = f'Full output: {link}' if link else ''
+            body = f'[... {len(body) - int(env.CD_LOG_MAX_OUTPUT)} characters omitted ...]\n' + body[
+                -int(env.CD_LOG_MAX_OUTPUT):]
+        return wrapCommentSection(title, body, isCmd=isCmd, footer=footer) if body or isCmd else f'{title}'
+
+    # reserve is room to leave in the comment for the section to grow into
+    def logLocked(title, body, isCmd, replaceLast, reserve=0):
+        section = formatSection(title, body, isCmd)
+
+        segment = segments[-1]
+        if replaceLast and segment.hasSections():
+            segment.replaceLast(section)
         else:
-            content.append(section)
+            if segment.size + len(section) + reserve > int(env.CD_LOG_SEGMENT_SIZE) and segment.hasSections():
+                segment = CommentSegment(
+                    newCommentURL, f'{heading} (part {len(segments) + 1}, continued from {commentHTMLURL})\n',
+                    previous=segments[-1])
+                segments.append(segment)
+            segment.append(section)
 
         if env.CD_LOCAL_MODE == 'false':
-            PATCH(commentAPIURL, {'body': '\n'.join(content)})
+            backgroundSender.submit(segment, segment.send)
 
         if env.CD_DEBUG == 'true' and not isCmd:
             print(f"Log: {title}\n{body}")
+        return segment
+
+    # adds a section that can be rewritten later, e.g. with the output of a command while it runs
+    # returns update(body, footer='', newTitle=None), a new title is shown as plain text rather than as a command
+    def live(title, isCmd=True, replaceLast=False):
+        with lock:
+            segment = logLocked(title, '', isCmd, replaceLast, reserve=int(env.CD_LOG_MAX_OUTPUT) + 1000)
+            index = len(segment.sections) - 1
+
+        def update(body, footer='', newTitle=None):
+            if newTitle is None:
+                section = formatSection(title, body, isCmd, footer)
+            else:
+                section = formatSection(newTitle, body, False, footer)
+            with lock:
+                segment.replace(index, section)
+                if env.CD_LOCAL_MODE == 'false':
+                    backgroundSender.submit(segment, segment.send)
+
+        return update
 
     log.commentAPIURL = commentAPIURL
     log.commentHTMLURL = commentHTMLURL
+    log.flush = flushLogs
+    log.live = live
     return log
 
 
-def wrapCommentSection(title, body='', isCmd=True):
-    commentSection = '<details><summary>%s</summary>\n\n```\n%s\n```\n</details>'
+class CommentSegment:
+    def __init__(self, newCommentURL, header, previous=None):
+        self.newCommentURL = newCommentURL
+        self.sections = [header]
+        self.size = len(header)
+        self.previous = previous
+        self.continuedIn = None
+        self.apiURL = None
+        self.htmlURL = None
+
+    def hasSections(self):
+        return len(self.sections) > 1
+
+    def append(self, section):
+        self.sections.append(section)
+        self.size += len(section) + 1
+
+    def replaceLast(self, section):
+        self.replace(len(self.sections) - 1, section)
+
+    def replace(self, index, section):
+        self.size += len(section) - len(self.sections[index])
+        self.sections[index] = section
+
+    def render(self):
+        body = '\n'.join(self.sections)
+        return body + f'\n\nContinued in {self.continuedIn}' if self.continuedIn else body
+
+    # creates the comment the first time, updates it after that
+    def send(self):
+        if self.apiURL:
+            PATCH(self.apiURL, {'body': self.render()})
+            return
+
+        comment = POST(self.newCommentURL, {'body': self.render()})
+        self.apiURL = comment['url']
+        self.htmlURL = comment['html_url']
+        if self.previous:
+            self.previous.continuedIn = self.htmlURL
+            backgroundSender.submit(self.previous, self.previous.send)
+
+
+class BackgroundSender:
+    """
+    Sends comment updates and commit statuses from a background thread so that handlers never wait on GitHub.
+    Updates to the same comment or status are coalesced, at most one request for each is sent every interval seconds.
+    Everything is held back while the rate limit is running low, polling gets what's left.
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.pid = None
+
+    # state is per process, a forked worker starts with a clean slate rather than a copy of a possibly held lock
+    def ensureStarted(self, thread=True):
+        if self.pid != os.getpid():
+            self.pid = os.getpid()
+            self.cond = threading.Condition()
+            self.pending = {}  # comment or status -> function that sends its latest content
+            self.lastSent = {}
+            self.sending = 0
+            self.flushing = 0
+            self.wakeTask = None  # set while runAsTask is doing the sending
+            if thread:
+                self.startThread()
+
+    def startThread(self):
+        threading.Thread(target=self.run, name='background-sender', daemon=True).start()
+
+    def submit(self, key, send):
+        self.ensureStarted()
+        send = tracing.bind(send, 'background send', 'github')  # part of the handler's trace, if it's traced
+        with self.cond:
+            self.pending[key] = send
+            self.cond.notify_all()
+        self.notifyTask()
+
+    # send everything queued up right away and wait for it to go out, unless it's being held back for the rate limit
+    # returns how many sends are still waiting
+    def flush(self, timeout=60):
+        if self.pid != os.getpid():
+            return 0
+        with self.cond:
+            self.flushing += 1
+            self.cond.notify_all()
+            self.notifyTask()
+            self.cond.wait_for(lambda: (not self.pending or rateBudget.deferFor()) and not self.sending, timeout)
+            self.flushing -= 1
+            return len(self.pending)
+
+    def notifyTask(self):
+        wakeTask = self.wakeTask
+        if wakeTask:
+            wakeTask()
+
+    def run(self):
+        while True:
+            with self.cond:
+                due = self.nextDue()
+                while due != 0:
+                    self.cond.wait(due)
+                    due = self.nextDue()
+                send = self.takeNext()
+            self.send(send)
+
+    # the main process sends from a task on its event loop instead of a thread of its own, see core.py
+    # requests are still made in the loop's default executor, once the task is cancelled a thread takes over
+    async def runAsTask(self):
+        if self.pid == os.getpid():
+            return  # already sending from a thread
+        loop = asyncio.get_event_loop()
+        wanted = asyncio.Event()
+        self.ensureStarted(thread=False)
+        self.wakeTask = lambda: callSoonThreadsafe(loop, wanted.set)
+        try:
+            while True:
+                wanted.clear()
+                with self.cond:
+                    due = self.nextDue()
+                    send = self.takeNext() if due == 0 else None
+                if send is None:
+                    try:
+                        await asyncio.wait_for(wanted.wait(), due)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+                await loop.run_in_executor(None, self.send, send)
+        finally:
+            self.wakeTask = None
+            self.startThread()  # for whatever's still to come, like the flush at exit
+
+    # call with cond held, when nextDue() is 0
+    def takeNext(self):
+        key = min(self.pending, key=lambda key: self.lastSent.get(key, 0))
+        send = self.pending.pop(key)
+        now = time.time()
+        # forget comments that haven't been touched in a while so finished loggers can be collected
+        self.lastSent = dict((k, t) for k, t in self.lastSent.items() if k in self.pending or now - t < self.interval)
+        self.lastSent[key] = now
+        self.sending += 1
+        return send
+
+    def send(self, send):
+        try:
+            send()
+        except:  # non critical
+            print(traceback.format_exc())
+        finally:
+            with self.cond:
+                self.sending -= 1
+                self.cond.notify_all()
+
+    # seconds until the next update may be sent, None if nothing is queued
+    def nextDue(self):
+        if not self.pending:
+            return None
+        deferFor = rateBudget.deferFor()
+        if deferFor:
+            return deferFor
+        if self.flushing:
+            return 0
+        return max(0, min(self.lastSent.get(key, 0) for key in self.pending) + self.interval - time.time())
+
+
+backgroundSender = BackgroundSender(float(env.CD_LOG_FLUSH_INTERVAL))
+
+
+def flushLogs():
+    return backgroundSender.flush()
+
+
+atexit.register(flushLogs)
+
+
+def wrapCommentSection(title, body='', isCmd=True, footer=''):
+    commentSection = '<details><summary>%s</summary>\n\n```\n%s\n```\n%s</details>'
     if isCmd:
         title = '<code>' + title + '</code>'
-    return commentSection % (title, body)
+    return commentSection % (title, body, footer + '\n' if footer else '')
+
+
+# keeps a full copy of text too big for a comment, returns a link to it or None if the store isn't served
+def saveArtifact(text, name='output'):
+    path, link = newArtifact(name, hashlib.sha1(text.encode()).hexdigest()[:12])
+    with open(path, 'w') as f:
+        f.write(text)
+    if not link:
+        print(f'Full output of a truncated log section: {path}')
+    return link
+
+
+# returns the path to write a new artifact to and the link to it
+# without CD_ARTIFACT_URL there's no link, a path inside our container is no use to anyone reading GitHub
+def newArtifact(name='output', id=None, extension='txt'):
+    os.makedirs(env.CD_ARTIFACT_DIR, exist_ok=True)
+    fileName = f"{time.strftime('%Y%m%d-%H%M%S')}-{id or uuid.uuid4().hex[:12]}-{name}.{extension}"
+    link = f"{env.CD_ARTIFACT_URL.rstrip('/')}/{fileName}" if env.CD_ARTIFACT_URL else None
+    return os.path.join(env.CD_ARTIFACT_DIR, fileName), link
+
+
+artifactsPrunedAt = 0
+
+
+# removes artifacts older than CD_ARTIFACT_RETENTION_DAYS, unless that was done less than interval seconds ago
+# runs at startup and after every handler run, see events.callHandler, since artifacts are written all the time
+def pruneArtifacts(interval=0):
+    global artifactsPrunedAt
+    if time.time() - artifactsPrunedAt < interval:
+        return
+    artifactsPrunedAt = time.time()
+    if os.path.isdir(env.CD_ARTIFACT_DIR):
+        cutoff = time.time() - float(env.CD_ARTIFACT_RETENTION_DAYS) * 24 * 60 * 60
+        for fileName in os.listdir(env.CD_ARTIFACT_DIR):
+            path = os.path.join(env.CD_ARTIFACT_DIR, fileName)
+            try:
+                if os.path.getmtime(path) < cutoff:
+                    os.remove(path)
+            except FileNotFoundError:
+                pass  # another worker pruned it first
 
 
 # returns a convenience wrapper around sh that logs to a third party, like a comment in github
@@ -143,9 +582,12 @@ def newLoggingShell(log=None):
     if not log:
         return sh
 
+    # stream=True shows the tail of the output in the log while the command runs
+    # spill=True also keeps the complete output in an artifact that's linked from the log, if CD_ARTIFACT_URL is set
     def loggingShell(*args, **kwargs):
         skipLog = False
         replaceLast = False
+        spill = kwargs.pop('spill', False)
         if 'skipLog' in kwargs:
             kwargs.pop('skipLog')
             skipLog = True
@@ -153,6 +595,10 @@ def newLoggingShell(log=None):
             kwargs.pop('replaceLast')
             replaceLast = True
 
+        # loggers other than GitHub's can't show output while it's coming in, they get it once the command is done
+        if kwargs.get('stream') and not skipLog and hasattr(log, 'live'):
+            return streamingShell(args, kwargs, spill, replaceLast)
+
         try:
             out = sh(*args, **kwargs)
         except ExecutionError as e:
@@ -167,25 +613,90 @@ def newLoggingShell(log=None):
                 log(args[0], out, isCmd=True, replaceLast=replaceLast)
             return out
 
+    def streamingShell(args, kwargs, spill, replaceLast):
+        footer = ''
+        if spill and env.CD_ARTIFACT_URL:  # without a link nobody would read it, it would only fill the disk
+            kwargs['spillPath'], link = newArtifact()
+            footer = f'Full output: {link}'
+        update = log.live(args[0], replaceLast=replaceLast)
+
+        def onOutput(out, err):
+            output = out + (f'\nStderr: {err}' if err.strip() else '')
+            update(output[-int(env.CD_LOG_MAX_OUTPUT):] + '\n[still running...]', footer)
+
+        try:
+            out = sh(*args, onOutput=onOutput, **kwargs)
+        except ExecutionError as e:
+            out, err = (o.decode(errors='replace') if isinstance(o, bytes) else o for o in (e.out, e.err))
+            update(f'Return code: {e.ret}\nStdout: {out}\nStderr: {err}', footer,
+                   newTitle=f'Error: <code>{args[0]}</code>')
+            raise
+        update(out, footer)
+        return out
+
     return loggingShell
 
 
-currentHandlerFnName = None
+# state for the handler currently running in this thread, each handler run gets its own
+handlerContext = threading.local()
+
+
+def setHandlerContext(name, eventID=0, workspace=None):
+    handlerContext.name = name
+    handlerContext.eventID = eventID
+    handlerContext.workspace = workspace
 
 
 def setCurrentHandlerFnName(name):
-    global currentHandlerFnName
-    currentHandlerFnName = name
+    handlerContext.name = name
 
 
 def getCurrentHandlerFnName():
-    return currentHandlerFnName
+    return getattr(handlerContext, 'name', None)
+
+
+# wraps fn to run with the current thread's repository and handler context, for handing work off to other threads
+def inCurrentContext(fn):
+    repo = currentRepo()
+    context = (getCurrentHandlerFnName(), getattr(handlerContext, 'eventID', 0),
+               getattr(handlerContext, 'workspace', None))
+    span = tracing.current()
+
+    def wrapper(*args, **kwargs):
+        with repoContext(repo), tracing.activate(span):
+            setHandlerContext(*context)
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                setHandlerContext(None)
+
+    return wrapper
+
+
+# returns a fresh, empty directory for a handler run to work in
+def newWorkspace(name):
+    os.makedirs(env.CD_WORKSPACE_ROOT, exist_ok=True)
+    path = tempfile.mkdtemp(prefix=f'{name}-', dir=env.CD_WORKSPACE_ROOT)
+    os.chmod(path, 0o777)
+    return path
+
+
+# deleting a big checkout can take a while, no need to hold up the next handler for it
+def removeInBackground(path):
+    threading.Thread(target=shutil.rmtree, args=(path, True), daemon=True).start()
+
+
+# clean up workspaces left behind by a previous run of quickcd
+def removeStaleWorkspaces():
+    if os.path.isdir(env.CD_WORKSPACE_ROOT):
+        for name in os.listdir(env.CD_WORKSPACE_ROOT):
+            removeInBackground(os.path.join(env.CD_WORKSPACE_ROOT, name))
 
 
 # these will raise exception for non 2xx code
-# urllib3 autoretries and follows redirects
+# urllib3 autoretries connection errors and follows redirects, transient errors from GitHub are retried by request
 def getJSON(url):
-    return json.loads(checkResponse(http.request('GET', url)).data.decode('utf-8'))
+    return json.loads(request('GET', url).data.decode('utf-8'))
 
 
 GET = getJSON
@@ -195,12 +706,27 @@ def postJSON(url, data, method='POST'):
     if isinstance(data, dict):
         data = json.dumps(data, ensure_ascii=False, allow_nan=False)
     return json.loads(
-        checkResponse(
-            http.request(
-                'POST',
-                url,
-                body=data.encode('utf-8'),
-                headers=dict(http.headers, **{'Content-Type': 'application/json'}))).data.decode('utf-8'))
+        request(method, url, body=data.encode('utf-8'),
+                headers=dict(http.headers, **{'Content-Type': 'application/json'})).data.decode('utf-8'))
+
+
+# an endpoint that keeps failing is given a break rather than every handler retrying it
+githubCircuit = CircuitBreaker(failures=(RetryException, urllib3.exceptions.HTTPError))
+
+
+# allowed are statuses other than 2xx that are answers too, like a 304 to a request with an etag
+@retryWithBackoff()
+def request(method, url, allowed=(), **kwargs):
+    with githubCircuit.call(endpoint(method, url)), tracing.span(endpoint(method, url), 'github'):
+        resp = http.request(method, url, **kwargs)
+        tracing.annotate(status=resp.status)
+        # a POST that may have gone through isn't repeated, it could create a second comment
+        return checkResponse(resp, idempotent=method != 'POST', allowed=allowed)
+
+
+# statuses/<sha>, comments/<id> etc. are all the same endpoint as far as the circuit breaker is concerned
+def endpoint(method, url):
+    return method + ' ' + re.sub(r'/(\d+|[0-9a-f]{40})(?=/|$)', '/*', url.split('?')[0])
 
 
 POST = postJSON
@@ -214,12 +740,31 @@ def patchJSON(*args, **kwargs):
 PATCH = patchJSON
 
 
-def checkResponse(resp):
-    if resp.status < 200 or resp.status > 299:
-        raise Exception(f'Unexpected status: {resp.status}. Headers: {resp.headers}. Body: {resp.data}')
+# transient errors raise RetryException, everything else a plain Exception
+def checkResponse(resp, idempotent=True, allowed=()):
+    if (resp.status < 200 or resp.status > 299) and resp.status not in allowed:
+        message = f'Unexpected status: {resp.status}. Headers: {resp.headers}. Body: {resp.data}'
+        rateLimited = resp.status == 429 or resp.status == 403 and (
+            'Retry-After' in resp.headers or resp.headers.get('X-RateLimit-Remaining') == '0'
+            or b'rate limit' in resp.data.lower())
+        if rateLimited or resp.status == 503 or (idempotent and resp.status in (500, 502, 504)):
+            raise RetryException(message, after=retryAfter(resp))
+        raise Exception(message)
     return resp
 
 
+# seconds GitHub wants us to wait before trying again, if it said
+def retryAfter(resp):
+    if 'Retry-After' in resp.headers:
+        try:
+            return float(resp.headers['Retry-After'])
+        except ValueError:
+            pass  # can also be an http date, GitHub doesn't send those
+    if resp.headers.get('X-RateLimit-Remaining') == '0' and 'X-RateLimit-Reset' in resp.headers:
+        return max(0, float(resp.headers['X-RateLimit-Reset']) - time.time())
+    return None
+
+
 # GitHub's build statuses
 class BuildStatus:
     pending = "pending"
@@ -241,18 +786,14 @@ def setCommitStatus(commitHash, status, description='', url=''):
     if env.CD_LOCAL_MODE != 'false':
         return
 
-    try:
-        POST(f'{env.CD_REPO_API_URL}/statuses/{commitHash}', {
-            "state": status,
-            "description": description,
-            "context": env.CD_CLUSTER_ID,
-            "target_url": url
-        })
-    except:  # non critical
-        print(traceback.format_exc())
+    statusURL = f'{env.CD_REPO_API_URL}/statuses/{commitHash}'
+    body = {"state": status, "description": description, "context": env.CD_CLUSTER_ID, "target_url": url}
+    # non critical, sent in the background where only the latest status for a commit is kept
+    backgroundSender.submit(statusURL, lambda: POST(statusURL, body))
 
 
 interruptEvent = threading.Event()
+wakeListeners = []  # the main loop's, called with poll by wake, from whichever thread wake is called in
 
 
 def stillAlive():
@@ -263,6 +804,22 @@ def sleep(sec):
     interruptEvent.wait(sec)
 
 
+# wakes up the main loop early, e.g. when a handler running in the background finishes
+# poll=True also has it poll for new events early instead of when next scheduled, poll=repo only that repository,
+# how early is up to ratelimit.rateBudget.earlyPollDelay
+def wake(poll=False):
+    for listener in list(wakeListeners):
+        listener(poll)
+
+
+# loop.call_soon_threadsafe, but does nothing once the loop is closed, for threads that may outlive it
+def callSoonThreadsafe(loop, fn, *args):
+    try:
+        loop.call_soon_threadsafe(fn, *args)
+    except RuntimeError:
+        pass  # closed
+
+
 def setInterruptHandlers():
     signal.signal(signal.SIGINT, interrupt_handler)
     signal.signal(signal.SIGTERM, interrupt_handler)
@@ -271,17 +828,26 @@ def setInterruptHandlers():
 def interrupt_handler(sig, frame):
     if not stillAlive():
         print('Interrupted twice, exiting.')
-        exit(1)
+        # exit() would wait for the handler running in the dispatch thread, the interpreter joins executor threads
+        for child in multiprocessing.active_children():
+            child.terminate()
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os._exit(1)
     else:
         interruptEvent.set()
+        wake()
         print('INTERRUPTED. Exiting as soon as all handlers for event complete.')
 
 
 def writeLabels(item, **kwargs):
-    sh(f'kubectl -n {env.CD_NAMESPACE} label --overwrite configmap {getFullName(item)} ' + ' '.join(
-        f'{key}={value}' for key, value in kwargs.items()))
+    kube.patchLabels(getFullName(item), kwargs)
 
 
+# answered from the local mirror when it's running
 def readLabels(item):
-    return json.loads(
-        sh(f'kubectl -n {env.CD_NAMESPACE} get configmap -o=json ' + getFullName(item)))['metadata']['labels']
+    return kube.state.get(getFullName(item))['metadata']['labels']
+
+
+# at the end since kube imports this file also
+import kube
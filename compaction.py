@@ -0,0 +1,172 @@
+"""
+Handled events are kept as ConfigMaps for CD_EVENT_RETENTION_DAYS, after that they're moved into gzipped archive
+ConfigMaps, one or more per day the events were created on, so that the event lists and the namespace don't keep
+growing. CD_EVENT_ARCHIVE=full keeps whole events, audit keeps only which handlers ran, how often and when.
+This runs in a background thread that only works while the main loop is waiting for work, at no more than
+CD_COMPACT_RATE api calls a second.
+
+Archives aren't mirrored by kube.state, to read them back:
+for record in compaction.archivedEvents('20190501'): ...
+"""
+import base64, calendar, gzip, json, threading, time, traceback
+from common import env, getFullName, getRepos, repoContext, stillAlive, sleep
+import kube
+
+ARCHIVE_MAX_BYTES = 900 * 1024  # ConfigMaps can't be larger than 1MiB
+idle = threading.Event()  # set by the main loop while it has nothing to dispatch
+archiveSizes = {}  # archive name -> bytes, only the compactor writes archives so this stays accurate
+thread = None
+
+
+def handledSelector():
+    return f'kind=GitHubEvent,status=handled,org={env.CD_GITHUB_ORG_NAME},repo={env.CD_GITHUB_REPO_NAME}'
+
+
+def archiveSelector(day=None):
+    selector = f'kind=GitHubEventArchive,org={env.CD_GITHUB_ORG_NAME},repo={env.CD_GITHUB_REPO_NAME}'
+    return selector + f',day={day}' if day else selector
+
+
+def createdAt(event):
+    return calendar.timegm(time.strptime(event['created_at'], '%Y-%m-%dT%H:%M:%SZ'))
+
+
+# sort key for events in the order they happened, within the same second polled ones go by their events api id
+# and webhook deliveries, which are only timed when they came in, come after them in the order they came in
+def eventOrder(event):
+    id = str(event['id'])
+    if id.isdigit():
+        return createdAt(event), 0, int(id)
+    return createdAt(event), 1, event.get('received_at', 0)
+
+
+# when the last handler ran, or when the event was created if it didn't need any
+def handledAt(event, labels):
+    runs = [float(value) for key, value in labels.items() if key.endswith('_last_run')]
+    return max(runs) if runs else createdAt(event)
+
+
+def archiveEntry(event, labels):
+    record = {
+        'id': event['id'],
+        'type': event['type'],
+        'created_at': event['created_at'],
+        'actor': (event.get('actor') or {}).get('login'),
+        'labels': dict((k, v) for k, v in labels.items() if k not in ('owner', 'kind', 'org', 'repo')),
+    }
+    if env.CD_EVENT_ARCHIVE == 'full':
+        record['event'] = event
+    return base64.b64encode(gzip.compress(json.dumps(record, ensure_ascii=False).encode('utf-8'))).decode()
+
+
+def archiveSize(name):
+    if name not in archiveSizes:
+        try:
+            data = kube.getConfigMap(name).get('binaryData') or {}
+        except kube.KubeError as e:
+            if not kube.isNotFound(e):
+                raise
+            data = {}
+        archiveSizes[name] = sum(len(k) + len(v) for k, v in data.items())
+    return archiveSizes[name]
+
+
+# the first archive of the day with room for size more bytes
+def archiveFor(day, size):
+    part = 0
+    while archiveSize(getFullName(f'{day}-{part}', 'archive')) + size > ARCHIVE_MAX_BYTES:
+        part += 1
+    return getFullName(f'{day}-{part}', 'archive')
+
+
+def addToArchive(name, day, entries):
+    try:
+        kube.patchConfigMap(name, {'binaryData': entries})
+    except kube.KubeError as e:
+        if not kube.isNotFound(e):
+            raise
+        kube.createConfigMap({
+            'apiVersion': 'v1',
+            'kind': 'ConfigMap',
+            'metadata': {
+                'name': name,
+                'labels': {
+                    'owner': 'quickcd-archive',  # not 'quickcd', that would bring them back into kube.state
+                    'kind': 'GitHubEventArchive',
+                    'org': env.CD_GITHUB_ORG_NAME,
+                    'repo': env.CD_GITHUB_REPO_NAME,
+                    'day': day
+                }
+            },
+            'binaryData': entries
+        })
+    archiveSizes[name] = archiveSize(name) + sum(len(k) + len(v) for k, v in entries.items())
+
+
+# waits until the main loop is idle and our rate allows another call, False if we're shutting down
+def takeTurn():
+    while stillAlive() and not idle.wait(1):
+        pass
+    sleep(1 / float(env.CD_COMPACT_RATE))
+    return stillAlive()
+
+
+# archives handled events of the current repository that are past retention, oldest first
+# the retention should be longer than GitHub keeps redelivering webhooks, dedup keys go with the events
+def compactEvents():
+    cutoff = time.time() - float(env.CD_EVENT_RETENTION_DAYS) * 24 * 60 * 60
+    expired = []
+    for r in kube.state.list(handledSelector()):
+        event, labels = json.loads(r['data']['event']), r['metadata']['labels']
+        if handledAt(event, labels) < cutoff:
+            expired.append((r['metadata']['name'], event, labels))
+    if not expired:
+        return 0
+
+    print(f'Archiving {len(expired)} handled event(s) older than {env.CD_EVENT_RETENTION_DAYS} days.')
+    archived = 0
+    for name, event, labels in sorted(expired, key=lambda e: eventOrder(e[1])):
+        id = event['id']
+        entry = archiveEntry(event, labels)
+        day = time.strftime('%Y%m%d', time.gmtime(createdAt(event)))
+        # archived first, if we stop in between the event is archived again next time under the same key
+        if not takeTurn():
+            break
+        addToArchive(archiveFor(day, len(entry) + len(str(id))), day, {str(id): entry})
+        if not takeTurn():
+            break
+        try:
+            kube.deleteConfigMap(name)
+        except kube.KubeError as e:
+            if not kube.isNotFound(e):
+                raise
+        archived += 1
+    return archived
+
+
+# archived events of the current repository, all of them or those created on day (YYYYMMDD)
+def archivedEvents(day=None):
+    archives = kube.listConfigMaps(archiveSelector(day))['items']
+    records = {}  # an event may have been archived twice, see compactEvents
+    for archive in archives:
+        for id, entry in (archive.get('binaryData') or {}).items():
+            records[id] = json.loads(gzip.decompress(base64.b64decode(entry)).decode('utf-8'))
+    return sorted(records.values(), key=eventOrder)
+
+
+def run():
+    while stillAlive():
+        for repo in getRepos():
+            with repoContext(repo):
+                try:
+                    compactEvents()
+                except:
+                    print(traceback.format_exc())
+        sleep(float(env.CD_COMPACT_INTERVAL))
+
+
+def start():
+    global thread
+    if thread is None and float(env.CD_EVENT_RETENTION_DAYS) > 0:
+        thread = threading.Thread(target=run, name='compaction', daemon=True)
+        thread.start()
@@ -0,0 +1,154 @@
+"""
+The main loop, as asyncio tasks that run side by side on one event loop:
+ - a poller for every repository, on the rate limit aware schedule or early when a webhook asks for it,
+   a poll that fails is logged and the next ones back off until GitHub answers again
+ - the dispatcher, which hands saved events to their handlers whenever there's something new or a handler finished
+ - the hourly refresh of the kube config
+ - the sender of comment updates and commit statuses, see common.BackgroundSender
+Everything that blocks runs in executors, so polling carries on while a handler runs and the other way around:
+each repository is polled in a thread of its own and dispatching has a single thread, which keeps blocking handlers
+running one at a time in event order. The kube config is refreshed in the dispatch thread too, between handlers, so
+it's never rewritten while a blocking handler is using it. Nonblocking handlers run in the worker pool as before.
+
+Interrupts (see setInterruptHandlers) stop any new polls and dispatches from starting, the ones already under way are
+finished and then the handlers running in the worker pool are waited for.
+"""
+import asyncio, time, traceback
+from concurrent.futures import ThreadPoolExecutor
+import init, kube, metrics, compaction
+from common import stillAlive, repoContext, wakeListeners, callSoonThreadsafe, backgroundSender, interruptEvent, wake
+from events import fetchAndSaveNewEvents, processNextEvent, drainWorkers, repoName
+from ratelimit import rateBudget
+from retries import backoffDelay
+
+KUBE_CONFIG_REFRESH_INTERVAL = 60 * 60
+POLL_MAX_BACKOFF = 10 * 60
+
+
+def refreshKubeConfig():
+    print('Refreshing Kube config')
+    init.generateKubeconfig()
+    kube.loadConfig()
+    kube.state.waitSynced()
+
+
+def poll(repo):
+    with repoContext(repo), metrics.pollDuration.time(repo=repoName()):
+        fetchAndSaveNewEvents()
+
+
+# one turn for every repository, returns True if any work was done
+def dispatch(repos):
+    workPerformed = False
+    for repo in repos:
+        if stillAlive():
+            with repoContext(repo):
+                workPerformed = processNextEvent() or workPerformed
+    return workPerformed
+
+
+class Core:
+    def __init__(self, loop, repos):
+        self.loop = loop
+        self.repos = repos
+        self.pollWanted = dict((repo, asyncio.Event()) for repo in repos)
+        self.dispatchWanted = asyncio.Event()
+        self.refreshWanted = asyncio.Event()  # only set to stop
+        self.pollExecutor = ThreadPoolExecutor(len(repos), 'poll')
+        self.dispatchExecutor = ThreadPoolExecutor(1, 'dispatch')
+
+    # a wake listener, called from any thread and from the interrupt handler
+    def wake(self, poll):
+        callSoonThreadsafe(self.loop, self.wakeTasks, poll)
+
+    def wakeTasks(self, poll):
+        self.dispatchWanted.set()
+        for repo, event in self.pollWanted.items():
+            if poll is True or poll == repo or not stillAlive():
+                event.set()
+        if not stillAlive():
+            self.refreshWanted.set()
+
+    # returns once the event is set or after seconds, whichever is first, None waits for the event only
+    async def pause(self, event, seconds):
+        if event.is_set() or not stillAlive():
+            return
+        try:
+            await asyncio.wait_for(event.wait(), max(0, seconds) if seconds is not None else None)
+        except asyncio.TimeoutError:
+            pass
+
+    async def poller(self, repo):
+        lastPoll, nextPoll, failures = 0, 0, 0
+        while stillAlive():
+            await self.pause(self.pollWanted[repo], nextPoll - time.time())
+            if not stillAlive():
+                break
+            if self.pollWanted[repo].is_set():
+                # asked to poll early, which can't be any sooner than GitHub and the rate limit allow
+                self.pollWanted[repo].clear()
+                nextPoll = min(nextPoll, lastPoll + rateBudget.earlyPollDelay(len(self.repos)))
+                if nextPoll > time.time():
+                    continue
+            lastPoll = time.time()
+            try:
+                await self.loop.run_in_executor(self.pollExecutor, poll, repo)
+                failures = 0
+            except Exception:
+                # the request was retried already, GitHub is having a longer bad moment, the events will keep
+                failures += 1
+                print(f"Polling {'/'.join(repo)} failed, {failures} time(s) in a row:\n{traceback.format_exc()}")
+            # every repository has its own schedule but they all share one rate limit budget
+            nextPoll = time.time() + rateBudget.nextPollDelay(len(self.repos))
+            if failures:
+                nextPoll += backoffDelay(failures, 10, POLL_MAX_BACKOFF)
+            self.dispatchWanted.set()
+
+    async def dispatcher(self):
+        while stillAlive():
+            self.dispatchWanted.clear()
+            if not await self.loop.run_in_executor(self.dispatchExecutor, dispatch, self.repos):
+                # finished processing all events, take a break until there's something new
+                compaction.idle.set()
+                await self.pause(self.dispatchWanted, None)
+                compaction.idle.clear()
+
+    async def refresher(self):
+        while stillAlive():
+            await self.pause(self.refreshWanted, KUBE_CONFIG_REFRESH_INTERVAL)
+            if stillAlive():
+                await self.loop.run_in_executor(self.dispatchExecutor, refreshKubeConfig)
+
+    async def run(self):
+        await self.loop.run_in_executor(self.dispatchExecutor, refreshKubeConfig)
+        sender = self.loop.create_task(backgroundSender.runAsTask())
+        wakeListeners.append(self.wake)
+        tasks = [self.loop.create_task(self.poller(repo)) for repo in self.repos]
+        tasks += [self.loop.create_task(self.dispatcher()), self.loop.create_task(self.refresher())]
+        try:
+            done, running = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+            failed = [task for task in done if not task.cancelled() and task.exception()]
+            if failed:
+                # let the rest wind down as if interrupted, then go down with the error
+                interruptEvent.set()
+                wake()
+                if running:
+                    await asyncio.wait(running)
+                failed[0].result()
+        finally:
+            wakeListeners.remove(self.wake)
+            await self.loop.run_in_executor(None, drainWorkers)
+            sender.cancel()
+            await asyncio.wait([sender])
+            for executor in (self.pollExecutor, self.dispatchExecutor):
+                executor.shutdown(wait=False)
+
+
+# runs until interrupted, best called from the main thread so interrupts are handled straight away
+def run(repos):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        loop.run_until_complete(Core(loop, repos).run())
+    finally:
+        loop.close()
@@ -1,4 +1,164 @@
 """
-This file should provide persistent storage functionality backed by etcd through kubectl, probably just kv to start.
-Should be autokeyed on event id?
-"""
\ No newline at end of file
+A key-value store for handlers, kept in ConfigMaps in quickcd's namespace.
+Keys are spread over CD_DB_SHARDS ConfigMaps per repository (don't change it once there's data in them),
+values are anything json can store.
+Reads are answered from kube.state's local mirror, so they don't cost a round trip to the api.
+Writes go out straight away, or all together at the end of a `with db.batch():` block. Each shard is updated with
+its resourceVersion, so concurrent writers such as worker processes don't overwrite each other.
+A ConfigMap holds at most 1MiB, a write that would take a shard past SHARD_MAX_BYTES fails instead.
+
+db.put('skip/abc123', True)
+db.get('skip/abc123')  # True
+db.scan('skip/')  # {'skip/abc123': True}
+"""
+import json, os, re, threading, zlib
+from contextlib import contextmanager
+from common import env, getFullName
+import kube
+
+SHARDS = int(os.environ.get('CD_DB_SHARDS', '16'))
+SHARD_MAX_BYTES = 900 * 1024  # ConfigMaps can't be larger than 1MiB, this leaves room for the rest of the object
+local = threading.local()  # writes not sent yet, each thread batches its own
+
+
+# ConfigMap keys only allow [-._a-zA-Z0-9], anything else is written as _xx per utf-8 byte
+# this keeps prefixes intact, so scans can work on the encoded keys
+def encodeKey(key):
+    return ''.join(c if re.match('[-.a-zA-Z0-9]', c) else ''.join('_%02x' % b for b in c.encode()) for c in key)
+
+
+def decodeKey(key):
+    return re.sub('(_[0-9a-f]{2})+', lambda m: bytes.fromhex(m.group().replace('_', '')).decode(), key)
+
+
+def shardName(key):
+    return getFullName(f'db-{zlib.crc32(key.encode()) % SHARDS}')
+
+
+def shardSelector():
+    return f'kind=KV,org={env.CD_GITHUB_ORG_NAME},repo={env.CD_GITHUB_REPO_NAME}'
+
+
+# shard name -> {encoded key: json value, or None to delete}
+def pendingWrites():
+    if not hasattr(local, 'writes'):
+        local.writes = {}
+    return local.writes
+
+
+def get(key, default=None):
+    shard, encoded = shardName(key), encodeKey(key)
+    writes = pendingWrites().get(shard, {})
+    if encoded in writes:
+        return default if writes[encoded] is None else json.loads(writes[encoded])
+    try:
+        data = kube.state.get(shard).get('data') or {}
+    except kube.KubeError as e:
+        if not kube.isNotFound(e):
+            raise
+        return default
+    return json.loads(data[encoded]) if encoded in data else default
+
+
+def put(key, value):
+    write(key, json.dumps(value, ensure_ascii=False, allow_nan=False))
+
+
+def delete(key):
+    write(key, None)
+
+
+def write(key, value):
+    pendingWrites().setdefault(shardName(key), {})[encodeKey(key)] = value
+    if not getattr(local, 'depth', 0):
+        flush()
+
+
+# returns {key: value} for every key starting with prefix
+def scan(prefix=''):
+    encoded = encodeKey(prefix)
+    result = {}
+    for shard in kube.state.list(shardSelector()):
+        for key, value in (shard.get('data') or {}).items():
+            if key.startswith(encoded):
+                result[decodeKey(key)] = json.loads(value)
+    for writes in pendingWrites().values():
+        for key, value in writes.items():
+            if key.startswith(encoded):
+                if value is None:
+                    result.pop(decodeKey(key), None)
+                else:
+                    result[decodeKey(key)] = json.loads(value)
+    return result
+
+
+# writes made in the block are sent together when it ends, one request per shard touched
+# nothing is written if the block raises
+@contextmanager
+def batch():
+    local.depth = getattr(local, 'depth', 0) + 1
+    try:
+        yield
+    except:
+        if local.depth == 1:
+            local.writes = {}
+        raise
+    finally:
+        local.depth -= 1
+    if not local.depth:
+        flush()
+
+
+def flush():
+    writes, local.writes = pendingWrites(), {}
+    for shard, changes in writes.items():
+        writeShard(shard, changes)
+
+
+# read-modify-write of a single shard, starting from the local mirror and rereading from the api on conflicts
+def writeShard(name, changes, attempts=10):
+    for attempt in range(attempts):
+        try:
+            current = kube.state.get(name) if attempt == 0 else kube.getConfigMap(name)
+        except kube.KubeError as e:
+            if not kube.isNotFound(e):
+                raise
+            current = None
+
+        data = dict((current or {}).get('data') or {})
+        for key, value in changes.items():
+            if value is None:
+                data.pop(key, None)
+            else:
+                data[key] = value
+        size = sum(len(key) + len(value.encode('utf-8')) for key, value in data.items())
+        if size > SHARD_MAX_BYTES:
+            largest = decodeKey(max(data, key=lambda key: len(data[key])))
+            raise Exception(f"Writing {', '.join(decodeKey(key) for key in changes)} would make {name} {size} bytes, "
+                            f'more than a ConfigMap can hold. The largest value in it is {largest}.')
+        obj = {
+            'apiVersion': 'v1',
+            'kind': 'ConfigMap',
+            'metadata': {
+                'name': name,
+                'labels': {
+                    'owner': 'quickcd',
+                    'kind': 'KV',
+                    'org': env.CD_GITHUB_ORG_NAME,
+                    'repo': env.CD_GITHUB_REPO_NAME
+                }
+            },
+            'data': data
+        }
+
+        try:
+            if current is None:
+                kube.createConfigMap(obj)
+            else:
+                obj['metadata']['resourceVersion'] = current['metadata']['resourceVersion']
+                kube.replaceConfigMap(obj)
+            return
+        except kube.KubeError as e:
+            if not kube.isConflict(e):
+                raise
+    raise Exception(f'Gave up writing {name} after {attempts} conflicting updates.')
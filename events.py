@@ -1,20 +1,78 @@
-import json, os, traceback, time
-from common import http, checkResponse, sh, env, getFullName, setCurrentHandlerFnName, writeLabels
-from collections import defaultdict, namedtuple
+import json, os, re, traceback, time, signal, threading, multiprocessing, hashlib, importlib.util, kube
+import metrics, tracing
+from compaction import eventOrder
+from common import http, request, env, getFullName, writeLabels, readLabels
+from common import setHandlerContext, newWorkspace, removeInBackground, wake, flushLogs, getRepos, repoContext, currentRepo
+from common import inCurrentContext, newArtifact, pruneArtifacts
+from collections import defaultdict, namedtuple, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from base64 import b32encode
+from filters import Filter, FilterIndex
 
-kubeList = {"apiVersion": "v1", "items": [], "kind": "List"}
+ARTIFACT_PRUNE_INTERVAL = 60 * 60
 kubeConfigMap = {"apiVersion": "v1", "data": {}, "kind": "ConfigMap", "metadata": {}}
 Handler = namedtuple('Handler', ['filterFn', 'handlerFn', 'name', 'id', 'isBlocking'])
-dispatchTable = defaultdict(list)
+dispatchTables = defaultdict(lambda: defaultdict(list))  # one dispatch table per repository
+
+
+def getDispatchTable():
+    return dispatchTables[currentRepo()]
+
+
+def repoName():
+    return '/'.join(currentRepo())
+
+
+def pendingEventCounts():
+    counts = {}
+    for repo in getRepos():
+        with repoContext(repo):
+            counts[(repoName(), )] = len(
+                kube.state.list(
+                    f'kind=GitHubEvent,status=pending,org={env.CD_GITHUB_ORG_NAME},repo={env.CD_GITHUB_REPO_NAME}'))
+    return counts
+
+
+metrics.Gauge('quickcd_events_pending', 'Events saved and waiting for handlers.', ['repo'], fn=pendingEventCounts)
+
+
+filterIndexes = {}  # (repo, event type) -> FilterIndex of its handlers
+matchCache = OrderedDict()  # (repo, event id) -> handlers whose filters match the event
+matchLock = threading.Lock()
+MATCH_CACHE_SIZE = 10000
+saveLock = threading.Lock()  # webhook deliveries are saved from the server's threads, events from the pollers'
+lastPolled = {}  # repo -> when the last poll that got through started
+
+
+# the handlers for an event, an event is checked many times while it's pending so the result is kept by event id
+def matchingHandlers(event):
+    key = (currentRepo(), event.get('id'))
+    if key[1] is not None:
+        with matchLock:
+            if key in matchCache:
+                matchCache.move_to_end(key)
+                return matchCache[key]
+
+    index = filterIndexes.get((currentRepo(), event['type']))
+    if index is None:
+        index = filterIndexes[(currentRepo(), event['type'])] = FilterIndex(getDispatchTable()[event['type']])
+    handlers = index.match(event['payload'])
+
+    if key[1] is not None:
+        with matchLock:
+            matchCache[key] = handlers
+            while len(matchCache) > MATCH_CACHE_SIZE:
+                matchCache.popitem(last=False)
+    return handlers
 
 
 # this routine makes sure that we locally are up to date with all of the events that exist on github
 def fetchAndSaveNewEvents():
-    # todo: respect the x-poll-interval header
+    # how often this is called is up to ratelimit.rateBudget, which respects the x-poll-interval header
     # first run don't save anything, second run, even if no id saved previously, save all
+    pollStart = time.time()
     try:
-        resource = json.loads(sh(f"kubectl -n {env.CD_NAMESPACE} get ConfigMap {getFullName('event-cursor')} -ojson"))
+        resource = kube.state.get(getFullName('event-cursor'))
     except:
         firstRun = True
         fetchedETag = '"none"'
@@ -29,41 +87,29 @@ def fetchAndSaveNewEvents():
     newEventID = fetchedEventID
 
     url = env.CD_REPO_API_URL + '/events'
-    events = []
-    for i in range(15):  # Current GH limit is 10 pages
-        if i > 10:
-            raise Exception("Github only provides 10 pages of results, something's wrong with pagination.")
-
-        resp = http.request(
-            'GET',
-            url,
-            headers=dict(http.headers, **{'If-None-Match': fetchedETag}) if i == 0 and not firstRun else http.headers)
-
-        if resp.status == 304:
-            print("Fetching events 304 (nothing new)")
-            return
-        else:
-            checkResponse(resp)
-
-        print(f"Processing page {i+1}")
-
-        if i == 0 and 'ETag' in resp.headers:
-            newETag = resp.headers['ETag']
-
-        tmpEvents = json.loads(resp.data.decode('utf-8'))
-        tmpEventsFiltered = [e for e in tmpEvents if int(e['id']) > fetchedEventID]
-        events += tmpEventsFiltered
-        if len(tmpEvents) != len(tmpEventsFiltered):
-            break  # already reached event we saved last
-
-        if firstRun:
-            break  #during first run only want latest id
-
-        linkKey = '; rel="next"'
-        if 'Link' in resp.headers and linkKey in resp.headers['Link']:
-            url = resp.headers['Link'].split(linkKey)[0].split(',').pop().strip('< >')
-        else:
-            break
+    resp = fetchPage(url, None if firstRun else fetchedETag)
+    if resp.status == 304:
+        print("Fetching events 304 (nothing new)")
+        lastPolled[currentRepo()] = pollStart
+        return
+    print("Processing page 1")
+    if 'ETag' in resp.headers:
+        newETag = resp.headers['ETag']
+    events, reachedCursor = eventsAfter(resp, fetchedEventID)
+    pages = 1
+
+    # during first run only want latest id
+    if not firstRun and not reachedCursor:
+        parallelism = int(env.CD_EVENT_PAGE_PARALLELISM)
+        remaining, pages = fetchRemainingPages(resp, fetchedEventID, parallelism)
+        # new events push older ones onto later pages, if that happened while we fetched pages out of order
+        # some may have slipped past us, one at a time they can only show up twice which we deal with below
+        # a 304 doesn't count against the rate limit so checking is cheap
+        if remaining and parallelism > 1 and fetchPage(url, newETag).status != 304:
+            print("New events came in while fetching pages, fetching them again one at a time.")
+            remaining, pages = fetchRemainingPages(resp, fetchedEventID, 1)
+        events += remaining
+    metrics.pollPages.observe(pages, repo=repoName())
 
     if events:
         newEventID = int(
@@ -74,54 +120,142 @@ def fetchAndSaveNewEvents():
     # only save events on subsequent runs
     if not firstRun:
         # get rid of duplicates and filter
-        eventDict = dict(
-            (e['id'], e) for e in events if any(handler.filterFn(e['payload']) for handler in dispatchTable[e['type']]))
+        eventDict = dict((e['id'], e) for e in events if matchingHandlers(e))
 
         if eventDict:
-            # use apply in case this command worked but saving cursor failed, resulting in resave
-            # todo: not sure why yapf is using 3 space indenting here and below
-            sh(f'kubectl -n {env.CD_NAMESPACE} apply -f-',
-               input=json.dumps(
-                   dict(
-                       kubeList,
-                       items=[
-                           dict(
-                               kubeConfigMap,
-                               metadata={
-                                   'name': getFullName(e['id']),
-                                   'labels': {
-                                       'owner': 'quickcd',
-                                       'kind': 'GitHubEvent',
-                                       'org': env.CD_GITHUB_ORG_NAME,
-                                       'repo': env.CD_GITHUB_REPO_NAME,
-                                       'status': 'pending'
-                                   }
-                               },
-                               data={'event': json.dumps(e, ensure_ascii=False, allow_nan=False)})
-                           for e in eventDict.values()
-                       ]),
-                   ensure_ascii=False,
-                   allow_nan=False))
-
+            # existing ones are left alone in case this worked but saving cursor failed, resulting in resave
+            saveEvents(eventDict.values(), source='poll')
+
+    cursor = dict(
+        kubeConfigMap,
+        metadata={
+            'name': getFullName('event-cursor'),
+            'labels': {
+                'owner': 'quickcd'
+            }
+        },
+        data={
+            'eventID': str(newEventID),
+            'ETag': newETag
+        })
     # below we use create for first run to make sure we don't accidentally override a config that existed but failed to load above
-    sh(f"kubectl -n {env.CD_NAMESPACE} {'create --save-config' if firstRun else 'apply'} -f-",
-       input=json.dumps(
-           dict(
-               kubeConfigMap,
-               metadata={
-                   'name': getFullName('event-cursor'),
-                   'labels': {
-                       'owner': 'quickcd'
-                   }
-               },
-               data={
-                   'eventID': str(newEventID),
-                   'ETag': newETag
-               }),
-           ensure_ascii=False,
-           allow_nan=False))
+    if firstRun:
+        kube.createConfigMap(cursor)
+    else:
+        kube.applyConfigMap(cursor)
+    lastPolled[currentRepo()] = pollStart
+
+
+# with an etag GitHub answers 304 if the page is unchanged
+# transient errors are retried like any other GitHub call, see common.request
+def fetchPage(url, etag=None):
+    headers = dict(http.headers, **{'If-None-Match': etag}) if etag else http.headers
+    return request('GET', url, headers=headers, allowed=(304, ))
+
+
+# events on the page newer than eventID, and whether the page went back as far as eventID
+def eventsAfter(resp, eventID):
+    pageEvents = json.loads(resp.data.decode('utf-8'))
+    newer = [e for e in pageEvents if int(e['id']) > eventID]
+    return newer, len(newer) != len(pageEvents)
+
+
+# urls of the pages after this one, all of them if the Link header says where the last one is, else just the next
+def pageURLs(resp):
+    links = dict((rel, link) for link, rel in re.findall(r'<([^>]+)>;\s*rel="(\w+)"', resp.headers.get('Link', '')))
+    if 'next' not in links:
+        return []
+    pageNumber = re.compile(r'([?&]page=)(\d+)')
+    if 'last' not in links or not pageNumber.search(links['next']) or not pageNumber.search(links['last']):
+        return [links['next']]
+    first, last = (int(pageNumber.search(links[rel]).group(2)) for rel in ('next', 'last'))
+    return [pageNumber.sub(lambda m: m.group(1) + str(page), links['last']) for page in range(first, last + 1)]
+
+
+# fetches the pages after firstPage, parallelism at a time, until one goes back as far as eventID
+# results are handled in page order so events come out newest first, as they would one page at a time
+# returns the events and the number of the last page looked at
+def fetchRemainingPages(firstPage, eventID, parallelism):
+    events, urls, page, reachedCursor = [], pageURLs(firstPage), 1, False
+    fetch = inCurrentContext(fetchPage)
+    with ThreadPoolExecutor(parallelism) as pool:
+        while urls and not reachedCursor:
+            wave, urls = urls[:parallelism], urls[parallelism:]
+            for resp in pool.map(fetch, wave):
+                page += 1
+                if page > 11:  # Current GH limit is 10 pages
+                    raise Exception("Github only provides 10 pages of results, something's wrong with pagination.")
+                print(f"Processing page {page}")
+                pageEvents, reachedCursor = eventsAfter(resp, eventID)
+                events += pageEvents
+                if reachedCursor:
+                    break
+            if not urls and not reachedCursor:
+                urls = pageURLs(resp)
+    return events, page
+
+
+# saves events as pending ConfigMaps, skipping any that were already saved
+# an event that arrives both by webhook and by polling is only saved the first time, see dedupKey
+def saveEvents(events, source):
+    newEvents = []
+    with saveLock:
+        for e in events:
+            eventLabels = dict(
+                owner='quickcd',
+                kind='GitHubEvent',
+                org=env.CD_GITHUB_ORG_NAME,
+                repo=env.CD_GITHUB_REPO_NAME,
+                status='pending',
+                source=source)
+            key = dedupKey(e)
+            if key:
+                twin = unpairedTwin(key, source)
+                if twin:
+                    kube.patchLabels(twin['metadata']['name'], {'paired': 'true'})
+                    continue
+                eventLabels['dedup'] = key
+            newEvents.append(
+                dict(
+                    kubeConfigMap,
+                    metadata={
+                        'name': getFullName(e['id']),
+                        'labels': eventLabels
+                    },
+                    data={'event': json.dumps(e, ensure_ascii=False, allow_nan=False)}))
+        created = kube.createConfigMaps(newEvents)
+    metrics.eventsSaved.inc(len(created), repo=repoName(), source=source)
+    return created
+
+
+# the same event saved from the other source that hasn't been matched with one from ours yet
+# an event only pairs up once, so the same thing happening twice, like a PR closed, reopened and closed, is kept
+# events saved before there were sources came from polling
+def unpairedTwin(key, source):
+    selector = f'kind=GitHubEvent,org={env.CD_GITHUB_ORG_NAME},repo={env.CD_GITHUB_REPO_NAME},dedup={key}'
+    for r in kube.state.list(selector):
+        labels = r['metadata']['labels']
+        if labels.get('source', 'poll') != source and 'paired' not in labels:
+            return r
+    return None
+
+
+# identifies an event the same way whether it came from the events api or a webhook, None if we can't tell
+def dedupKey(e):
+    payload = e['payload']
+    if e['type'] == 'PushEvent':
+        parts = [payload.get('ref'), payload.get('before'), payload.get('head')]
+    elif e['type'] == 'PullRequestEvent':
+        parts = [payload.get('number'), payload.get('action'), payload['pull_request']['head']['sha']]
+    elif 'comment' in payload:
+        parts = [payload['comment']['id'], payload.get('action', 'created')]
+    else:
+        return None
+    parts = [env.CD_GITHUB_ORG_NAME, env.CD_GITHUB_REPO_NAME, e['type']] + parts
+    return hashlib.sha1(json.dumps(parts).encode('utf-8')).hexdigest()
 
 
+# filterFn is either a function of the payload or a declarative filter, see filters.py
 def registerEventHandler(eventType, fn, filterFn=lambda e: True, blocking=True):
     def filterWrapper(e):
         try:
@@ -130,7 +264,12 @@ def registerEventHandler(eventType, fn, filterFn=lambda e: True, blocking=True):
             return False
 
     id = 'handler-' + b32encode(fn.__name__.encode()).decode().replace('=', '-').lower()[::-1]
-    dispatchTable[eventType].append(Handler(filterWrapper, fn, fn.__name__, id, blocking))
+    compiled = Filter(filterFn) if isinstance(filterFn, str) else filterWrapper
+    getDispatchTable()[eventType].append(Handler(compiled, fn, fn.__name__, id, blocking))
+    with matchLock:
+        filterIndexes.pop((currentRepo(), eventType), None)
+        for key in [key for key in matchCache if key[0] == currentRepo()]:
+            del matchCache[key]
     print(f"Added handler {fn.__name__} for event {eventType}")
     return fn
 
@@ -156,76 +295,242 @@ def registerEventHandlerDecorator(eventType, filterFn=lambda e: True):
 
 
 # return True if any work was done, execution or cleanup wise, and False if nothing to do
+# all reads here are answered from the local mirror of quickcd's ConfigMaps, only writes go to the api
 def processNextEvent():
-    maxEventId = int(
-        json.loads(sh(f'kubectl -n {env.CD_NAMESPACE} get configmap -ojson ' +
-                      getFullName('event-cursor')))['data']['eventID'])
-    events = sh(
-        f"kubectl -n {env.CD_NAMESPACE} get configmaps -o=jsonpath='{{.items[*].metadata.name}}'" +
-        f" -lowner=quickcd,kind=GitHubEvent,status=pending,org={env.CD_GITHUB_ORG_NAME},repo={env.CD_GITHUB_REPO_NAME}"
-    ).strip()
-    if not events:
-        return False
-    eventIds = [eid for eid in (int(e.split('-').pop()) for e in events.split(' ')) if eid <= maxEventId]
+    workPerformed = collectFinishedHandlers()
+    try:
+        maxEventId = int(kube.state.get(getFullName('event-cursor'))['data']['eventID'])
+    except kube.KubeError:
+        return workPerformed  # first run, the first poll hasn't saved the cursor yet
+    eventResources = kube.state.list(
+        f'kind=GitHubEvent,status=pending,org={env.CD_GITHUB_ORG_NAME},repo={env.CD_GITHUB_REPO_NAME}')
+    # webhook deliveries are saved ahead of the cursor so they're exempt from that check
+    pendingEvents = dict((e['id'], (e, r['metadata']['labels']))
+                         for e, r in ((json.loads(r['data']['event']), r) for r in eventResources)
+                         if r['metadata']['labels'].get('source') == 'webhook' or int(e['id']) <= maxEventId)
+    if not pendingEvents:
+        return workPerformed
+    inOrder = sorted(pendingEvents, key=lambda eid: eventOrder(pendingEvents[eid][0]))
 
     # run nonblocking handlers first if we can
-    for eid in eventIds:
-        eventResource = json.loads(sh(f'kubectl -n {env.CD_NAMESPACE} get configmap -o=json ' + getFullName(eid)))
-        if runHandlers(json.loads(eventResource['data']['event']), False, eid, eventResource['metadata']['labels']):
-            return True
-
-    earliestEventId = min(eventIds)
-    eventResource = json.loads(
-        sh(f'kubectl -n {env.CD_NAMESPACE} get configmap -o=json ' + getFullName(earliestEventId)))
-    return runHandlers(
-        json.loads(eventResource['data']['event']), True, earliestEventId, eventResource['metadata']['labels'])
+    # with a worker pool these only get queued, so queue up as many as the pool will take
+    for eid in inOrder:
+        event, labels = pendingEvents[eid]
+        if runHandlers(event, False, eid, labels):
+            workPerformed = True
+            if not workerCount():
+                return True
+
+    # blocking handlers run in the order events happened
+    # the first event that still has blocking work gates all later ones
+    blockedEvents = [eid for eid in inOrder if remainingHandlers(*pendingEvents[eid], True)]
+    if not blockedEvents:
+        return workPerformed
+    earliestEventId = blockedEvents[0]
+    event, labels = pendingEvents[earliestEventId]
+    # a webhook event waits for a poll that started after it came in, so that earlier events only polling
+    # knows about, like ones whose delivery failed, get saved and go first
+    if labels.get('source') == 'webhook' and lastPolled.get(currentRepo(), 0) < event.get('received_at', 0):
+        return workPerformed
+    return runHandlers(event, True, earliestEventId, labels) or workPerformed
+
+
+def remainingHandlers(event, labels, blocking=None):
+    return [
+        handler for handler in matchingHandlers(event)
+        if (blocking is None or handler.isBlocking == blocking) and handler.id not in labels
+    ]
 
 
 def runHandlers(event, blocking, eventID=0, labels={}):
     # now that we have the event of interest, fire all the (remaining) event handlers for it.
     workPerformed = False
-    for handler in dispatchTable[event['type']]:
-        if handler.isBlocking == blocking and handler.filterFn(event['payload']) and handler.id not in labels:
-            if eventID:
-                lastRun = float(labels.get(f'{handler.id}_last_run', '0'))
-                attempts = int(labels.get(f'{handler.id}_attempts', '0'))
-                if (time.time() - lastRun) / 60 < attempts**3:
-                    continue
-                writeLabels(eventID, **{f'{handler.id}_last_run': time.time(), f'{handler.id}_attempts': attempts + 1})
-            workPerformed = True
-            # reset workspace and call handler
-            sh('rm -rf /tmp')
-            sh('mkdir -m 777 /tmp')
-            os.chdir('/tmp')
-            setCurrentHandlerFnName(handler.name)
-            print(f"Event {eventID}. Calling handler: {handler.name}")
-            try:
-                handler.handlerFn(event['payload'])
-            except:
-                print(traceback.format_exc())
-                if blocking:
-                    return True  # don't run other handlers for this event since encountered an error
-                else:
-                    continue  # run remaining nonblocking handlers for this evt
-            if eventID:
-                writeLabels(eventID, **{f'{handler.id}': 'complete'})
-
-    # check if any handlers remaining and mark complete if not
+    for handler in remainingHandlers(event, labels, blocking):
+        inWorker = eventID and not blocking and workerCount()
+        if eventID:
+            if (currentRepo(), eventID, handler.id) in runningHandlers:
+                continue
+            if inWorker and len(runningHandlers) >= workerCount():
+                break  # pool is busy, we'll get back to this once something finishes
+            lastRun = float(labels.get(f'{handler.id}_last_run', '0'))
+            attempts = int(labels.get(f'{handler.id}_attempts', '0'))
+            if (time.time() - lastRun) / 60 < attempts**3:
+                continue
+            writeLabels(eventID, **{f'{handler.id}_last_run': time.time(), f'{handler.id}_attempts': attempts + 1})
+        workPerformed = True
+
+        if inWorker:
+            print(f"Event {eventID}. Queueing handler: {handler.name}")
+            runningHandlers[(currentRepo(), eventID, handler.id)] = (getWorkerPool().apply_async(
+                runHandlerInWorker, (currentRepo(), event['type'], handler.id, event['payload'], eventID),
+                callback=lambda result: wake(),
+                error_callback=lambda e: wake()), event)
+            continue
+
+        print(f"Event {eventID}. Calling handler: {handler.name}")
+        try:
+            callHandler(handler, event['payload'], eventID)
+        except:
+            print(traceback.format_exc())
+            if blocking:
+                return True  # don't run other handlers for this event since encountered an error
+            else:
+                continue  # run remaining nonblocking handlers for this evt
+        if eventID:
+            writeLabels(eventID, **{f'{handler.id}': 'complete'})
+
     if eventID:
-        allDone = True
-        for handler in dispatchTable[event['type']]:
-            if handler.filterFn(event['payload']) and handler.id not in labels:
-                allDone = False
-                break
-        if allDone:
-            writeLabels(eventID, status='handled')
+        markHandledIfDone(event, eventID)
 
     return workPerformed
 
 
+# check if any handlers remaining and mark complete if not
+def markHandledIfDone(event, eventID):
+    if not remainingHandlers(event, readLabels(eventID)):
+        writeLabels(eventID, status='handled')
+        metrics.eventsHandled.inc(repo=repoName())
+
+
+# every handler run gets a fresh workspace as its working directory, which is removed in the background afterwards
+def callHandler(handler, payload, eventID=0):
+    workspace = newWorkspace(f'{eventID}-{handler.name}')
+    os.chdir(workspace)
+    setHandlerContext(handler.name, eventID, workspace)
+    try:
+        sampleRate = float(env.CD_TRACE_SAMPLE_RATE)
+        with tracing.trace(handler.name, save=saveTrace, sampleRate=sampleRate, repo=repoName(), eventID=eventID):
+            try:
+                with metrics.handlerDuration.time(repo=repoName(), handler=handler.name, outcome='failure') as labels:
+                    handler.handlerFn(payload)
+                    labels['outcome'] = 'success'
+            finally:
+                with tracing.span('flush logs', 'log'):
+                    # whatever happened, make sure the log in GitHub is complete
+                    # updates held back for the rate limit go out after the trace is saved, so they're only counted
+                    deferred = flushLogs()
+                    if deferred:
+                        tracing.annotate(deferredSends=deferred)
+    finally:
+        setHandlerContext(None)
+        os.chdir(env.CD_WORKSPACE_ROOT)
+        removeInBackground(workspace)
+        pruneArtifacts(ARTIFACT_PRUNE_INTERVAL)
+
+
+def saveTrace(trace):
+    path, link = newArtifact(f'{trace.name}-trace', extension='json')
+    with open(path, 'w') as f:
+        json.dump(trace.export(), f)
+    print(f'Trace of {trace.name}: {link or path}')
+
+
+workerPool = None
+startedHandlers = None  # workers tell us which of them runs what, (repo, eventID, handler id, pid)
+runningHandlers = {}  # (repo, eventID, handler id) -> (AsyncResult, event)
+handlerPids = {}  # (repo, eventID, handler id) -> pid of the worker running it
+
+
+def workerCount():
+    return int(env.CD_WORKERS)
+
+
+# best called early, before any background threads are started, since the workers are forked
+def getWorkerPool():
+    global workerPool, startedHandlers
+    if workerPool is None and workerCount():
+        startedHandlers = multiprocessing.get_context('fork').SimpleQueue()
+        workerPool = multiprocessing.get_context('fork').Pool(workerCount(), initializer=initWorker)
+    return workerPool
+
+
+def initWorker():
+    # connections are shared with the parent after fork, make sure we open our own
+    http.clear()
+    kube.afterFork()
+    metrics.drain()  # the parent's, we only send back what we record ourselves
+    # the main process decides when to stop, it waits for us to finish
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+
+# runs inside a worker process, the handler is looked up in the dispatch table inherited from the main process
+# returns whether it succeeded, the error if not, and the metrics recorded meanwhile
+def runHandlerInWorker(repo, eventType, handlerID, payload, eventID):
+    startedHandlers.put((repo, eventID, handlerID, os.getpid()))
+    with repoContext(repo):
+        handler = next(handler for handler in getDispatchTable()[eventType] if handler.id == handlerID)
+        print(f"Event {eventID}. Calling handler: {handler.name}")
+        try:
+            callHandler(handler, payload, eventID)
+        except:
+            return False, traceback.format_exc(), metrics.drain()
+        return True, None, metrics.drain()
+
+
+# record results of handlers that finished in the pool, returns True if any did
+def collectFinishedHandlers():
+    # a worker that dies (the OOM killer, a segfault) takes its handler with it and the pool never says so,
+    # the pool only starts a new worker, so we look for handlers whose worker is gone and count them as failed
+    while startedHandlers is not None and not startedHandlers.empty():
+        repo, eventID, handlerID, pid = startedHandlers.get()
+        if (repo, eventID, handlerID) in runningHandlers:
+            handlerPids[(repo, eventID, handlerID)] = pid
+    alive = set(process.pid for process in multiprocessing.active_children())
+    finished = [(key, result, event) for key, (result, event) in runningHandlers.items()
+                if result.ready() or key in handlerPids and handlerPids[key] not in alive]
+    for (repo, eventID, handlerID), result, event in finished:
+        del runningHandlers[(repo, eventID, handlerID)]
+        pid = handlerPids.pop((repo, eventID, handlerID), None)
+        try:
+            if not result.ready():
+                raise Exception(f'Worker {pid} died while running handler {handlerID} of event {eventID}')
+            ok, error, recorded = result.get()
+        except:
+            ok, error, recorded = False, traceback.format_exc(), None
+        metrics.merge(recorded)
+        with repoContext(repo):
+            if ok:
+                writeLabels(eventID, **{handlerID: 'complete'})
+            else:
+                print(error)
+            markHandledIfDone(event, eventID)
+    return bool(finished)
+
+
+# wait for all handlers running in the pool to finish, used for a graceful shutdown
+# handlers still running after CD_DRAIN_TIMEOUT seconds are stopped, they're retried once we're back
+def drainWorkers():
+    if workerPool is not None:
+        print(f'Waiting for {len(runningHandlers)} running handler(s) to finish.')
+        workerPool.close()
+        deadline = time.time() + float(env.CD_DRAIN_TIMEOUT)
+        while runningHandlers and time.time() < deadline:
+            result, event = next(iter(runningHandlers.values()))
+            result.wait(max(0, min(1, deadline - time.time())))
+            collectFinishedHandlers()
+        if runningHandlers:
+            print(f'Stopping {len(runningHandlers)} handler(s) still running after {env.CD_DRAIN_TIMEOUT}s.')
+        # join alone would wait forever on the results of workers that died
+        workerPool.terminate()
+        workerPool.join()
+
+
 def hasHandlers():
-    return len(dispatchTable) != 0
+    return any(len(dispatchTable) != 0 for dispatchTable in dispatchTables.values())
+
+
+# eventHandlers is loaded once for every repository, with env set up for that repository,
+# so each one ends up with its own dispatch table
+def loadHandlers():
+    for i, repo in enumerate(getRepos()):
+        with repoContext(repo):
+            if i == 0:
+                importlib.import_module('eventHandlers')
+            else:
+                spec = importlib.util.find_spec('eventHandlers')
+                spec.loader.exec_module(importlib.util.module_from_spec(spec))
 
 
 # at the end since handlers imports this file also, process handler registrations via decorators
-import eventHandlers
+loadHandlers()
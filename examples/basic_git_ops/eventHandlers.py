@@ -1,4 +1,4 @@
-import json
+import json, gitcache
 from events import registerEventHandler as addHandler
 from common import newCommitLogger, env, newLoggingShell, setCommitStatus, BuildStatus, GET
 from emailClient import sendEmail
@@ -19,7 +19,8 @@ if env.CD_ENVIRONMENT == 'development':
         commits = [c['commit'] for c in GET(e['commits_url'])]
 
         # fetch the repo and merge in changes from PR
-        sh(f'git clone -b {e["base"]["ref"]} {env.CD_REPO_URL} .')
+        # gitcache clones from a local mirror of the repo, which is a lot quicker than cloning from GitHub
+        gitcache.clone(sh, branch=e['base']['ref'], commits=[e['base']['sha'], e['head']['sha']])
         try:
             if e['head']['repo']['fork']:
                 sh(f'git pull --no-edit --no-ff {e["head"]["repo"]["ssh_url"]} {e["head"]["ref"]}')
@@ -40,17 +41,17 @@ elif env.CD_ENVIRONMENT == 'staging':
         log('Event', json.dumps(e, ensure_ascii=False, allow_nan=False, indent=2, sort_keys=True))
 
         # fetch repo and checkout the commit that this event is for
-        sh(f'git clone {env.CD_REPO_URL} .')
+        gitcache.clone(sh, commits=[e['head']])
         sh(f'git checkout {e["head"]}')
 
         pass  # logic to deploy to staging, or call common function
 
-    addHandler('PushEvent', pushToStaging, filterFn=lambda e: e['ref'] == 'refs/heads/staging')
+    addHandler('PushEvent', pushToStaging, filterFn="ref == 'refs/heads/staging'")
 
 elif env.CD_ENVIRONMENT == 'production':
 
     def pushToProduction(e):
         pass  # logic to deploy to production, or call common function
 
-    addHandler('PushEvent', pushToProduction, filterFn=lambda e: e['ref'] == 'refs/heads/production')
+    addHandler('PushEvent', pushToProduction, filterFn="ref == 'refs/heads/production'")
 
@@ -1,6 +1,6 @@
-import traceback, json
+import traceback, db, kube
 from events import addBlockingHandler, addNonBlockingHandler
-from common import env, setCommitStatus, BuildStatus, getJSON, getFullName, newCommitLogger, newLoggingShell
+from common import env, setCommitStatus, BuildStatus, getJSON, newCommitLogger, newLoggingShell, getFullName
 from charts import Chart, DeployableDiff
 from emailClient import sendEmail
 
@@ -11,11 +11,41 @@ from emailClient import sendEmail
 
 def cmdSkip(commit, sh, log):
     '''Skip deploying this commit. One use for this is to stop trying to deploy a commit that will never succeed.'''
-    obj = {"apiVersion": "v1", "data": {}, "kind": "ConfigMap", "metadata": {"name": getFullName(f'skip-{commit}')}}
-    sh(f'kubectl -n {env.CD_NAMESPACE} apply -f-', input=json.dumps(obj, ensure_ascii=False, allow_nan=False))
+    db.put(f'skip/{commit}', True)
     log(f'Future deploy attempts for {commit} will be skipped.')
 
 
+def isSkipped(commit):
+    migrateSkipMarkers()
+    return db.get(f'skip/{commit}', False)
+
+
+# skip markers used to be ConfigMaps of their own, unlike db they aren't in kube.state so reading them is a round trip
+# they're moved into db the first time a process checks for one, not on import since the kube config
+# is only set up after the handlers are loaded
+migratedPrefixes = set()
+
+
+def migrateSkipMarkers():
+    prefix = getFullName('skip-')
+    if prefix in migratedPrefixes:
+        return
+    names = [
+        item['metadata']['name'] for item in kube.listConfigMapsMetadata('')['items']
+        if item['metadata']['name'].startswith(prefix)
+    ]
+    with db.batch():
+        for name in names:
+            db.put(f'skip/{name[len(prefix):]}', True)
+    for name in names:
+        try:
+            kube.deleteConfigMap(name)
+        except kube.KubeError as e:
+            if not kube.isNotFound(e):  # not found means another worker migrating at the same time got there first
+                raise
+    migratedPrefixes.add(prefix)
+
+
 def cmdRedeploy(commit, sh, log):
     '''Redeploy the given commit'''  # doesn't seem to be an easy way to tell which PR a PR commit belongs to
     pass  # todo
@@ -57,12 +87,11 @@ if env.CD_ENVIRONMENT == 'development':
         else:
             processDiff(diff)
 
-    def filterStagingAndOpened(e):
-        return e['pull_request']['base']['ref'] == 'staging' and e['action'] in ['opened', 'reopened']
-
-    addNonBlockingHandler('PullRequestEvent', PRToStaging, filterFn=filterStagingAndOpened)
     addNonBlockingHandler(
-        'CommitCommentEvent', quickCommand, filterFn=lambda e: e['comment']['body'].startswith('/quickcd'))
+        'PullRequestEvent',
+        PRToStaging,
+        filterFn="pull_request.base.ref == 'staging' and action in ['opened', 'reopened']")
+    addNonBlockingHandler('CommitCommentEvent', quickCommand, filterFn="comment.body startswith '/quickcd'")
 
 elif env.CD_ENVIRONMENT == 'staging':
 
@@ -70,9 +99,8 @@ elif env.CD_ENVIRONMENT == 'staging':
         diff = DeployableDiff.createFromMerge(e)
         processDiff(diff)
 
-    addBlockingHandler('PushEvent', pushToStaging, filterFn=lambda e: e['ref'] == 'refs/heads/staging')
-    addNonBlockingHandler(
-        'CommitCommentEvent', quickCommand, filterFn=lambda e: e['comment']['body'].startswith('/quickcd'))
+    addBlockingHandler('PushEvent', pushToStaging, filterFn="ref == 'refs/heads/staging'")
+    addNonBlockingHandler('CommitCommentEvent', quickCommand, filterFn="comment.body startswith '/quickcd'")
 
 elif env.CD_ENVIRONMENT == 'production':
 
@@ -80,15 +108,12 @@ elif env.CD_ENVIRONMENT == 'production':
         diff = DeployableDiff.createFromMerge(e)
         processDiff(diff)
 
-    addBlockingHandler('PushEvent', pushToProduction, filterFn=lambda e: e['ref'] == 'refs/heads/production')
-    addNonBlockingHandler(
-        'CommitCommentEvent', quickCommand, filterFn=lambda e: e['comment']['body'].startswith('/quickcd'))
+    addBlockingHandler('PushEvent', pushToProduction, filterFn="ref == 'refs/heads/production'")
+    addNonBlockingHandler('CommitCommentEvent', quickCommand, filterFn="comment.body startswith '/quickcd'")
 
 
 def processDiff(diff):
-    if len(
-            diff.sh(f'kubectl -n {env.CD_NAMESPACE} get ConfigMap --ignore-not-found ' +
-                    getFullName(f'skip-{diff.head}'))):
+    if isSkipped(diff.head):
         diff.log('Skipping this commit.')
         return
 
@@ -0,0 +1,112 @@
+"""
+Declarative event filters, which can be given instead of a function as the filterFn of a handler:
+addBlockingHandler('PushEvent', deploy, "ref == 'refs/heads/production'")
+addNonBlockingHandler('CommitCommentEvent', command, "comment.body startswith '/quickcd'")
+addNonBlockingHandler('PullRequestEvent', build, "pull_request.base.ref == 'staging' and action in ['opened', 'reopened']")
+
+A filter is one or more `field op value` clauses joined by `and`. field is a dotted path into the event payload,
+value is a Python literal and op is one of the operators below. A clause on a field the payload doesn't have is false.
+Handlers are indexed on the field of their first == or in clause, so events only get checked against the handlers
+that can match them. Functions still work as filters, they're checked against every event of their type.
+"""
+import ast, re
+
+operators = {
+    '==': lambda actual, value: actual == value,
+    '!=': lambda actual, value: actual != value,
+    'in': lambda actual, value: actual in value,
+    'contains': lambda actual, value: value in actual,
+    'startswith': lambda actual, value: actual.startswith(value),
+    'endswith': lambda actual, value: actual.endswith(value),
+    'matches': lambda actual, value: re.search(value, actual) is not None,
+}
+clausePattern = re.compile(r'''\s*([\w.]+)\s+(==|!=|in|contains|startswith|endswith|matches)\s+''' +
+                           r'''('(?:[^'\\]|\\.)*'|"(?:[^"\\]|\\.)*"|\[[^\]]*\]|\([^)]*\)|[-+\w.]+)\s*(?:(and)\s+|$)''')
+missing = object()
+
+
+def field(payload, path):
+    for key in path:
+        if not isinstance(payload, dict) or key not in payload:
+            return missing
+        payload = payload[key]
+    return payload
+
+
+def hashable(value):
+    try:
+        hash(value)
+    except TypeError:
+        return False
+    return True
+
+
+class Filter:
+    def __init__(self, source):
+        self.source = source
+        self.clauses = []  # (path, op, value)
+        position = 0
+        while True:
+            match = clausePattern.match(source, position)
+            if not match:
+                raise ValueError(f'Invalid filter "{source}", can\'t make sense of "{source[position:]}".')
+            path, op, literal, conjunction = match.groups()
+            try:
+                value = ast.literal_eval(literal)
+            except (ValueError, SyntaxError):
+                raise ValueError(f'Invalid filter "{source}", {literal} is not a Python literal, quote strings.')
+            self.clauses.append((tuple(path.split('.')), op, value))
+            position = match.end()
+            if not conjunction:
+                break
+
+    # like other filterFns this never raises, a clause that can't be evaluated is false
+    def __call__(self, payload):
+        for path, op, value in self.clauses:
+            actual = field(payload, path)
+            try:
+                if actual is missing or not operators[op](actual, value):
+                    return False
+            except Exception:
+                return False
+        return True
+
+    # the field this filter can be looked up by and the values it matches, None if there isn't one
+    def indexKey(self):
+        for path, op, value in self.clauses:
+            if op == '==' and hashable(value):
+                return path, [value]
+            if op == 'in' and isinstance(value, (list, tuple, set)) and all(hashable(v) for v in value):
+                return path, list(value)
+        return None
+
+    def __repr__(self):
+        return f'Filter({self.source!r})'
+
+
+class FilterIndex:
+    """
+    The handlers for one event type, indexed by the fields their filters look up.
+    match returns the handlers whose filters match a payload, in the order they were registered.
+    """
+
+    def __init__(self, handlers):
+        self.handlers = handlers
+        self.byField = {}  # path -> value -> positions of handlers
+        self.unindexed = []  # positions of handlers with no index key, checked for every event
+        for position, handler in enumerate(handlers):
+            key = handler.filterFn.indexKey() if isinstance(handler.filterFn, Filter) else None
+            if key is None:
+                self.unindexed.append(position)
+                continue
+            path, values = key
+            for value in values:
+                self.byField.setdefault(path, {}).setdefault(value, []).append(position)
+
+    def match(self, payload):
+        candidates = set(self.unindexed)
+        for path, handlersByValue in self.byField.items():
+            value = field(payload, path)
+            if value is not missing and hashable(value):
+                candidates.update(handlersByValue.get(value, ()))
+        return [self.handlers[i] for i in sorted(candidates) if self.handlers[i].filterFn(payload)]
@@ -0,0 +1,90 @@
+"""
+Keeps a bare mirror of each repository in CD_GIT_CACHE_DIR so handlers don't have to clone from scratch every time.
+The mirror is updated with an incremental fetch when it's missing something a handler needs, and handler runs get a
+clone that borrows its objects from the mirror, which only takes as long as writing out the working tree.
+CD_GIT_CACHE_DIR is best put on a persistent volume, set it to an empty string to always clone from the remote.
+
+In a handler, instead of `git clone {env.CD_REPO_URL} .`:
+gitcache.clone(sh, commits=[e['head']])
+"""
+import os, fcntl
+from contextlib import contextmanager
+from common import env, sh as plainShell, getFullName, M
+
+
+def mirrorPath():
+    return os.path.join(env.CD_GIT_CACHE_DIR, getFullName('mirror') + '.git')
+
+
+# clones take a shared lock, updates an exclusive one, this works across worker processes as well as threads
+@contextmanager
+def locked(path, exclusive):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + '.lock', 'w') as f:
+        fcntl.flock(f, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def hasCommits(path, commits):
+    try:
+        for commit in commits:
+            plainShell(f'git -C {path} cat-file -e {commit}^{{commit}}')
+    except:
+        return False
+    return True
+
+
+# brings the mirror up to date, unless it already has all the given commits
+def updateMirror(sh=plainShell, commits=()):
+    path = mirrorPath()
+    with locked(path, exclusive=True):
+        if not os.path.isdir(path):
+            # --mirror also gets refs/pull/*, which have the heads and merge previews of pull requests
+            plainShell(f'rm -rf {path}.tmp')
+            sh(f'git clone -q --mirror {env.CD_REPO_URL} {path}.tmp', timeout=60 * M)
+            sh(f'git -C {path}.tmp config gc.auto 0')  # objects must not move while clones are using them
+            os.rename(path + '.tmp', path)
+        elif not commits or not hasCommits(path, commits):
+            sh(f'git -C {path} fetch -q --prune origin', timeout=30 * M)
+
+
+# clones the repository into the current directory, making sure it has the given commits
+# the mirror is only fetched when it's missing one of them, so with a branch pass the commit the branch has to be at,
+# e.g. e['base']['sha'] for a pull request, or the checkout may be an older copy of the branch
+# origin points at the real repository afterwards so pushing etc. works as usual
+def clone(sh=plainShell, branch=None, commits=()):
+    if not env.CD_GIT_CACHE_DIR:
+        sh(f"git clone {f'-b {branch} ' if branch else ''}{env.CD_REPO_URL} .")
+        return
+
+    updateMirror(sh, commits)
+    path = mirrorPath()
+    with locked(path, exclusive=False):
+        sh(f"git clone -q --shared {f'-b {branch} ' if branch else ''}{path} .")
+    sh(f'git remote set-url origin {env.CD_REPO_URL}')
+
+
+# fast forwards to GitHub's preview of merging the pull request into the checked out base branch
+# returns the merge commit, or None if GitHub's preview is missing or out of date
+def checkoutPullMerge(sh, number, head):
+    if not env.CD_GIT_CACHE_DIR:
+        return None
+    try:
+        plainShell(f'git fetch -q {mirrorPath()} refs/pull/{number}/merge')
+    except:
+        return None  # GitHub doesn't make one when there are conflicts
+    parents = plainShell('git rev-list --parents -n1 FETCH_HEAD').split()[1:]
+    if parents != [plainShell('git rev-parse HEAD'), head]:
+        return None
+    sh('git merge -q --ff-only FETCH_HEAD')
+    return plainShell('git rev-parse HEAD')
+
+
+# gc is off in the mirrors, run it while nothing can be using them, e.g. at startup
+def maintain():
+    if env.CD_GIT_CACHE_DIR and os.path.isdir(mirrorPath()):
+        with locked(mirrorPath(), exclusive=True):
+            plainShell(f'git -C {mirrorPath()} -c gc.auto=6700 gc -q --auto', timeout=30 * M)
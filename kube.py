@@ -0,0 +1,505 @@
+"""
+A small Kubernetes API client so that state operations don't need to fork kubectl every time.
+Connections are pooled and kept alive, and the config is read from whatever init.generateKubeconfig sets up.
+Set CD_KUBE_API_URL (e.g. http://localhost:8001) to bypass kubeconfig entirely, useful with `kubectl proxy`
+or when testing against a fake apiserver.
+"""
+import json, os, base64, shutil, tempfile, threading, time, traceback, urllib3, certifi, tracing
+from urllib.parse import urlencode
+from multiprocessing.util import Finalize
+from common import sh, env, ExecutionError
+
+
+class KubeError(Exception):
+    def __init__(self, message, status, body):
+        super().__init__(message)
+        self.status = status
+        self.body = body
+
+
+class KubeClient:
+    def __init__(self, server, token=None, caFile=None, certFile=None, keyFile=None, insecure=False):
+        self.server = server.rstrip('/')
+        self.headers = {'Accept': 'application/json'}
+        if token:
+            self.headers['Authorization'] = f'Bearer {token}'
+
+        tls = {}
+        if self.server.startswith('https'):
+            tls = dict(cert_reqs='CERT_NONE') if insecure else dict(
+                cert_reqs='CERT_REQUIRED', ca_certs=caFile or certifi.where())
+            if certFile:
+                tls.update(cert_file=certFile, key_file=keyFile)
+        self.pool = urllib3.PoolManager(
+            num_pools=2, maxsize=int(os.environ.get('CD_KUBE_POOL_SIZE', '4')), block=False, timeout=30, **tls)
+
+    def request(self,
+                method,
+                path,
+                body=None,
+                query=None,
+                contentType='application/json',
+                timeout=None,
+                accept=None,
+                reauthenticate=True):
+        url = self.server + path + ('?' + urlencode(query) if query else '')
+        headers = dict(self.headers, **({'Accept': accept} if accept else {}))
+        if body is not None:
+            headers['Content-Type'] = contentType
+            body = json.dumps(body, ensure_ascii=False, allow_nan=False).encode('utf-8')
+        with tracing.span(f'{method} {path}', 'kube'):
+            resp = self.pool.request(
+                method, url, body=body, headers=headers, **({'timeout': timeout} if timeout else {}))
+            tracing.annotate(status=resp.status)
+        if resp.status == 401 and reauthenticate and reloadAfterUnauthorized(self):
+            return getClient().request(method, path, body, query, contentType, timeout, accept, reauthenticate=False)
+        if resp.status < 200 or resp.status > 299:
+            raise KubeError(f'Unexpected status from kube api: {resp.status} {method} {path}. Body: {resp.data}',
+                            resp.status, resp.data)
+        return json.loads(resp.data.decode('utf-8')) if resp.data else {}
+
+    # yields (type, object) tuples until the server closes the watch
+    def watch(self, path, query, timeoutSeconds=300):
+        query = dict(query, watch='true', timeoutSeconds=timeoutSeconds, allowWatchBookmarks='true')
+        resp = self.pool.request(
+            'GET',
+            self.server + path + '?' + urlencode(query),
+            headers=self.headers,
+            preload_content=False,
+            timeout=urllib3.Timeout(connect=10, read=timeoutSeconds + 30))
+        try:
+            if resp.status == 401:
+                reloadAfterUnauthorized(self)  # the caller retries with getClient()
+            if resp.status != 200:
+                raise KubeError(f'Unexpected status from kube api watch: {resp.status} {path}. Body: {resp.data}',
+                                resp.status, resp.data)
+            buf = b''
+            for chunk in resp.stream(64 * 1024):
+                buf += chunk
+                *lines, buf = buf.split(b'\n')
+                for line in lines:
+                    if line.strip():
+                        event = json.loads(line.decode('utf-8'))
+                        yield event['type'], event['object']
+        finally:
+            resp.release_conn()
+
+
+def clientFromKubeconfig(config):
+    cluster = config['clusters'][0]['cluster']
+    user = config['users'][0]['user'] if config.get('users') else {}
+    if 'exec' in user:
+        raise Exception('Exec based kube credentials are not supported, use a token or client certificates.')
+
+    # urllib3 wants files for certificates, so inline data from the flattened config is written out
+    # always to the same files, replaced whole so connections being opened never see one half written
+    def dataFile(name, data):
+        path = os.path.join(getCertDir(), name)
+        with open(path + '.new', 'wb') as f:
+            f.write(base64.b64decode(data))
+        os.replace(path + '.new', path)
+        return path
+
+    token = user.get('token') or user.get('auth-provider', {}).get('config', {}).get('id-token')
+    return KubeClient(
+        cluster['server'],
+        token=token,
+        caFile=dataFile('ca.crt', cluster['certificate-authority-data'])
+        if 'certificate-authority-data' in cluster else None,
+        certFile=dataFile('client.crt', user['client-certificate-data'])
+        if 'client-certificate-data' in user else None,
+        keyFile=dataFile('client.key', user['client-key-data']) if 'client-key-data' in user else None,
+        insecure=cluster.get('insecure-skip-tls-verify', False))
+
+
+certDirs = {}  # pid -> where that process keeps client certificates, forked workers load their own config
+
+
+def getCertDir():
+    pid = os.getpid()
+    if pid not in certDirs:
+        certDirs[pid] = tempfile.mkdtemp(prefix='quickcd-kube-')
+        Finalize(None, removeCertDir, (pid, ), exitpriority=0)  # at exit, unlike atexit this also runs in pool workers
+    return certDirs[pid]
+
+
+def removeCertDir(pid):
+    if pid == os.getpid():
+        shutil.rmtree(certDirs.pop(pid), ignore_errors=True)
+
+
+def clientFromServiceAccount():
+    saDir = '/var/run/secrets/kubernetes.io/serviceaccount'
+    with open(f'{saDir}/token') as f:
+        token = f.read().strip()
+    return KubeClient(
+        f"https://{env.KUBERNETES_SERVICE_HOST}:{env.KUBERNETES_SERVICE_PORT}", token=token, caFile=f'{saDir}/ca.crt')
+
+
+client = None
+configLock = threading.RLock()
+loadedMTimes = None  # of the kubeconfig files when they were last read, None if the config didn't come from them
+
+
+# the files kubectl reads its config from
+def kubeconfigPaths():
+    return [path for path in (os.environ.get('KUBECONFIG') or os.path.expanduser('~/.kube/config')).split(os.pathsep) if path]
+
+
+def kubeconfigMTimes():
+    mtimes = []
+    for path in kubeconfigPaths():
+        try:
+            mtimes.append(os.path.getmtime(path))
+        except OSError:
+            mtimes.append(None)
+    return mtimes
+
+
+# init.generateKubeconfig, or kubectl refreshing a token, wrote new credentials since we last read them
+# this is how forked workers pick up the hourly refresh, which only runs in the main process
+def configChanged():
+    return loadedMTimes is not None and kubeconfigMTimes() != loadedMTimes
+
+
+# call after init.generateKubeconfig so the client picks up fresh credentials
+# getClient also calls this by itself whenever the kubeconfig changes or the api server stops accepting a token
+def loadConfig():
+    global client, loadedMTimes
+    with configLock:
+        old = client
+        loadedMTimes = None
+        if 'CD_KUBE_API_URL' in env:
+            client = KubeClient(env.CD_KUBE_API_URL, token=os.environ.get('CD_KUBE_TOKEN'))
+        else:
+            mtimes = kubeconfigMTimes()
+            # flatten + minify gives us just the current context with all certs inlined
+            config = json.loads(sh('kubectl config view --flatten --minify -ojson'))
+            if config.get('clusters'):
+                client = clientFromKubeconfig(config)
+                loadedMTimes = mtimes
+            elif 'KUBERNETES_SERVICE_HOST' in env:
+                client = clientFromServiceAccount()  # the token file is rotated by the kubelet, a 401 reads it again
+            else:
+                raise Exception('No kube config found and not running in a cluster.')
+        # idle connections of the old client go now, ones in use (like a watch) are closed when they're done
+        if old is not None:
+            old.pool.clear()
+
+
+# tokens can expire while we hold them, like the OIDC id-token IKS kubeconfigs have
+# kubectl refreshes those when it talks to the api server and writes them back, so it gets to do that first
+# returns whether there's a new client to retry with
+def reloadAfterUnauthorized(stale):
+    with configLock:
+        if client is not stale:
+            return client is not None  # another thread got there first
+        if 'CD_KUBE_API_URL' in env:
+            return False
+        print('Kube api rejected our credentials, reloading them')
+        try:
+            sh('kubectl get --raw /api')
+        except ExecutionError:
+            pass  # loadConfig below still picks up anything generateKubeconfig wrote meanwhile
+        loadConfig()
+        return True
+
+
+def getClient():
+    if client is None or configChanged():
+        with configLock:
+            if client is None or configChanged():
+                loadConfig()
+    return client
+
+
+# a forked process starts out with whatever state our connections and locks were in, even ones another thread held
+def afterFork():
+    global configLock
+    configLock = threading.RLock()
+    if client is not None:
+        client.pool.clear()
+
+
+def configMapsPath(namespace=None, name=None):
+    return f'/api/v1/namespaces/{namespace or env.CD_NAMESPACE}/configmaps' + (f'/{name}' if name else '')
+
+
+def isNotFound(e):
+    return isinstance(e, KubeError) and e.status == 404
+
+
+def isConflict(e):
+    return isinstance(e, KubeError) and e.status == 409
+
+
+def getConfigMap(name, namespace=None):
+    return getClient().request('GET', configMapsPath(namespace, name))
+
+
+def listConfigMaps(labelSelector, namespace=None):
+    return getClient().request('GET', configMapsPath(namespace), query={'labelSelector': labelSelector})
+
+
+# like listConfigMaps but leaves out the data, which can be big, on api servers that support it (1.15+)
+def listConfigMapsMetadata(labelSelector, namespace=None):
+    try:
+        return getClient().request(
+            'GET',
+            configMapsPath(namespace),
+            query={'labelSelector': labelSelector},
+            accept='application/json;as=PartialObjectMetadataList;g=meta.k8s.io;v=v1,application/json')
+    except KubeError as e:
+        if e.status != 406:
+            raise
+    return listConfigMaps(labelSelector, namespace)
+
+
+def createConfigMap(obj, namespace=None):
+    return observe(getClient().request('POST', configMapsPath(namespace), obj))
+
+
+# creates all the given ConfigMaps, leaving alone any that already exist
+# all requests go over the same kept alive connection so this is cheap even for large batches
+def createConfigMaps(objs, namespace=None):
+    created = []
+    for obj in objs:
+        try:
+            created.append(createConfigMap(obj, namespace))
+        except KubeError as e:
+            if not isConflict(e):
+                raise
+    return created
+
+
+patchContentTypes = {
+    'merge': 'application/merge-patch+json',
+    'strategic': 'application/strategic-merge-patch+json',
+}
+
+
+# for ConfigMaps merge and strategic patches behave the same, both are here for other resource types
+def patchConfigMap(name, patch, namespace=None, patchType='merge'):
+    return observe(
+        getClient().request('PATCH', configMapsPath(namespace, name), patch, contentType=patchContentTypes[patchType]))
+
+
+# replaces the whole ConfigMap, fails with a conflict if it was changed after obj['metadata']['resourceVersion']
+def replaceConfigMap(obj, namespace=None):
+    return observe(getClient().request('PUT', configMapsPath(namespace, obj['metadata']['name']), obj))
+
+
+# create, or if it exists already, overwrite labels and data
+def applyConfigMap(obj, namespace=None):
+    try:
+        return createConfigMap(obj, namespace)
+    except KubeError as e:
+        if not isConflict(e):
+            raise
+    return patchConfigMap(
+        obj['metadata']['name'], {
+            'metadata': {
+                'labels': obj['metadata'].get('labels', {})
+            },
+            'data': obj.get('data', {})
+        }, namespace)
+
+
+def patchLabels(name, labels, namespace=None):
+    return patchConfigMap(name, {'metadata': {'labels': dict((k, str(v)) for k, v in labels.items())}}, namespace)
+
+
+def deleteConfigMap(name, namespace=None):
+    resp = getClient().request('DELETE', configMapsPath(namespace, name))
+    for informer in informers:
+        informer.remove(namespace or env.CD_NAMESPACE, name)
+    return resp
+
+
+def jobsPath(namespace, name=None):
+    return f'/apis/batch/v1/namespaces/{namespace}/jobs' + (f'/{name}' if name else '')
+
+
+# 'succeeded' or 'failed' once the Job has finished, None while it's still going
+def jobResult(job):
+    for condition in (job.get('status') or {}).get('conditions') or []:
+        if condition.get('status') == 'True' and condition.get('type') in ('Complete', 'Failed'):
+            return 'succeeded' if condition['type'] == 'Complete' else 'failed'
+    return None
+
+
+# blocks until the Job finishes and returns its jobResult, 'deleted' if it's deleted first
+# or None on timeout or once cancelled (a threading.Event)
+# the Job is watched, so this returns as soon as the api server knows it's done
+@tracing.traced('kube.waitForJob', 'kube')
+def waitForJob(name, namespace, timeout, cancelled=None):
+    tracing.annotate(job=name, namespace=namespace)
+    deadline = time.time() + timeout
+    query = {'fieldSelector': f'metadata.name={name}'}
+    resourceVersion = None
+    while time.time() < deadline and not (cancelled and cancelled.is_set()):
+        try:
+            if resourceVersion is None:
+                # list first so a Job that finished before the watch started isn't missed
+                resp = getClient().request('GET', jobsPath(namespace), query=query)
+                for job in resp['items']:
+                    if jobResult(job):
+                        return jobResult(job)
+                resourceVersion = resp['metadata']['resourceVersion']
+            # short watches so that cancelling doesn't have to wait long
+            for type, job in getClient().watch(
+                    jobsPath(namespace),
+                    dict(query, resourceVersion=resourceVersion),
+                    timeoutSeconds=max(1, int(min(15, deadline - time.time())))):
+                if type == 'ERROR':
+                    resourceVersion = None
+                    break
+                resourceVersion = job['metadata']['resourceVersion']
+                if type == 'DELETED':
+                    return 'deleted'
+                if type in ('ADDED', 'MODIFIED') and jobResult(job):
+                    return jobResult(job)
+                if cancelled and cancelled.is_set():
+                    return None
+        except Exception:
+            print(traceback.format_exc())
+            resourceVersion = None
+            time.sleep(5)
+    return None
+
+
+def deleteJob(name, namespace):
+    return getClient().request('DELETE', jobsPath(namespace, name), query={'propagationPolicy': 'Background'})
+
+
+# only equality based selectors (a=b,c=d) are supported, which is all quickcd uses
+def selectorMatches(selector, labels):
+    return all(labels.get(k) == v for k, v in (part.split('=', 1) for part in selector.split(',') if part))
+
+
+def resourceVersionNewer(new, old):
+    try:
+        return int(new) >= int(old)
+    except (TypeError, ValueError):
+        return True  # resource versions are opaque, if they aren't ints just trust the latest one we've seen
+
+
+informers = []
+
+
+# our own writes are applied to local caches straight away instead of waiting for them to come back through a watch
+def observe(obj):
+    for informer in informers:
+        informer.update(obj)
+    return obj
+
+
+class Informer:
+    """
+    Keeps an in-memory mirror of all ConfigMaps matching a label selector.
+    Filled by a single list, then kept current with a watch that resumes from the last seen resourceVersion.
+    Reads fall back to the api when the mirror isn't running, for example in a forked process.
+    """
+
+    def __init__(self, labelSelector, namespace=None):
+        self.labelSelector = labelSelector
+        self.namespace = namespace
+        self.items = {}
+        self.resourceVersion = None
+        self.lock = threading.Lock()
+        self.synced = threading.Event()
+        self.thread = None
+        informers.append(self)
+
+    def start(self):
+        if not self.running():
+            self.synced.clear()
+            self.thread = threading.Thread(target=self.run, name='informer', daemon=True)
+            self.thread.start()
+        return self
+
+    def running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def ready(self):
+        return self.running() and self.synced.is_set()
+
+    def waitSynced(self, timeout=60):
+        self.start()
+        return self.synced.wait(timeout)
+
+    def run(self):
+        while True:
+            try:
+                if not self.synced.is_set():
+                    self.relist()
+                for type, obj in getClient().watch(
+                        configMapsPath(self.namespace),
+                    {
+                        'labelSelector': self.labelSelector,
+                        'resourceVersion': self.resourceVersion
+                    }):
+                    if type == 'ERROR':
+                        # usually 410 Gone, our resourceVersion is too old so start over
+                        print(f"Watch error, relisting: {obj.get('message')}")
+                        self.synced.clear()
+                        break
+                    elif type == 'BOOKMARK':
+                        self.resourceVersion = obj['metadata']['resourceVersion']
+                    elif type == 'DELETED':
+                        self.remove(obj['metadata']['namespace'], obj['metadata']['name'])
+                        self.resourceVersion = obj['metadata']['resourceVersion']
+                    else:
+                        self.update(obj)
+                        self.resourceVersion = obj['metadata']['resourceVersion']
+            except Exception:
+                print(traceback.format_exc())
+                self.synced.clear()
+                time.sleep(5)
+
+    def relist(self):
+        resp = listConfigMaps(self.labelSelector, self.namespace)
+        with self.lock:
+            self.items = dict((obj['metadata']['name'], obj) for obj in resp['items'])
+            self.resourceVersion = resp['metadata']['resourceVersion']
+        self.synced.set()
+
+    def update(self, obj):
+        meta = obj.get('metadata', {})
+        if meta.get('namespace', env.CD_NAMESPACE) != (self.namespace or env.CD_NAMESPACE):
+            return
+        with self.lock:
+            if not selectorMatches(self.labelSelector, meta.get('labels') or {}):
+                self.items.pop(meta['name'], None)
+                return
+            old = self.items.get(meta['name'])
+            if old is None or resourceVersionNewer(meta.get('resourceVersion'), old['metadata'].get('resourceVersion')):
+                self.items[meta['name']] = obj
+
+    def remove(self, namespace, name):
+        if namespace == (self.namespace or env.CD_NAMESPACE):
+            with self.lock:
+                self.items.pop(name, None)
+
+    def get(self, name):
+        if not self.ready():
+            return getConfigMap(name, self.namespace)
+        with self.lock:
+            obj = self.items.get(name)
+        if obj is None:
+            raise KubeError(f'ConfigMap {name} not found in local cache', 404, b'')
+        return obj
+
+    def list(self, labelSelector=''):
+        if not self.ready():
+            selector = ','.join(s for s in (self.labelSelector, labelSelector) if s)
+            return listConfigMaps(selector, self.namespace)['items']
+        with self.lock:
+            return [
+                obj for obj in self.items.values()
+                if selectorMatches(labelSelector, obj['metadata'].get('labels') or {})
+            ]
+
+
+# mirror of everything quickcd keeps in its namespace: events, cursors, etc.
+state = Informer('owner=quickcd')
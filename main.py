@@ -1,6 +1,6 @@
-import time, init, json
-from common import sh, env, sleep, stillAlive, setInterruptHandlers
-from events import fetchAndSaveNewEvents, runHandlers, processNextEvent, hasHandlers
+import init, webhook, gitcache, compaction, metrics, replay, core
+from common import sh, env, setInterruptHandlers, removeStaleWorkspaces, pruneArtifacts, getRepos, repoContext
+from events import hasHandlers, getWorkerPool
 from pathlib import Path
 
 
@@ -13,41 +13,29 @@ def main():
         print("No handlers defined, exiting.")
         exit(0)
 
+    removeStaleWorkspaces()
+    pruneArtifacts()
+    for repo in getRepos():
+        with repoContext(repo):
+            gitcache.maintain()
+
     if env.CD_LOCAL_MODE == 'false':
+        getWorkerPool()  # fork workers before any background threads exist
         setInterruptHandlers()
+        compaction.start()
+        if 'CD_WEBHOOK_SECRET' in env:
+            webhook.enable()
+        if env.CD_METRICS == 'true':
+            metrics.enable()
 
-        lastConfig = 0
-        while stillAlive():
-            # refresh config token once an hour
-            if time.time() - lastConfig > 60 * 60:
-                print('Refreshing Kube config')
-                init.generateKubeconfig()
-                lastConfig = time.time()
-
-            if stillAlive():
-                fetchAndSaveNewEvents()
-
-            # keep dispatching events until all have been dispatched
-            # unless an interrupt arrives which we catch so we can finish the current dispatch call
-            while stillAlive() and processNextEvent():
-                sleep(1)  #will prevent busyloop in case of a bug of some sort
-
-            # finished processing all events, take a break
-            if stillAlive():
-                sleep(60)
-
+        core.run(getRepos())  # polls and dispatches until interrupted
         print("Clean exit.")
         exit(0)
     else:
-        print("Running in local mode: no comments an no status updates in GH, reading events from /app/testEvents.json")
+        print("Running in local mode: no comments an no status updates in GH, replaying recorded events, see replay.py")
         init.generateKubeconfig()
-        print("Running handlers for events in /app/testEvents.json")
-        with open("/app/testEvents.json") as f:
-            events = json.load(f)
-            for event in events:
-                runHandlers(event, False)
-            for event in events:
-                runHandlers(event, True)
+        with repoContext(getRepos()[0]):
+            replay.replay()
         print("Clean exit.")
 
 
@@ -0,0 +1,193 @@
+"""
+Counters, gauges and histograms served in the Prometheus text format on /metrics (port CD_HTTP_PORT) when
+CD_METRICS is true. Recording is always on, it's an uncontended lock and a dict update.
+
+Handlers running in worker processes record into the worker's copy of the metrics, what they recorded is sent back
+with the result of the handler and merged into the main process, see drain and merge.
+
+To have a look: curl -s localhost:8080/metrics
+"""
+import bisect, re, threading, time
+from contextlib import contextmanager
+from ratelimit import rateBudget
+
+registry = {}  # name -> metric, rendered in the order they were defined
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)
+
+
+class Metric:
+    type = 'untyped'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labelNames = tuple(labels)
+        self.lock = threading.Lock()
+        self.values = {}  # label values -> value
+        registry[name] = self
+
+    def key(self, labels):
+        return tuple(str(labels[name]) for name in self.labelNames)
+
+    def labelString(self, key, extra=()):
+        pairs = list(zip(self.labelNames, key)) + list(extra)
+        if not pairs:
+            return ''
+        return '{' + ','.join(f'{name}="{escape(value)}"' for name, value in pairs) + '}'
+
+    def samples(self):
+        with self.lock:
+            values = dict(self.values)
+        for key, value in sorted(values.items()):
+            yield self.name + self.labelString(key), value
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.type}']
+        lines += [f'{name} {formatValue(value)}' for name, value in self.samples()]
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def mergeValues(self, values):
+        for key, value in values.items():
+            with self.lock:
+                self.values[key] = self.values.get(key, 0) + value
+
+
+class Gauge(Metric):
+    """
+    Either set directly, or given fn which is called on every scrape and returns {label values tuple: value}.
+    """
+    type = 'gauge'
+
+    def __init__(self, name, help, labels=(), fn=None):
+        super().__init__(name, help, labels)
+        self.fn = fn
+
+    def set(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = value
+
+    def samples(self):
+        if self.fn is None:
+            yield from super().samples()
+            return
+        try:
+            values = self.fn()
+        except Exception as e:
+            print(f'Failed collecting {self.name}: {e}')
+            return
+        for key, value in sorted(values.items()):
+            yield self.name + self.labelString(key), value
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=DURATION_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    # counts per bucket, not cumulative, with +Inf at the end and then the sum
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        bucket = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            counts = self.values.get(key)
+            if counts is None:
+                counts = self.values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[bucket] += 1
+            counts[-1] += value
+
+    # observes how long the block took, labels can still be changed in the block, e.g. to set an outcome
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield labels
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def mergeValues(self, values):
+        for key, counts in values.items():
+            with self.lock:
+                current = self.values.setdefault(key, [0] * len(counts))
+                self.values[key] = [a + b for a, b in zip(current, counts)]
+
+    def samples(self):
+        with self.lock:
+            values = dict((key, list(counts)) for key, counts in self.values.items())
+        for key, counts in sorted(values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf', ), counts):
+                cumulative += count
+                yield self.name + '_bucket' + self.labelString(key, [('le', formatValue(bound))]), cumulative
+            yield self.name + '_sum' + self.labelString(key), counts[-1]
+            yield self.name + '_count' + self.labelString(key), cumulative
+
+
+def escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def formatValue(value):
+    if isinstance(value, str):
+        return value
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def render():
+    return '\n'.join(metric.render() for metric in list(registry.values())) + '\n'
+
+
+# what this process recorded since the last drain, the counters and histograms start over from zero
+def drain():
+    delta = {}
+    for metric in list(registry.values()):
+        if isinstance(metric, (Counter, Histogram)):
+            with metric.lock:
+                delta[metric.name], metric.values = metric.values, {}
+    return delta
+
+
+# adds what another process drained
+def merge(delta):
+    for name, values in (delta or {}).items():
+        if name in registry:
+            registry[name].mergeValues(values)
+
+
+# the first word of a command that isn't setting a variable, e.g. git, helm, kubectl
+def commandName(cmd):
+    match = re.match(r'\s*(?:\w+=\S*\s+)*([^\s;&|()]+)', cmd)
+    return match.group(1).split('/').pop() if match else ''
+
+
+# the series recorded across quickcd
+pollDuration = Histogram('quickcd_poll_duration_seconds', 'Time taken to poll GitHub for new events.', ['repo'])
+pollPages = Histogram(
+    'quickcd_poll_pages', 'Pages of events fetched per poll that found new events.', ['repo'], buckets=range(1, 11))
+eventsSaved = Counter('quickcd_events_saved_total', 'Events saved for dispatch.', ['repo', 'source'])
+eventsHandled = Counter('quickcd_events_handled_total', 'Events all handlers have completed for.', ['repo'])
+handlerDuration = Histogram('quickcd_handler_duration_seconds', 'Handler run time by outcome.',
+                            ['repo', 'handler', 'outcome'])
+shDuration = Histogram('quickcd_sh_duration_seconds', 'Shell command run time by command name and outcome.',
+                       ['command', 'outcome'])
+githubRequests = Counter('quickcd_github_requests_total', 'Requests made to the GitHub api by method and status.',
+                         ['method', 'status'])
+rateLimitRemaining = Gauge('quickcd_github_rate_limit_remaining', 'GitHub api requests left until the limit resets.',
+                           fn=lambda: {(): rateBudget.remaining} if rateBudget.remaining is not None else {})
+
+
+def enable():
+    import server  # not at the top, common imports this file and server imports common
+    server.addRoute('GET', '/metrics', lambda request: (200, 'text/plain; version=0.0.4; charset=utf-8', render()))
+    server.start()
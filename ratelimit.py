@@ -0,0 +1,75 @@
+"""
+Tracks the GitHub rate limit from the headers of every response and uses it to pace polling.
+Polling gets first claim on the budget: once it runs low, non-critical calls (statuses, comment updates)
+are held back until the limit resets while polling slows down but carries on.
+"""
+import os, time, random, threading
+
+
+class RateBudget:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.limit = None
+        self.remaining = None
+        self.reset = None
+        self.pollInterval = None
+
+    def record(self, headers):
+        with self.lock:
+            if 'X-RateLimit-Remaining' in headers:
+                self.remaining = int(headers['X-RateLimit-Remaining'])
+                self.limit = int(headers.get('X-RateLimit-Limit', self.limit or 5000))
+                self.reset = float(headers.get('X-RateLimit-Reset', time.time() + 60 * 60))
+            if 'X-Poll-Interval' in headers:
+                self.pollInterval = int(headers['X-Poll-Interval'])
+
+    # requests kept aside for polling
+    def reserve(self):
+        if 'CD_RATE_LIMIT_RESERVE' in os.environ:
+            return int(os.environ['CD_RATE_LIMIT_RESERVE'])
+        return (self.limit or 5000) // 10
+
+    def secondsUntilReset(self):
+        return max(1, (self.reset or 0) - time.time())
+
+    def known(self):
+        return self.remaining is not None and time.time() < (self.reset or 0)
+
+    # seconds non-critical calls should wait, 0 if they can go ahead
+    def deferFor(self):
+        with self.lock:
+            if self.known() and self.remaining <= self.reserve():
+                return self.secondsUntilReset()
+            return 0
+
+    # never faster than GitHub asks us to poll
+    def minimumPollDelay(self):
+        return max(self.pollInterval or 0, int(os.environ.get('CD_POLL_MIN_INTERVAL', '10')))
+
+    # how soon after the last poll an extra one may go, e.g. for a webhook delivery that couldn't be saved
+    # that's as soon as GitHub lets us unless we're running low, then it has to wait for its turn like any other
+    def earlyPollDelay(self, pollers=1):
+        if self.deferFor():
+            return self.nextPollDelay(pollers)
+        with self.lock:
+            return self.minimumPollDelay()
+
+    # pollers is the number of things polling on this budget, e.g. repositories
+    def nextPollDelay(self, pollers=1):
+        with self.lock:
+            minimum = self.minimumPollDelay()
+            maximum = int(os.environ.get('CD_POLL_MAX_INTERVAL', '300'))
+            if not self.known():
+                delay = max(minimum, int(os.environ.get('CD_POLL_INTERVAL', '60')))
+            elif self.remaining > self.reserve():
+                # plenty left, polling may use its share of what's spare until the reset
+                share = float(os.environ.get('CD_POLL_BUDGET_SHARE', '0.2'))
+                delay = self.secondsUntilReset() * pollers / ((self.remaining - self.reserve()) * share)
+                delay = min(max(delay, minimum), maximum)
+            else:
+                # running low, spread the reserve over the rest of the window
+                delay = max(minimum, self.secondsUntilReset() * pollers / max(1, self.remaining))
+        return delay * random.uniform(0.9, 1.1)  # jitter so that many instances don't poll in lockstep
+
+
+rateBudget = RateBudget()
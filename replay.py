@@ -0,0 +1,194 @@
+"""
+Replays recorded events through the handlers, this is what local mode runs and it's also a way to load test a
+pipeline offline against a production sized history. Events are read one at a time from CD_REPLAY_SOURCE
+(default /app/testEvents.json), which is either:
+ - a file of events as a JSON array, like testEvents.json, or as JSON lines
+ - a directory, whose .json and .jsonl files are read in name order. A .json file that isn't an event is taken to be a
+   recorded webhook payload named after the GitHub event it's for, e.g. push-0001.json or pull_request-0002.json
+
+CD_REPLAY_SPEED keeps the time between events from their created_at: 1 replays them as they happened, 60 replays an
+hour in a minute and 0 (the default) doesn't wait at all. Events are replayed in the order they're read.
+
+Nonblocking handlers run in the worker pool (CD_WORKERS) while the following events are replayed, blocking handlers
+run one at a time as each event comes up. A report of every handler's run times and throughput is printed at the end.
+"""
+import os, json, time, traceback
+from collections import deque, defaultdict
+from common import sleep, stillAlive, setInterruptHandlers, currentRepo
+from events import matchingHandlers, callHandler, runHandlerInWorker, getWorkerPool, workerCount, drainWorkers
+from compaction import createdAt
+from webhook import eventType, payloadAdapters
+import metrics
+
+READ_SIZE = 1024 * 1024
+
+
+# the JSON values in a file one after another, whether they're in an array, on separate lines or just concatenated
+def readJSONValues(f):
+    decoder = json.JSONDecoder()
+    buffer, position = '', 0
+    while True:
+        while position < len(buffer) and buffer[position] in ' \t\r\n,[]':
+            position += 1
+        try:
+            if position == len(buffer):
+                raise ValueError('Need more data')
+            value, position = decoder.raw_decode(buffer, position)
+        except ValueError:
+            chunk = f.read(READ_SIZE)
+            if not chunk:
+                if position == len(buffer):
+                    return
+                raise  # what's left isn't valid JSON
+            buffer, position = buffer[position:] + chunk, 0
+            continue
+        yield value
+
+
+# like the events api's version of the payload, see webhook.handleRepoDelivery
+def eventFromWebhookPayload(fileName, payload):
+    type = eventType(fileName.split('.')[0].split('-')[0])
+    return {
+        'type': type,
+        'payload': payloadAdapters.get(type, lambda p: p)(payload),
+        'actor': payload.get('sender'),
+        'repo': payload.get('repository')
+    }
+
+
+def readEvents(source):
+    if not os.path.isdir(source):
+        with open(source) as f:
+            yield from readJSONValues(f)
+        return
+    for name in sorted(os.listdir(source)):
+        if name.endswith(('.json', '.jsonl')):
+            with open(os.path.join(source, name)) as f:
+                for value in readJSONValues(f):
+                    yield value if 'type' in value and 'payload' in value else eventFromWebhookPayload(name, value)
+
+
+class HandlerStats:
+    def __init__(self):
+        self.durations = []
+        self.waits = []  # from the event being replayed until the handler started
+        self.failures = 0
+        self.start = None
+        self.end = None
+
+    def add(self, replayedAt, start, end, ok):
+        self.durations.append(end - start)
+        self.waits.append(max(0, start - replayedAt))
+        self.failures += not ok
+        self.start = min(start, self.start or start)
+        self.end = max(end, self.end or end)
+
+
+class Replay:
+    def __init__(self, source, speed):
+        self.source = source
+        self.speed = speed
+        self.stats = defaultdict(HandlerStats)  # handler name -> stats
+        self.inFlight = deque()  # (handler name, when the event was replayed, AsyncResult)
+        self.events = 0
+
+    def run(self):
+        start = time.time()
+        firstCreated = None
+        for event in readEvents(self.source):
+            if not stillAlive():
+                break
+            # the wait is for when the event is due, so time spent in blocking handlers isn't added on top
+            if self.speed and event.get('created_at'):
+                firstCreated = firstCreated or createdAt(event)
+                sleep(start + (createdAt(event) - firstCreated) / self.speed - time.time())
+            self.replay(event)
+        self.collect(wait=True)
+        return time.time() - start
+
+    def replay(self, event):
+        self.events += 1
+        eventID = int(event['id']) if str(event.get('id', '')).isdigit() else 0
+        handlers = matchingHandlers(event)
+        replayedAt = time.time()
+
+        for handler in [handler for handler in handlers if not handler.isBlocking]:
+            if not workerCount():
+                self.runInline(handler, event, eventID, replayedAt)
+                continue
+            # a bounded queue keeps the whole history from ending up in memory when handlers can't keep up
+            while len(self.inFlight) >= 2 * workerCount():
+                self.collect(wait=True, oldestOnly=True)
+            result = getWorkerPool().apply_async(runTimedInWorker,
+                                                 (currentRepo(), event['type'], handler.id, event['payload'], eventID))
+            self.inFlight.append((handler.name, replayedAt, result))
+        self.collect()
+
+        for handler in [handler for handler in handlers if handler.isBlocking]:
+            if not self.runInline(handler, event, eventID, replayedAt):
+                break  # like the main loop, a failed blocking handler stops the rest for this event
+
+    def runInline(self, handler, event, eventID, replayedAt):
+        print(f"Event {eventID}. Calling handler: {handler.name}")
+        start, ok = time.time(), True
+        try:
+            callHandler(handler, event['payload'], eventID)
+        except:
+            print(traceback.format_exc())
+            ok = False
+        self.stats[handler.name].add(replayedAt, start, time.time(), ok)
+        return ok
+
+    # records handlers that finished in the pool, waiting for all of them or just the oldest with wait
+    def collect(self, wait=False, oldestOnly=False):
+        while self.inFlight and (wait or self.inFlight[0][2].ready()):
+            name, replayedAt, result = self.inFlight.popleft()
+            try:
+                start, end, ok, error, recorded = result.get()
+            except:
+                start, end, ok, error, recorded = replayedAt, time.time(), False, traceback.format_exc(), None
+            metrics.merge(recorded)
+            if error:
+                print(error)
+            self.stats[name].add(replayedAt, start, end, ok)
+            if oldestOnly:
+                break
+
+    def report(self, elapsed):
+        lines = [
+            f'Replayed {self.events} events in {elapsed:.1f}s.',
+            f"{'handler':<30} {'runs':>6} {'failed':>6} {'runs/s':>8} {'p50':>8} {'p90':>8} {'p99':>8} {'max':>8} "
+            f"{'wait p50':>9} {'wait p99':>9}"
+        ]
+        for name, stats in sorted(self.stats.items()):
+            durations, waits = sorted(stats.durations), sorted(stats.waits)
+            throughput = len(durations) / max(stats.end - stats.start, 0.001)
+            lines.append(f'{name[:30]:<30} {len(durations):>6} {stats.failures:>6} {throughput:>8.2f} ' +
+                         ' '.join(f'{percentile(durations, p):>8.3f}' for p in (0.5, 0.9, 0.99, 1)) + ' ' +
+                         ' '.join(f'{percentile(waits, p):>9.3f}' for p in (0.5, 0.99)))
+        return '\n'.join(lines)
+
+
+def percentile(values, p):
+    return values[min(len(values) - 1, int(p * len(values)))] if values else 0
+
+
+# runs in a worker process, returns when the handler started and finished along with runHandlerInWorker's result
+def runTimedInWorker(repo, eventType, handlerID, payload, eventID):
+    start = time.time()
+    ok, error, recorded = runHandlerInWorker(repo, eventType, handlerID, payload, eventID)
+    return start, time.time(), ok, error, recorded
+
+
+def replay(source=None, speed=None):
+    # absolute since handlers change the working directory
+    source = os.path.abspath(source or os.environ.get('CD_REPLAY_SOURCE', '/app/testEvents.json'))
+    speed = float(speed if speed is not None else os.environ.get('CD_REPLAY_SPEED', '0'))
+    getWorkerPool()  # fork workers before any background threads exist
+    setInterruptHandlers()  # an interrupt stops the replay after the current event, running handlers are waited for
+    print(f'Replaying events from {source}' + (f' at {speed:g}x speed' if speed else ''))
+    engine = Replay(source, speed)
+    elapsed = engine.run()
+    drainWorkers()
+    print(engine.report(elapsed))
+    return engine
@@ -1,11 +1,102 @@
-class RetryException(Exception):
-    pass
-
-
 """
-This file should provide some decorators to allow for easy retries when RetryException is raised
+Decorators that retry a call when it raises RetryException, plus a circuit breaker so that an endpoint that keeps
+failing is left alone for a while instead of being retried by every caller.
 
 For example:
 @retry(3)
-@retryWithBackoff(?)
+@retryWithBackoff(5, base=1, maximum=60)
+
+Raise RetryException(message, after=seconds) to ask for a retry, after is how long the other side asked us to wait,
+e.g. from a Retry-After header. Any other exception is raised straight away.
 """
+import os, time, random, threading, functools
+from contextlib import contextmanager
+
+
+class RetryException(Exception):
+    def __init__(self, message='', after=None):
+        super().__init__(message)
+        self.after = after
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+# tries fn up to times times in total, without waiting in between unless asked to
+def retry(times, exceptions=(RetryException, )):
+    return retryWithBackoff(times, base=0, exceptions=exceptions)
+
+
+# tries fn up to times times in total, waiting a random time of up to base * 2^attempt seconds in between
+# a wait asked for with RetryException.after is used instead, unless it's longer than maximum, then we give up
+def retryWithBackoff(times=None, base=1, maximum=None, exceptions=(RetryException, )):
+    times = times or int(os.environ.get('CD_RETRY_ATTEMPTS', '4'))
+    maximum = maximum or float(os.environ.get('CD_RETRY_MAX_DELAY', '60'))
+
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            for attempt in range(1, times + 1):
+                try:
+                    return fn(*args, **kwargs)
+                except exceptions as e:
+                    delay = backoffDelay(attempt, base, maximum, getattr(e, 'after', None))
+                    if attempt == times or delay is None:
+                        raise
+                    print(f'Retrying {fn.__name__} in {delay:.1f}s, attempt {attempt} failed: {str(e)[:200]}')
+                    time.sleep(delay)
+
+        return wrapper
+
+    return decorator
+
+
+# full jitter, so that callers that failed together don't all come back at the same moment
+def backoffDelay(attempt, base, maximum, after=None):
+    if after is not None:
+        return after if after <= maximum else None
+    return random.uniform(0, min(maximum, base * 2**(attempt - 1)))
+
+
+class CircuitBreaker:
+    """
+    After threshold failures in a row for an endpoint, calls to it raise CircuitOpenError right away for the next
+    cooldown seconds. Then a single call is let through, if that succeeds the endpoint is back in business.
+    Only exceptions of the given types count as failures, anything else means the endpoint did answer.
+    """
+
+    def __init__(self, threshold=None, cooldown=None, failures=(RetryException, )):
+        self.threshold = threshold or int(os.environ.get('CD_CIRCUIT_THRESHOLD', '5'))
+        self.cooldown = cooldown or float(os.environ.get('CD_CIRCUIT_COOLDOWN', '30'))
+        self.failureTypes = failures
+        self.lock = threading.Lock()
+        self.failures = {}  # endpoint -> failures in a row
+        self.openUntil = {}  # endpoint -> time
+
+    @contextmanager
+    def call(self, endpoint):
+        with self.lock:
+            if endpoint in self.openUntil:
+                if time.time() < self.openUntil[endpoint]:
+                    raise CircuitOpenError(f'{endpoint} failed {self.failures[endpoint]} times in a row, ' +
+                                           f'not calling it for another {self.openUntil[endpoint] - time.time():.0f}s')
+                self.openUntil[endpoint] = time.time() + self.cooldown  # this call is the trial, keep others out
+        try:
+            yield
+        except self.failureTypes:
+            with self.lock:
+                self.failures[endpoint] = self.failures.get(endpoint, 0) + 1
+                if self.failures[endpoint] >= self.threshold:
+                    self.openUntil[endpoint] = time.time() + self.cooldown
+            raise
+        except Exception:
+            self.succeeded(endpoint)
+            raise
+        else:
+            self.succeeded(endpoint)
+
+    def succeeded(self, endpoint):
+        with self.lock:
+            self.failures.pop(endpoint, None)
+            self.openUntil.pop(endpoint, None)
@@ -0,0 +1,67 @@
+"""
+A tiny built-in HTTP server other modules can add routes to, e.g. the webhook endpoint.
+It's only started when something needs it, on CD_HTTP_PORT.
+"""
+import threading, traceback
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+from common import env
+
+MAX_BODY = 25 * 1024 * 1024  # GitHub caps webhook payloads at 25MB
+routes = {}  # (method, path) -> fn(request) returning (status, contentType, body)
+
+
+def addRoute(method, path, fn):
+    routes[(method, path)] = fn
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    def dispatch(self, method):
+        fn = routes.get((method, self.path.split('?')[0]))
+        if fn is None:
+            return self.respond(404, 'text/plain', b'Not found\n')
+        try:
+            status, contentType, body = fn(self)
+        except:
+            print(traceback.format_exc())
+            status, contentType, body = 500, 'text/plain', b'Internal error\n'
+        self.respond(status, contentType, body)
+
+    def respond(self, status, contentType, body):
+        body = body.encode('utf-8') if isinstance(body, str) else body
+        self.send_response(status)
+        self.send_header('Content-Type', contentType)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def readBody(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        if length > MAX_BODY:
+            raise Exception(f'Request body too large: {length}')
+        return self.rfile.read(length)
+
+    def do_GET(self):
+        self.dispatch('GET')
+
+    def do_POST(self):
+        self.dispatch('POST')
+
+    def log_message(self, format, *args):
+        if env.CD_DEBUG == 'true':
+            super().log_message(format, *args)
+
+
+class ThreadingServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+httpServer = None
+
+
+def start():
+    global httpServer
+    if httpServer is None:
+        httpServer = ThreadingServer(('', int(env.CD_HTTP_PORT)), RequestHandler)
+        threading.Thread(target=httpServer.serve_forever, name='http-server', daemon=True).start()
+        print(f'Listening on port {env.CD_HTTP_PORT}')
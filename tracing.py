@@ -0,0 +1,165 @@
+"""
+Records where the time goes in a handler run as a tree of spans: shell commands, GitHub and Kubernetes api calls,
+log updates and the steps of a chart deployment. Each traced run is written out in the Chrome trace format, which
+chrome://tracing and https://ui.perfetto.dev open, as an artifact linked from the output of quickcd.
+Span ids are in OpenTelemetry's format and are included in each span's args along with its parent's.
+
+CD_TRACE_SAMPLE_RATE is the fraction of handler runs that are traced, 0 (the default) turns tracing off.
+Outside of a traced run span() and traced() only cost a thread local lookup. Work handed to other threads with bind()
+that's still going on after the trace is saved isn't in it.
+
+@tracing.traced('charts.deploy')
+def deploy(): ...
+
+with tracing.span('wait for rollout', 'kube', deployment=name): ...
+"""
+import os, time, random, threading, functools
+from contextlib import contextmanager
+
+local = threading.local()  # .span is the innermost span open in this thread
+
+
+class Trace:
+    def __init__(self, name):
+        self.name = name
+        self.id = '%032x' % random.getrandbits(128)
+        self.lock = threading.Lock()
+        self.spans = []  # finished ones
+        self.saved = False
+
+    # Chrome trace format, 'X' events are complete spans with their duration, 'M' events name processes and threads
+    def export(self):
+        pid = os.getpid()
+        with self.lock:
+            spans = list(self.spans)
+        events = [{'name': 'process_name', 'ph': 'M', 'pid': pid, 'tid': 0, 'args': {'name': self.name}}]
+        for tid, threadName in sorted(set((span.tid, span.threadName) for span in spans)):
+            events.append({'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': tid, 'args': {'name': threadName}})
+        for span in sorted(spans, key=lambda span: span.start):
+            events.append({
+                'name': span.name,
+                'cat': span.category,
+                'ph': 'X',
+                'ts': round(span.start * 1e6),
+                'dur': round(span.duration * 1e6),
+                'pid': pid,
+                'tid': span.tid,
+                'args': dict(span.attributes,
+                             traceId=self.id,
+                             spanId=span.id,
+                             parentSpanId=span.parent.id if span.parent else None)
+            })
+        return {'traceEvents': events, 'displayTimeUnit': 'ms', 'otherData': {'traceId': self.id, 'name': self.name}}
+
+
+class Span:
+    def __init__(self, trace, name, category, parent, attributes):
+        self.trace = trace
+        self.name = name
+        self.category = category
+        self.parent = parent
+        self.attributes = attributes
+        self.id = '%016x' % random.getrandbits(64)
+        self.tid = threading.get_ident()
+        self.threadName = threading.current_thread().name
+        self.start = time.time()
+        self.duration = None
+
+    def end(self):
+        self.duration = time.time() - self.start
+        with self.trace.lock:
+            self.trace.spans.append(self)
+
+
+def current():
+    return getattr(local, 'span', None)
+
+
+@contextmanager
+def activate(span):
+    previous, local.span = current(), span
+    try:
+        yield span
+    finally:
+        local.span = previous
+
+
+# traces the block for sampleRate of the times it runs, save is called with the Trace when it's done
+# within a trace this is just a span
+@contextmanager
+def trace(name, category='handler', save=None, sampleRate=1, **attributes):
+    if current() is not None:
+        with span(name, category, **attributes) as s:
+            yield s
+        return
+    if random.random() >= sampleRate:
+        yield None
+        return
+    root = Span(Trace(name), name, category, None, attributes)
+    try:
+        with activate(root):
+            yield root
+    except BaseException as e:
+        root.attributes['error'] = repr(e)[:500]
+        raise
+    finally:
+        root.end()
+        root.trace.saved = True
+        if save:
+            save(root.trace)
+
+
+# a child of the current span, nothing happens unless we're in a trace
+@contextmanager
+def span(name, category='function', **attributes):
+    parent = current()
+    if parent is None:
+        yield None
+        return
+    s = Span(parent.trace, name, category, parent, attributes)
+    try:
+        with activate(s):
+            yield s
+    except BaseException as e:
+        s.attributes['error'] = repr(e)[:500]
+        raise
+    finally:
+        s.end()
+
+
+def traced(name=None, category='function'):
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if current() is None:
+                return fn(*args, **kwargs)
+            with span(name or fn.__qualname__, category):
+                return fn(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+# adds attributes to the current span, e.g. the result of what it's timing
+def annotate(**attributes):
+    s = current()
+    if s is not None:
+        s.attributes.update(attributes)
+
+
+# wraps fn to run as a span of the current trace in whatever thread calls it, for handing work off to other threads
+# once the trace is saved fn runs untraced
+def bind(fn, name=None, category='function'):
+    parent = current()
+    if parent is None:
+        return fn
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        if parent.trace.saved:
+            return fn(*args, **kwargs)
+        with activate(parent), span(name or fn.__qualname__, category):
+            return fn(*args, **kwargs)
+
+    return wrapper
@@ -0,0 +1,118 @@
+"""
+Optional GitHub webhook endpoint, enabled by setting CD_WEBHOOK_SECRET to the secret configured on the webhook.
+Deliveries are saved the same way polled events are and the main loop is woken right away, polling carries on
+in the background to catch anything a webhook missed. Blocking handlers of a delivery wait for the next poll, see
+events.processNextEvent.
+
+To try it locally, post a recorded payload:
+python webhook.py push payload.json http://localhost:8080/webhook
+"""
+import hmac, hashlib, json, time, sys, uuid
+from common import env, getFullName, wake, getRepos, repoContext, currentRepo
+from events import matchingHandlers, dedupKey, saveEvents
+import server, kube
+
+# payloads that differ between the events api and webhooks, made to look like the events api version
+payloadAdapters = {
+    'PushEvent': lambda p: dict(p, head=p['after'], size=len(p.get('commits') or [])),
+}
+
+
+def signature(body, secret=None):
+    return 'sha256=' + hmac.new((secret or env.CD_WEBHOOK_SECRET).encode('utf-8'), body, hashlib.sha256).hexdigest()
+
+
+def validSignature(request, body):
+    received = request.headers.get('X-Hub-Signature-256')
+    if received:
+        return hmac.compare_digest(received, signature(body))
+    received = request.headers.get('X-Hub-Signature')  # older GitHub Enterprise only sends sha1
+    if received:
+        expected = 'sha1=' + hmac.new(env.CD_WEBHOOK_SECRET.encode('utf-8'), body, hashlib.sha1).hexdigest()
+        return hmac.compare_digest(received, expected)
+    return False
+
+
+# push -> PushEvent, pull_request -> PullRequestEvent, etc.
+def eventType(webhookEvent):
+    return ''.join(word.title() for word in webhookEvent.split('_')) + 'Event'
+
+
+def handleDelivery(request):
+    body = request.readBody()
+    if not validSignature(request, body):
+        return 401, 'text/plain', 'Bad signature\n'
+
+    webhookEvent = request.headers.get('X-GitHub-Event', '')
+    if webhookEvent == 'ping':
+        return 200, 'text/plain', 'pong\n'
+
+    payload = json.loads(body.decode('utf-8'))
+    fullName = payload.get('repository', {}).get('full_name', '').lower()
+    repo = next((repo for repo in getRepos() if '/'.join(repo).lower() == fullName), None)
+    if repo is None:
+        return 202, 'text/plain', 'Ignored, not one of our repositories\n'
+
+    with repoContext(repo):
+        return handleRepoDelivery(request, webhookEvent, payload)
+
+
+def handleRepoDelivery(request, webhookEvent, payload):
+    type = eventType(webhookEvent)
+    payload = payloadAdapters.get(type, lambda p: p)(payload)
+    event = {
+        'type': type,
+        'payload': payload,
+        'actor': payload.get('sender'),
+        'repo': payload.get('repository'),
+        'created_at': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'received_at': time.time(),
+        'delivery': request.headers.get('X-GitHub-Delivery') or str(uuid.uuid4()),
+    }
+
+    if not matchingHandlers(event):
+        return 202, 'text/plain', 'Accepted\n'
+    # events we can't match up with their polled version or couldn't save are left to polling,
+    # which is asked to come early, as far as the rate limit allows
+    saved = False
+    try:
+        saved = dedupKey(event) and saveDelivery(event)
+    finally:
+        wake(poll=False if saved else currentRepo())
+    return 202, 'text/plain', 'Accepted\n'
+
+
+# webhook events don't have an events api id, they're named after the delivery instead
+# a redelivery has the same name and isn't saved again
+def saveDelivery(event):
+    try:
+        kube.state.get(getFullName('event-cursor'))
+    except kube.KubeError:
+        return False  # first run, nothing gets saved until polling has set the cursor
+    event['id'] = f"webhook-{event['delivery']}"
+    saveEvents([event], source='webhook')
+    return True
+
+
+def enable():
+    server.addRoute('POST', '/webhook', handleDelivery)
+    server.start()
+
+
+# posts a recorded payload to a running quickcd, signed with CD_WEBHOOK_SECRET
+if __name__ == '__main__':
+    import urllib3
+    webhookEvent, payloadFile, url = sys.argv[1:4]
+    with open(payloadFile, 'rb') as f:
+        body = f.read()
+    resp = urllib3.PoolManager().request(
+        'POST',
+        url,
+        body=body,
+        headers={
+            'Content-Type': 'application/json',
+            'X-GitHub-Event': webhookEvent,
+            'X-GitHub-Delivery': str(uuid.uuid4()),
+            'X-Hub-Signature-256': signature(body)
+        })
+    print(resp.status, resp.data.decode('utf-8'))